@@ -17,7 +17,8 @@ from geometry_msgs.msg import PoseStamped, TransformStamped
 from RavenDebridement.Utils import Util
 from RavenDebridement.Utils import Constants
 
-from RavenDebridement.RavenCommand import kinematics
+from RavenDebridement.RavenCommand import RavenKinematicModel
+from RavenDebridement.RavenCommand.JointState import JointState
 
 import IPython
 
@@ -136,8 +137,9 @@ class GripperPoseEstimator():
             arm_msg = [msg_arm for msg_arm in msg.arms if msg_arm.name == arm][0]
             #self.calcPose[arm] = tfx.pose(arm_msg.tool.pose,header=msg.header)
             
-            joints = dict((j.type,j.position) for j in arm_msg.joints)
-            fwdArmKinPose, grasp = kinematics.fwdArmKin(arm,joints)
+            joints = JointState.fromMsg(arm, arm_msg.joints)
+            fwdArmKinTf, grasp = RavenKinematicModel.getModel(arm).fwdArmKin(joints)
+            fwdArmKinPose = tfx.transform(fwdArmKinTf).as_pose(frame='/0_link')
             self.calcPose[arm] = (fwdArmKinPose.as_tf() * self.calcPosePostAdjustment[arm]).as_pose(stamp=msg.header.stamp)
             
             self._updateEstimatedPose(arm)
@@ -0,0 +1,115 @@
+"""
+Planning against a wall-clock deadline: the trajectory quality measure,
+the outcomes of a budgeted plan and their statistics
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import threading
+from collections import defaultdict
+
+import numpy as np
+
+# trajopt's result was handed back before the deadline
+MET = 'met'
+# trajopt wasn't done by the deadline, the best trajectory found without
+# it was handed back before the deadline
+FALLBACK = 'fallback'
+# the result was handed back after the deadline, because nothing feasible
+# was found without trajopt or the planner was held up
+LATE = 'late'
+OUTCOMES = [MET, FALLBACK, LATE]
+
+# fallback from the trajectory library's warm start, checked like the tiers
+WARM_START = 'warm_start'
+
+# upper edges (seconds) of the budgets the stats are grouped by
+BUDGET_BINS = [.1, .25, .5, 1., 2., 5., np.inf]
+
+def jointPathCost(traj):
+    """
+    Sum of the squared joint steps of an (N, dofs) trajectory, trajopt's
+    joint_vel cost with a coefficient of 1
+    """
+    traj = np.asarray(traj, dtype=float)
+    if len(traj) < 2:
+        return 0.
+    return float(np.sum(np.diff(traj, axis=0)**2))
+
+def normalizedCost(traj):
+    """
+    jointPathCost over that of the straight line between the ends with as
+    many waypoints, its minimum. 1 for a straight line and above for
+    anything longer
+    """
+    traj = np.asarray(traj, dtype=float)
+    if len(traj) < 2:
+        return 1.
+    minimum = np.sum((traj[-1] - traj[0])**2) / (len(traj) - 1)
+    if minimum <= 0:
+        return 1.
+    return jointPathCost(traj) / minimum
+
+def budgetBin(budget):
+    for edge in BUDGET_BINS:
+        if budget <= edge:
+            return edge
+    return BUDGET_BINS[-1]
+
+class AnytimeStats(object):
+    """
+    Outcome, planning time, overrun of the deadline and normalizedCost of
+    each budgeted plan, grouped by budget, and the cost of the fallbacks
+    against their refinements
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.plans = defaultdict(list)
+            self.refinements = []
+
+    def record(self, budget, planTime, outcome, cost):
+        """
+        budget and planTime in seconds, cost the normalizedCost of the
+        trajectory returned (None if there was none)
+        """
+        with self.lock:
+            self.plans[budgetBin(budget)].append((outcome, planTime, planTime - budget, cost))
+
+    def recordRefinement(self, fallbackCost, refinedCost):
+        with self.lock:
+            self.refinements.append((fallbackCost, refinedCost))
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            outcomes = defaultdict(int)
+            for edge, plans in sorted(self.plans.iteritems()):
+                binStats = {'requests' : len(plans)}
+                for outcome in OUTCOMES:
+                    count = sum(1 for plan in plans if plan[0] == outcome)
+                    binStats[outcome] = count
+                    outcomes[outcome] += count
+                binStats['missRate'] = 1. - binStats[MET] / float(len(plans))
+                binStats['medianPlanTime'] = float(np.median([plan[1] for plan in plans]))
+                overruns = [plan[2] for plan in plans if plan[0] == LATE]
+                if overruns:
+                    binStats['medianOverrun'] = float(np.median(overruns))
+                for outcome in (MET, FALLBACK):
+                    costs = [plan[3] for plan in plans if plan[0] == outcome and plan[3] is not None]
+                    if costs:
+                        binStats['medianCost_%s' % outcome] = float(np.median(costs))
+                stats['budget<=%g' % edge] = binStats
+            requests = sum(outcomes.values())
+            if requests:
+                stats['requests'] = requests
+                stats['missRate'] = 1. - outcomes[MET] / float(requests)
+                stats.update(outcomes)
+            if self.refinements:
+                stats['refinements'] = len(self.refinements)
+                stats['medianFallbackOverRefined'] = float(np.median([fallback / refined for fallback, refined in self.refinements if refined > 0] or [np.nan]))
+            return stats
@@ -0,0 +1,160 @@
+"""
+Capsule model of the Raven tools built from the kinematics.py link frames,
+for fast clearance checks between the two arms
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import numpy as np
+
+import RavenDebridement.RavenCommand.kinematics as kin
+from RavenDebridement.RavenCommand.kinematics import JOINT_TYPES, GOLD_ARM_ID, GREEN_ARM_ID
+
+# capsules of each arm as (name, start point, end point, radius in meters).
+# The points are the remote center of motion (rcm), the shaft end outside of
+# it (shaftTop), the wrist (pitch axis), the yaw axis and the tool point
+CAPSULES = [('shaft', 'shaftTop', 'wrist', .005),
+            ('wrist', 'wrist', 'yaw', .005),
+            ('jaws', 'yaw', 'tool', .004)]
+
+# how far the modeled shaft extends outside the remote center of motion
+SHAFT_EXTENSION = .05
+
+_BASE = dict((armId, kin._tf_array(kin.actual_world_to_ik_world(armId) * kin.Tw2b)) for armId in (GOLD_ARM_ID, GREEN_ARM_ID))
+_XU = kin._tf_array(kin.Xu)
+_XF = kin._tf_array(kin.Xf)
+_XIP = kin._tf_array(kin.Xip)
+_XPY = kin._tf_array(kin.Xpy)
+_TG = kin._tf_array(kin.Tg)
+
+def _jointArray(joints):
+    """
+    (N,7) array from an (N,7) array, a JointTrajectory or a list of joint dicts
+    """
+    if isinstance(joints, np.ndarray):
+        return joints.reshape(-1,len(JOINT_TYPES)).astype(float)
+    return kin.jointDictsToArray(joints)
+
+def linkPoints(armId, joints):
+    """
+    Points of the link frames (Tw2r, Tw2i, Tw2p, Tw2y and the tool) for
+    every waypoint of joints, as a dict of (N,3) arrays in '/0_link'
+    """
+    joints = _jointArray(joints)
+    ths, the, d, thr, thp, g1, g2 = joints.T
+
+    # shoulder, elbow and roll only rotate about the remote center of motion
+    F = np.matmul(_BASE[armId], kin._Z_batch(kin.THS_TO_IK(armId,ths)))
+    F = np.matmul(np.matmul(F, _XU), kin._Z_batch(kin.THE_TO_IK(armId,the)))
+    F = np.matmul(np.matmul(F, _XF), kin._Z_batch(kin.THR_TO_IK(armId,thr)))
+    rcm = F[:,:3,3]
+
+    F = np.matmul(np.matmul(F, kin._Z_batch(np.zeros(len(joints)), kin.D_TO_IK(armId,d))), _XIP)
+    wrist = F[:,:3,3]
+    F = np.matmul(np.matmul(F, kin._Z_batch(kin.THP_TO_IK(armId,thp))), _XPY)
+    yaw = F[:,:3,3]
+    F = np.matmul(np.matmul(F, kin._Z_batch(kin.THY_TO_IK_FROM_FINGERS(armId,g1,g2))), _TG)
+    tool = F[:,:3,3]
+
+    # the shaft continues through the rcm, away from the wrist
+    outward = rcm - wrist
+    outward /= np.maximum(np.linalg.norm(outward, axis=1), 1e-9)[:,None]
+
+    return {'rcm' : rcm,
+            'shaftTop' : rcm + SHAFT_EXTENSION * outward,
+            'wrist' : wrist,
+            'yaw' : yaw,
+            'tool' : tool}
+
+def armCapsules(armId, joints, capsules=CAPSULES):
+    """
+    Capsule segments of every waypoint: starts and ends (N,K,3) and radii (K,)
+    """
+    points = linkPoints(armId, joints)
+    starts = np.stack([points[start] for _, start, _, _ in capsules], axis=1)
+    ends = np.stack([points[end] for _, _, end, _ in capsules], axis=1)
+    radii = np.array([radius for _, _, _, radius in capsules])
+    return starts, ends, radii
+
+def segmentDistance(p1, q1, p2, q2):
+    """
+    Distance between the segments p1-q1 and p2-q2, broadcasting over all
+    leading dimensions of the (...,3) arrays
+    """
+    d1 = q1 - p1
+    d2 = q2 - p2
+    r = p1 - p2
+    a = np.sum(d1*d1, axis=-1)
+    e = np.sum(d2*d2, axis=-1)
+    f = np.sum(d2*r, axis=-1)
+    c = np.sum(d1*r, axis=-1)
+    b = np.sum(d1*d2, axis=-1)
+    eps = 1e-12
+
+    denom = a*e - b*b
+    # closest point on the first segment's line to the second, clamped
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.where(denom > eps, np.clip((b*f - c*e) / denom, 0., 1.), 0.)
+        t = np.where(e > eps, (b*s + f) / e, 0.)
+        # t outside [0,1]: clamp it and recompute s
+        t_clamped = np.clip(t, 0., 1.)
+        s = np.where(t != t_clamped, np.where(a > eps, np.clip((b*t_clamped - c) / a, 0., 1.), 0.), s)
+    t = t_clamped
+
+    closest = (p1 + d1 * s[...,None]) - (p2 + d2 * t[...,None])
+    return np.sqrt(np.sum(closest*closest, axis=-1))
+
+def _pad(joints, n):
+    """
+    Holds the last waypoint so the trajectory has n waypoints
+    """
+    if len(joints) >= n:
+        return joints
+    return np.concatenate((joints, np.repeat(joints[-1:], n - len(joints), axis=0)))
+
+def trajectoryClearance(leftJoints, rightJoints, capsules=CAPSULES):
+    """
+    Clearance (capsule surface distance, negative when they intersect)
+    between the left and right arm at each waypoint of the two joint
+    trajectories, paired by index. The shorter one holds its last waypoint
+    """
+    leftJoints, rightJoints = _jointArray(leftJoints), _jointArray(rightJoints)
+    n = max(len(leftJoints), len(rightJoints))
+    leftStarts, leftEnds, leftRadii = armCapsules(GOLD_ARM_ID, _pad(leftJoints, n), capsules)
+    rightStarts, rightEnds, rightRadii = armCapsules(GREEN_ARM_ID, _pad(rightJoints, n), capsules)
+
+    # (N,K,K) over all capsule pairs
+    dist = segmentDistance(leftStarts[:,:,None], leftEnds[:,:,None], rightStarts[:,None,:], rightEnds[:,None,:])
+    dist -= leftRadii[:,None] + rightRadii[None,:]
+    return dist.reshape(n,-1).min(axis=1)
+
+def sweptClearance(leftJoints, rightJoints, capsules=CAPSULES):
+    """
+    Smallest clearance between any left waypoint and any right waypoint,
+    for when the timing of the two trajectories is not known
+    """
+    leftStarts, leftEnds, leftRadii = armCapsules(GOLD_ARM_ID, leftJoints, capsules)
+    rightStarts, rightEnds, rightRadii = armCapsules(GREEN_ARM_ID, rightJoints, capsules)
+    leftStarts, leftEnds = leftStarts.reshape(-1,3), leftEnds.reshape(-1,3)
+    rightStarts, rightEnds = rightStarts.reshape(-1,3), rightEnds.reshape(-1,3)
+
+    dist = segmentDistance(leftStarts[:,None], leftEnds[:,None], rightStarts[None,:], rightEnds[None,:])
+    dist -= np.tile(leftRadii, len(leftStarts) // len(leftRadii))[:,None] + np.tile(rightRadii, len(rightStarts) // len(rightRadii))[None,:]
+    return float(dist.min())
+
+def armSweptClearance(armId, joints, otherJoints, capsules=CAPSULES):
+    """
+    sweptClearance between joints of armId and otherJoints of the other arm
+    """
+    if armId == GOLD_ARM_ID:
+        return sweptClearance(joints, otherJoints, capsules)
+    return sweptClearance(otherJoints, joints, capsules)
+
+def minClearance(leftJoints, rightJoints, capsules=CAPSULES):
+    """
+    Minimum clearance along the two trajectories and the waypoint where it occurs
+    """
+    clearance = trajectoryClearance(leftJoints, rightJoints, capsules)
+    index = int(np.argmin(clearance))
+    return float(clearance[index]), index
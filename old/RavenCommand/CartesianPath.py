@@ -0,0 +1,91 @@
+"""
+Straight-line (lerp + slerp) Cartesian paths solved with the batch IK,
+for short moves that do not need trajopt
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import numpy as np
+
+import RavenDebridement.RavenCommand.kinematics as kin
+from RavenDebridement.RavenCommand.kinematics import JOINT_TYPES, JOINT_WEIGHTS
+from RavenDebridement.RavenCommand import DifferentialKinematics
+
+class CartesianPathError(RuntimeError):
+    """
+    Raised when a waypoint of the path has no valid ik solution,
+    or the path has to jump between ik branches. index is the first
+    failing waypoint
+    """
+    def __init__(self, msg, index):
+        RuntimeError.__init__(self, msg)
+        self.index = index
+
+def numSteps(startPose, endPose, stepsPerMeter=200, stepsPerRadian=20):
+    """
+    Number of waypoints (including both ends) for the given step density
+    """
+    startPose, endPose = np.asarray(startPose), np.asarray(endPose)
+    dist = np.linalg.norm(endPose[:3,3] - startPose[:3,3])
+    angle = np.linalg.norm(DifferentialKinematics.rotationToAxisAngle(endPose[:3,:3].dot(startPose[:3,:3].T)))
+    return int(max(np.ceil(dist * stepsPerMeter), np.ceil(angle * stepsPerRadian), 1)) + 1
+
+def cartesianPathIK(armId, startPose, endPose, startGrasp, endGrasp=None, n_steps=None,
+                    stepsPerMeter=200, seedJoints=None, maxJointStep=.5):
+    """
+    Interpolates the 4x4 poses (in '/0_link') from startPose to endPose and
+    solves every waypoint with the batch IK. Among the elbow/roll branches,
+    picks the sequence with the smallest weighted joint motion, starting
+    from seedJoints (a joint dict) if given.
+
+    Returns (jointTraj, poseTraj): n_steps joint dicts (as from invArmKin)
+    and n_steps 4x4 poses. Raises CartesianPathError with the index of the
+    first failing waypoint
+    """
+    startPose, endPose = np.asarray(startPose, dtype=float), np.asarray(endPose, dtype=float)
+    if endGrasp is None:
+        endGrasp = startGrasp
+    if n_steps is None:
+        n_steps = numSteps(startPose, endPose, stepsPerMeter)
+    n_steps = max(int(n_steps), 2)
+
+    poses = DifferentialKinematics.interpolatePoses(startPose, endPose, n_steps)
+    grasps = np.linspace(startGrasp, endGrasp, n_steps)
+
+    candidates, valid = kin._invArmKinCandidates(armId, poses, grasps)
+    noSolution = ~valid.any(axis=1)
+    if noSolution.any():
+        index = int(np.argmax(noSolution))
+        raise CartesianPathError('No valid ik for waypoint %d of %d' % (index, n_steps), index)
+
+    # shortest path through the candidates of each waypoint
+    weighted = candidates * JOINT_WEIGHTS
+    if seedJoints is not None:
+        seed = np.array([seedJoints[jointType] for jointType in JOINT_TYPES]) * JOINT_WEIGHTS
+        cost = np.linalg.norm(weighted[0] - seed, axis=1)
+    else:
+        cost = np.zeros(candidates.shape[1])
+    cost[~valid[0]] = np.inf
+
+    prev = np.zeros((n_steps, candidates.shape[1]), dtype=int)
+    for i in xrange(1, n_steps):
+        step = np.linalg.norm(weighted[i][:,None,:] - weighted[i-1][None,:,:], axis=2)
+        total = np.where(np.isnan(step), np.inf, step) + cost[None,:]
+        prev[i] = np.argmin(total, axis=1)
+        cost = total[np.arange(len(cost)), prev[i]]
+        cost[~valid[i]] = np.inf
+
+    chosen = np.empty(n_steps, dtype=int)
+    chosen[-1] = np.argmin(cost)
+    for i in xrange(n_steps-1, 0, -1):
+        chosen[i-1] = prev[i, chosen[i]]
+    joints = candidates[np.arange(n_steps), chosen]
+
+    if maxJointStep is not None and n_steps > 1:
+        steps = np.linalg.norm(np.diff(joints * JOINT_WEIGHTS, axis=0), axis=1)
+        if steps.max() > maxJointStep:
+            index = int(np.argmax(steps > maxJointStep)) + 1
+            raise CartesianPathError('Joint jump of %.3f at waypoint %d of %d' % (steps[index-1], index, n_steps), index)
+
+    return kin._ikJointDicts(armId, joints, grasps), list(poses)
@@ -0,0 +1,198 @@
+"""
+Analytic Jacobian of the Raven chain in kinematics.py and a
+damped-least-squares resolved-rate solver for small corrective moves
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import numpy as np
+
+import RavenDebridement.RavenCommand.kinematics as kin
+from RavenDebridement.RavenCommand.kinematics import (SHOULDER, ELBOW, Z_INS, TOOL_ROT, WRIST, GRASP1, GRASP2, YAW, GRASP,
+                                                      GOLD_ARM_ID)
+
+# order of the Jacobian columns, same as RavenPlanner.rosJointTypes
+JACOBIAN_JOINT_TYPES = [SHOULDER, ELBOW, Z_INS, TOOL_ROT, WRIST, YAW]
+
+JACOBIAN_MIN_LIMITS = np.array([kin.SHOULDER_MIN_LIMIT, kin.ELBOW_MIN_LIMIT, kin.Z_INS_MIN_LIMIT,
+                                kin.TOOL_ROLL_MIN_LIMIT, kin.TOOL_WRIST_MIN_LIMIT, -kin.TOOL_GRASP_LIMIT])
+JACOBIAN_MAX_LIMITS = np.array([kin.SHOULDER_MAX_LIMIT, kin.ELBOW_MAX_LIMIT, kin.Z_INS_MAX_LIMIT,
+                                kin.TOOL_ROLL_MAX_LIMIT, kin.TOOL_WRIST_MAX_LIMIT, kin.TOOL_GRASP_LIMIT])
+
+# d(ik joint)/d(actual joint) for each Jacobian column, from the *_TO_IK functions
+_IK_SIGNS = {kin.GOLD_ARM_ID  : np.array([ 1., 1.,-1.,-1.,-1.,-1.]),
+             kin.GREEN_ARM_ID : np.array([-1.,-1.,-1., 1., 1.,-1.])}
+
+def jointsToVector(armId, joints):
+    """
+    Joint dict to the 6-vector in JACOBIAN_JOINT_TYPES order and the grasp
+    """
+    g1, g2 = joints[GRASP1], joints[GRASP2]
+    if armId == GOLD_ARM_ID:
+        yaw = (g2 - g1)/2.
+    else:
+        yaw = (g1 - g2)/2.
+    grasp = kin.ACTUAL_GRASP_FROM_MECH_GRASP(armId, kin.MECH_GRASP_FROM_MECH_FINGERS(armId, g1, g2))
+    q = np.array([joints[SHOULDER], joints[ELBOW], joints[Z_INS], joints[TOOL_ROT], joints[WRIST], yaw], dtype=float)
+    return q, grasp
+
+def vectorToJoints(armId, q, grasp):
+    """
+    Inverse of jointsToVector, returns a joint dict like invArmKin
+    """
+    ths, the, d, thr, thp, yaw = [float(v) for v in q]
+    # the ik yaw angle is -yaw for both arms
+    return {SHOULDER : ths,
+            ELBOW : the,
+            Z_INS : d,
+            TOOL_ROT : thr,
+            WRIST : thp,
+            GRASP1 : kin.FINGER1_FROM_IK(armId, -yaw, grasp),
+            GRASP2 : kin.FINGER2_FROM_IK(armId, -yaw, grasp),
+            YAW : yaw,
+            GRASP : grasp}
+
+_BASE = dict((armId, kin._tf_array(kin.actual_world_to_ik_world(armId) * kin.Tw2b)) for armId in _IK_SIGNS)
+_XU = kin._tf_array(kin.Xu)
+_XF = kin._tf_array(kin.Xf)
+_XIP = kin._tf_array(kin.Xip)
+_XPY = kin._tf_array(kin.Xpy)
+_TG = kin._tf_array(kin.Tg)
+
+def _Z(theta, d=0.):
+    return kin._Z_batch(np.array([theta]), d)[0]
+
+def linkFrames(armId, q):
+    """
+    World ('/0_link') frames of the six joints (4x4 each, the joint acts
+    about/along its z axis) and the tool frame, for the 6-vector q
+    """
+    ths, the, d, thr, thp, yaw = q
+
+    F0 = _BASE[armId]
+    F1 = F0.dot(_Z(kin.THS_TO_IK(armId,ths))).dot(_XU)
+    F2 = F1.dot(_Z(kin.THE_TO_IK(armId,the))).dot(_XF)
+    F3 = F2.dot(_Z(kin.THR_TO_IK(armId,thr)))
+    F4 = F3.dot(_Z(0., kin.D_TO_IK(armId,d))).dot(_XIP)
+    F5 = F4.dot(_Z(kin.THP_TO_IK(armId,thp))).dot(_XPY)
+    # the ik yaw angle is -yaw for both arms
+    tool = F5.dot(_Z(-yaw)).dot(_TG)
+    tool[:3,:3] *= kin._TOOL_POSE_AXES_SIGNS
+
+    return [F0, F1, F2, F3, F4, F5], tool
+
+def armJacobian(armId, q):
+    """
+    6x6 Jacobian of the tool twist (linear velocity of the tool point and
+    angular velocity, both in '/0_link') w.r.t. the actual joints in
+    JACOBIAN_JOINT_TYPES order. Also returns the tool frame
+    """
+    frames, tool = linkFrames(armId, q)
+    p = tool[:3,3]
+
+    J = np.zeros((6,6))
+    for i, F in enumerate(frames):
+        z = F[:3,2]
+        if JACOBIAN_JOINT_TYPES[i] == Z_INS:
+            J[:3,i] = z
+        else:
+            J[:3,i] = np.cross(z, p - F[:3,3])
+            J[3:,i] = z
+    J *= _IK_SIGNS[armId]
+
+    return J, tool
+
+def rotationToAxisAngle(R):
+    """
+    Rotation vector (axis * angle) of a 3x3 rotation matrix
+    """
+    cosAngle = np.clip((np.trace(R) - 1.)/2., -1., 1.)
+    angle = np.arccos(cosAngle)
+    if angle < 1e-9:
+        return .5 * np.array([R[2,1] - R[1,2], R[0,2] - R[2,0], R[1,0] - R[0,1]])
+    if np.pi - angle < 1e-6:
+        # axis from the symmetric part near pi
+        k = np.argmax(np.diag(R))
+        axis = (R[:,k] + np.eye(3)[:,k]) / np.sqrt(2. * (1. + R[k,k]))
+        return angle * axis
+    axis = np.array([R[2,1] - R[1,2], R[0,2] - R[2,0], R[1,0] - R[0,1]]) / (2. * np.sin(angle))
+    return angle * axis
+
+def axisAngleToRotation(v):
+    """
+    3x3 rotation matrix of a rotation vector
+    """
+    angle = np.linalg.norm(v)
+    if angle < 1e-12:
+        return np.eye(3)
+    k = v / angle
+    K = np.array([[0,-k[2],k[1]],[k[2],0,-k[0]],[-k[1],k[0],0]])
+    return np.eye(3) + np.sin(angle)*K + (1 - np.cos(angle))*K.dot(K)
+
+def poseError(current, target):
+    """
+    6-vector twist taking the 4x4 current pose to the target pose,
+    position difference and rotation vector, both in the world frame
+    """
+    return np.concatenate((target[:3,3] - current[:3,3],
+                           rotationToAxisAngle(target[:3,:3].dot(current[:3,:3].T))))
+
+def interpolatePoses(start, end, n_steps):
+    """
+    n_steps 4x4 poses from start to end (inclusive), linear in position
+    and slerp (constant angular rate about a fixed axis) in rotation
+    """
+    start, end = np.asarray(start, dtype=float), np.asarray(end, dtype=float)
+    rotvec = rotationToAxisAngle(end[:3,:3].dot(start[:3,:3].T))
+    poses = np.tile(np.eye(4), (n_steps,1,1))
+    for i, s in enumerate(np.linspace(0., 1., n_steps)):
+        poses[i,:3,3] = (1 - s)*start[:3,3] + s*end[:3,3]
+        poses[i,:3,:3] = axisAngleToRotation(s*rotvec).dot(start[:3,:3])
+    return poses
+
+def dlsStep(J, error, damping):
+    """
+    Damped least squares joint step J^T (J J^T + damping^2 I)^-1 error
+    """
+    return J.T.dot(np.linalg.solve(J.dot(J.T) + damping**2 * np.eye(J.shape[0]), error))
+
+def resolvedRateTrajectory(armId, startJoints, endPose, n_steps=10, endGrasp=None, damping=.01,
+                           maxIterations=20, posTolerance=1e-5, rotTolerance=1e-4):
+    """
+    Joint trajectory from startJoints (joint dict) to the 4x4 endPose in '/0_link'
+    by tracking the interpolated tool pose with damped-least-squares steps.
+
+    Returns (jointTraj, poseTraj), a list of n_steps joint dicts and the
+    corresponding list of 4x4 tool poses, or None if a waypoint can not be
+    reached within the joint limits
+    """
+    q, startGrasp = jointsToVector(armId, startJoints)
+    if endGrasp is None:
+        endGrasp = startGrasp
+    n_steps = max(int(n_steps), 2)
+
+    J, startPose = armJacobian(armId, q)
+    targets = interpolatePoses(startPose, endPose, n_steps)
+    grasps = np.linspace(startGrasp, endGrasp, n_steps)
+
+    jointTraj = [vectorToJoints(armId, q, startGrasp)]
+    poseTraj = [startPose]
+    for target, grasp in zip(targets[1:], grasps[1:]):
+        for _ in xrange(maxIterations):
+            J, tool = armJacobian(armId, q)
+            error = poseError(tool, target)
+            if np.linalg.norm(error[:3]) < posTolerance and np.linalg.norm(error[3:]) < rotTolerance:
+                break
+            q = np.clip(q + dlsStep(J, error, damping), JACOBIAN_MIN_LIMITS, JACOBIAN_MAX_LIMITS)
+        else:
+            return None
+
+        joints = vectorToJoints(armId, q, grasp)
+        if not (kin.TOOL_GRASP1_MIN_LIMIT <= joints[GRASP1] <= kin.TOOL_GRASP1_MAX_LIMIT and
+                kin.TOOL_GRASP2_MIN_LIMIT <= joints[GRASP2] <= kin.TOOL_GRASP2_MAX_LIMIT):
+            return None
+        jointTraj.append(joints)
+        poseTraj.append(tool)
+
+    return jointTraj, poseTraj
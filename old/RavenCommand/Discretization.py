@@ -0,0 +1,88 @@
+"""
+Number of trajopt waypoints from the size of a move instead of a fixed
+steps per meter, and resampling of the solution to the density the
+controller is sent
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import numpy as np
+
+from raven_2_msgs.msg import Constants
+
+from RavenDebridement.RavenCommand import DifferentialKinematics
+from RavenDebridement.RavenCommand.TrajectoryLibrary import warpTrajectory
+
+# largest change per waypoint of each planner joint, insertion in meters
+MAX_JOINT_STEP = {Constants.JOINT_TYPE_SHOULDER : .05,
+                  Constants.JOINT_TYPE_ELBOW : .05,
+                  Constants.JOINT_TYPE_INSERTION : .004,
+                  Constants.JOINT_TYPE_ROTATION : .1,
+                  Constants.JOINT_TYPE_PITCH : .1,
+                  Constants.JOINT_TYPE_YAW : .1}
+# largest tool rotation per waypoint (radians)
+MAX_ROTATION_STEP = .1
+# moves starting or ending closer than this (meters) to a workspace
+# body get NEAR_FACTOR times the waypoints
+NEAR_DISTANCE = .02
+NEAR_FACTOR = 2.
+
+MIN_STEPS = 5
+MAX_STEPS = 60
+
+def rotationAngle(startPose, endPose):
+    """
+    Angle of the rotation between two 4x4 poses
+    """
+    startPose, endPose = np.asarray(startPose, dtype=float), np.asarray(endPose, dtype=float)
+    return float(np.linalg.norm(DifferentialKinematics.rotationToAxisAngle(endPose[:3,:3].dot(startPose[:3,:3].T))))
+
+def aabbDistance(point, center, extents):
+    """
+    Distance from point to the axis aligned box, 0 inside it
+    """
+    outside = np.maximum(np.abs(np.asarray(point, dtype=float) - center) - extents, 0.)
+    return float(np.linalg.norm(outside))
+
+def workspaceClearance(env, robot, points):
+    """
+    Smallest distance from the points to the bounding box of a body in env
+    other than robot, inf if there are none
+    """
+    clearance = np.inf
+    for body in env.GetBodies():
+        if body == robot:
+            continue
+        aabb = body.ComputeAABB()
+        for point in points:
+            clearance = min(clearance, aabbDistance(point, aabb.pos(), aabb.extents()))
+    return clearance
+
+def adaptiveSteps(startJoints, endJoints, maxJointStep, rotation=0., clearance=np.inf,
+                  maxRotationStep=MAX_ROTATION_STEP, minSteps=MIN_STEPS, maxSteps=MAX_STEPS):
+    """
+    Waypoints (including both ends) so no joint of the straight line from
+    startJoints to endJoints (arrays of the planner joints of one or more
+    arms, maxJointStep the step of each of them from MAX_JOINT_STEP) and
+    no tool rotation moves more than a step between waypoints, more near
+    obstacles
+    """
+    startJoints = np.asarray(startJoints, dtype=float)
+    endJoints = np.asarray(endJoints, dtype=float)
+    maxJointStep = np.asarray(maxJointStep, dtype=float)
+
+    segments = max(np.max(np.abs(endJoints - startJoints) / maxJointStep), rotation / maxRotationStep)
+    if clearance < NEAR_DISTANCE:
+        segments *= NEAR_FACTOR
+    return int(np.clip(np.ceil(segments) + 1, minSteps, maxSteps))
+
+def resample(traj, n_steps):
+    """
+    (n_steps, dofs) trajectory through the waypoints of traj, linear in
+    normalized time
+    """
+    traj = np.asarray(traj, dtype=float)
+    if len(traj) == n_steps:
+        return traj
+    return warpTrajectory(traj, n_steps)
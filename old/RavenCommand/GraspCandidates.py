@@ -0,0 +1,128 @@
+"""
+Batched search over grasp orientations and approach directions for a
+foam piece, in place of the single fixed grasp orientation
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import math
+
+import numpy as np
+import tfx
+
+import RavenDebridement.RavenCommand.kinematics as kin
+from RavenDebridement.RavenCommand.ReachabilityMap import jointLimitMargin
+
+# the fixed grasp orientation the foam allocator used, straight down
+BASE_YAW, BASE_PITCH = -90., 90.
+
+# perturbations of the base orientation in degrees, tried as a grid
+YAW_OFFSETS = [0., -15., 15., -30., 30.]
+PITCH_OFFSETS = [0., -10., 10., -20.]
+
+# directions the gripper may come down from, as passed to the planner
+APPROACH_DIRS = [(0,.1,.9), (0,0,1), (.1,0,.9), (-.1,0,.9), (0,-.1,.9)]
+
+# same as the planner's approach waypoint and the lift after grasping
+APPROACH_DIST = .03
+LIFT_HEIGHT = .06
+
+GRASP = math.pi/4.
+
+# score is MARGIN_WEIGHT * margin - DISTANCE_WEIGHT * joint distance
+MARGIN_WEIGHT = 1.
+DISTANCE_WEIGHT = .1
+
+class GraspCandidate(object):
+    """
+    A feasible grasp: tool position and rotation (3x3), the approach
+    direction, the ik joints of the grasp pose in JOINT_TYPES order, the
+    smallest joint limit margin over the grasp, lift and approach poses,
+    the weighted joint distance from the seed and the combined score
+    """
+    def __init__(self, position, rotation, approachDir, joints, margin, distance, score):
+        self.position = position
+        self.rotation = rotation
+        self.approachDir = approachDir
+        self.joints = joints
+        self.margin = margin
+        self.distance = distance
+        self.score = score
+
+    def pose(self, frame=None):
+        return tfx.pose(self.position.tolist(), tfx.rotation(self.rotation), frame=frame)
+
+    def __repr__(self):
+        return 'GraspCandidate(approachDir=%s, margin=%f, distance=%f, score=%f)' % (self.approachDir.tolist(), self.margin, self.distance, self.score)
+
+def candidateRotations(yawOffsets=YAW_OFFSETS, pitchOffsets=PITCH_OFFSETS):
+    """
+    (K,3,3) rotations of the yaw x pitch grid around the base orientation
+    """
+    return np.array([np.array(tfx.tb_angles(BASE_YAW + yaw, BASE_PITCH + pitch, 0).matrix, dtype=float)
+                     for pitch in pitchOffsets for yaw in yawOffsets])
+
+def _poses(rotations, positions):
+    """
+    (N,4,4) poses from (N,3,3) rotations and (N,3) positions
+    """
+    poses = np.zeros((len(rotations),4,4))
+    poses[:,:3,:3] = rotations
+    poses[:,:3,3] = positions
+    poses[:,3,3] = 1.
+    return poses
+
+def graspCandidates(armId, center, seedJoints=None, grasp=GRASP, rotations=None, approachDirs=APPROACH_DIRS,
+                    approachDist=APPROACH_DIST, liftHeight=LIFT_HEIGHT, marginWeight=MARGIN_WEIGHT, distanceWeight=DISTANCE_WEIGHT):
+    """
+    Generates the feasible grasps of the foam piece at center, best score
+    first. A grasp is feasible when the grasp pose, the lift pose above it
+    and the approach waypoint all have ik solutions. All of them are
+    solved in a single invArmKinBatch call.
+
+    seedJoints is a joint dict (or JointState) of the arm, without it the
+    candidates are ranked by joint limit margin only
+    """
+    if rotations is None:
+        rotations = candidateRotations()
+    position = np.array(tfx.point(center).list, dtype=float)
+    dirs = np.array(approachDirs, dtype=float)
+    dirs /= np.linalg.norm(dirs, axis=1)[:,None]
+    K, A = len(rotations), len(dirs)
+
+    graspPoses = _poses(rotations, np.tile(position, (K,1)))
+    liftPoses = _poses(rotations, np.tile(position + [0,0,liftHeight], (K,1)))
+    approachPoses = _poses(np.repeat(rotations, A, axis=0), np.tile(position + approachDist*dirs, (K,1)))
+
+    joints, valid, _, _ = kin.invArmKinBatch(armId, np.concatenate((graspPoses, liftPoses, approachPoses)), grasp)
+    margin = jointLimitMargin(joints)
+
+    feasible = valid[:K,None] & valid[K:2*K,None] & valid[2*K:].reshape(K,A)
+    margins = np.minimum(np.minimum(margin[:K], margin[K:2*K])[:,None], margin[2*K:].reshape(K,A))
+
+    graspJoints = joints[:K]
+    distance = np.zeros(K)
+    if seedJoints is not None:
+        delta = graspJoints - kin.jointDictsToArray([seedJoints])
+        # tool roll solutions are 2pi apart, the planner picks the closer one
+        delta[:,3] = np.arctan2(np.sin(delta[:,3]), np.cos(delta[:,3]))
+        with np.errstate(invalid='ignore'):
+            distance = np.linalg.norm(delta * kin.JOINT_WEIGHTS, axis=1)
+
+    score = marginWeight * margins - distanceWeight * distance[:,None]
+    score[~feasible] = -np.inf
+
+    for index in np.argsort(-score, axis=None):
+        k, a = np.unravel_index(index, score.shape)
+        if not feasible[k,a]:
+            break
+        yield GraspCandidate(position, rotations[k], dirs[a], graspJoints[k], float(margins[k,a]), float(distance[k]), float(score[k,a]))
+
+def bestGrasp(armId, center, seedJoints=None, **kwargs):
+    """
+    The best scoring feasible grasp of graspCandidates, or None
+    """
+    for candidate in graspCandidates(armId, center, seedJoints, **kwargs):
+        return candidate
+    return None
@@ -0,0 +1,126 @@
+"""
+LRU memo cache in front of the inverse kinematics
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import copy
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import tfx
+
+import RavenDebridement.RavenCommand.kinematics as kin
+
+def _quaternion(R):
+    """
+    Unit quaternion (x,y,z,w) of a 3x3 rotation matrix, with w >= 0
+    """
+    trace = R[0,0] + R[1,1] + R[2,2]
+    if trace > 0:
+        s = 2. * np.sqrt(trace + 1.)
+        q = np.array([(R[2,1] - R[1,2]) / s, (R[0,2] - R[2,0]) / s, (R[1,0] - R[0,1]) / s, .25 * s])
+    elif R[0,0] > R[1,1] and R[0,0] > R[2,2]:
+        s = 2. * np.sqrt(1. + R[0,0] - R[1,1] - R[2,2])
+        q = np.array([.25 * s, (R[0,1] + R[1,0]) / s, (R[0,2] + R[2,0]) / s, (R[2,1] - R[1,2]) / s])
+    elif R[1,1] > R[2,2]:
+        s = 2. * np.sqrt(1. + R[1,1] - R[0,0] - R[2,2])
+        q = np.array([(R[0,1] + R[1,0]) / s, .25 * s, (R[1,2] + R[2,1]) / s, (R[0,2] - R[2,0]) / s])
+    else:
+        s = 2. * np.sqrt(1. + R[2,2] - R[0,0] - R[1,1])
+        q = np.array([(R[0,2] + R[2,0]) / s, (R[1,2] + R[2,1]) / s, .25 * s, (R[1,0] - R[0,1]) / s])
+    q /= np.linalg.norm(q)
+    # q and -q are the same rotation
+    if q[3] < 0:
+        q = -q
+    return q
+
+class IKCache(object):
+    """
+    Caches IK solutions keyed by arm, quantized pose and quantized grasp
+
+    posResolution is in meters, rotResolution in radians and
+    graspResolution in radians. A cached solution was solved for a pose
+    within one quantization cell of the query, so it agrees with an
+    uncached solve to within those tolerances. Failed solves are cached
+    too unless cacheFailures is False
+    """
+    def __init__(self, solver=kin.invArmKin, maxSize=2048, posResolution=.0002, rotResolution=.002,
+                 graspResolution=.005, cacheFailures=True):
+        self.solver = solver
+        self.maxSize = maxSize
+        self.posResolution = posResolution
+        self.rotResolution = rotResolution
+        self.graspResolution = graspResolution
+        self.cacheFailures = cacheFailures
+
+        self.cache = OrderedDict()
+        self.lock = threading.RLock()
+
+        self.clearStats()
+
+    def key(self, armName, pose, grasp):
+        m = np.asarray(tfx.pose(pose).matrix, dtype=float)
+        pos = np.floor(m[:3,3] / self.posResolution).astype(int)
+        # a rotation of a radians moves the quaternion components by about a/2
+        quat = np.floor(_quaternion(m[:3,:3]) / (.5 * self.rotResolution)).astype(int)
+        return (armName, tuple(pos.tolist()), tuple(quat.tolist()), int(np.floor(grasp / self.graspResolution)))
+
+    def invArmKin(self, armName, pose, grasp):
+        """
+        Same interface as the solver (kinematics.invArmKin by default).
+        Returns a copy of the cached solution, or None if the pose is not
+        reachable (the solver returned None or no solutions)
+        """
+        key = self.key(armName, pose, grasp)
+
+        with self.lock:
+            if key in self.cache:
+                joints = self.cache.pop(key)
+                self.cache[key] = joints
+                self.hits += 1
+                if joints is None:
+                    self.failureHits += 1
+                    return None
+                return copy.deepcopy(joints)
+            self.misses += 1
+
+        joints = self.solver(armName, pose, grasp)
+        if not joints:
+            joints = None
+
+        if joints is not None or self.cacheFailures:
+            with self.lock:
+                self.cache[key] = copy.deepcopy(joints)
+                while len(self.cache) > self.maxSize:
+                    self.cache.popitem(last=False)
+                    self.evictions += 1
+
+        return joints
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def clearStats(self):
+        self.hits = 0
+        self.failureHits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def hitRate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total > 0 else 0.
+
+    def stats(self):
+        return {'size' : len(self.cache),
+                'hits' : self.hits,
+                'failureHits' : self.failureHits,
+                'misses' : self.misses,
+                'evictions' : self.evictions,
+                'hitRate' : self.hitRate()}
+
+    def __len__(self):
+        return len(self.cache)
@@ -0,0 +1,180 @@
+"""
+Array-backed joint configurations of one arm, in place of
+{jointType : jointPos} dicts
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import numpy as np
+
+import RavenDebridement.RavenCommand.kinematics as kin
+from RavenDebridement.RavenCommand.kinematics import JOINT_TYPES, GRASP1, GRASP2, YAW, GRASP, GOLD_ARM_ID
+
+# column of each joint type in JointState.positions and JointTrajectory.joints
+JOINT_INDEX = dict((jointType, index) for index, jointType in enumerate(JOINT_TYPES))
+
+# joint types a JointState answers for, YAW is derived from the fingers
+STATE_JOINT_TYPES = JOINT_TYPES + [YAW, GRASP]
+
+def _yaw(armName, g1, g2):
+    if armName == GOLD_ARM_ID:
+        return (g2 - g1)/2.
+    else:
+        return (g1 - g2)/2.
+
+def _grasp(armName, g1, g2):
+    return kin.ACTUAL_GRASP_FROM_MECH_GRASP(armName, kin.MECH_GRASP_FROM_MECH_FINGERS(armName, g1, g2))
+
+class JointState(object):
+    """
+    Joint positions of one arm as a float64 array in JOINT_TYPES order.
+
+    Reads like the joint dicts (state[jointType], keys(), items(), get())
+    with YAW and GRASP included, so it can be passed where a joint dict is
+    read. Use toDict() where a mutable dict is needed
+    """
+    __slots__ = ('armName', 'positions', 'grasp')
+
+    def __init__(self, armName, positions, grasp=None):
+        self.armName = armName
+        self.positions = np.array(positions, dtype=float).reshape(len(JOINT_TYPES))
+        if grasp is None:
+            grasp = _grasp(armName, self.positions[JOINT_INDEX[GRASP1]], self.positions[JOINT_INDEX[GRASP2]])
+        self.grasp = float(grasp)
+
+    @classmethod
+    def fromDict(cls, armName, joints):
+        return cls(armName, [joints[jointType] for jointType in JOINT_TYPES], joints.get(GRASP))
+
+    @classmethod
+    def fromMsg(cls, armName, jointMsgs):
+        """
+        From the raven_2_msgs JointState list of an ArmState
+        """
+        positions = np.zeros(len(JOINT_TYPES))
+        grasp = None
+        for joint in jointMsgs:
+            index = JOINT_INDEX.get(joint.type)
+            if index is not None:
+                positions[index] = joint.position
+            elif joint.type == GRASP:
+                grasp = joint.position
+        return cls(armName, positions, grasp)
+
+    def toDict(self):
+        """
+        Joint dict like invArmKin returns
+        """
+        return dict(self.items())
+
+    @property
+    def yaw(self):
+        return _yaw(self.armName, self.positions[JOINT_INDEX[GRASP1]], self.positions[JOINT_INDEX[GRASP2]])
+
+    def __getitem__(self, jointType):
+        index = JOINT_INDEX.get(jointType)
+        if index is not None:
+            return float(self.positions[index])
+        if jointType == YAW:
+            return self.yaw
+        if jointType == GRASP:
+            return self.grasp
+        raise KeyError(jointType)
+
+    def get(self, jointType, default=None):
+        try:
+            return self[jointType]
+        except KeyError:
+            return default
+
+    def __contains__(self, jointType):
+        return jointType in JOINT_INDEX or jointType == YAW or jointType == GRASP
+
+    has_key = __contains__
+
+    def keys(self):
+        return list(STATE_JOINT_TYPES)
+
+    def items(self):
+        return zip(JOINT_TYPES, self.positions.tolist()) + [(YAW, self.yaw), (GRASP, self.grasp)]
+
+    def __iter__(self):
+        return iter(STATE_JOINT_TYPES)
+
+    def __len__(self):
+        return len(STATE_JOINT_TYPES)
+
+    def __repr__(self):
+        return 'JointState(%r, %s, grasp=%f)' % (self.armName, self.positions.tolist(), self.grasp)
+
+class JointTrajectory(object):
+    """
+    Joint trajectory of one arm: joints is an (N,7) float64 array in
+    JOINT_TYPES order and grasps an (N,) array. Indexing gives a
+    JointState (or a JointTrajectory for slices)
+    """
+    __slots__ = ('armName', 'joints', 'grasps')
+
+    def __init__(self, armName, joints, grasps=None):
+        self.armName = armName
+        self.joints = np.array(joints, dtype=float).reshape(-1,len(JOINT_TYPES))
+        if grasps is None:
+            grasps = _grasp(armName, self.joints[:,JOINT_INDEX[GRASP1]], self.joints[:,JOINT_INDEX[GRASP2]])
+        self.grasps = np.asarray(grasps, dtype=float) * np.ones(len(self.joints))
+
+    @classmethod
+    def fromDicts(cls, armName, jointDicts):
+        if len(jointDicts) > 0 and all(GRASP in joints for joints in jointDicts):
+            grasps = [joints[GRASP] for joints in jointDicts]
+        else:
+            grasps = None
+        return cls(armName, kin.jointDictsToArray(jointDicts), grasps)
+
+    @classmethod
+    def fromStates(cls, armName, states):
+        return cls(armName, [state.positions for state in states], [state.grasp for state in states])
+
+    @classmethod
+    def fromYawArray(cls, armName, yawJoints, grasps):
+        """
+        From an (N,6) array of shoulder, elbow, insertion, rotation, pitch
+        and yaw (the planner joints), splitting the yaw into the fingers
+        """
+        yawJoints = np.asarray(yawJoints, dtype=float).reshape(-1,6)
+        grasps = np.asarray(grasps, dtype=float) * np.ones(len(yawJoints))
+        yaw = yawJoints[:,5]
+        joints = np.empty((len(yawJoints),len(JOINT_TYPES)))
+        joints[:,:5] = yawJoints[:,:5]
+        if armName == GOLD_ARM_ID:
+            joints[:,5] = -yaw + grasps/2
+            joints[:,6] = yaw + grasps/2
+        else:
+            joints[:,5] = yaw - grasps/2
+            joints[:,6] = -yaw - grasps/2
+        return cls(armName, joints, grasps)
+
+    def toDicts(self):
+        return [self[i].toDict() for i in xrange(len(self))]
+
+    def column(self, jointType):
+        if jointType == YAW:
+            return _yaw(self.armName, self.joints[:,JOINT_INDEX[GRASP1]], self.joints[:,JOINT_INDEX[GRASP2]])
+        if jointType == GRASP:
+            return self.grasps
+        return self.joints[:,JOINT_INDEX[jointType]]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return JointTrajectory(self.armName, self.joints[index], self.grasps[index])
+        return JointState(self.armName, self.joints[index], self.grasps[index])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self.joints)
+
+    def __repr__(self):
+        return 'JointTrajectory(%r, %d waypoints)' % (self.armName, len(self))
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""
+Batch inverse and forward kinematics services built on kinematics.py,
+one call for a whole grid or trajectory of poses instead of one
+inv_kin_server round trip per pose
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+import rospy
+
+import threading
+import time
+
+import numpy as np
+import tfx
+
+from raven_2_msgs.msg import Constants
+
+from RavenDebridement.srv import InvKinBatchSrv, InvKinBatchSrvResponse, FwdKinBatchSrv, FwdKinBatchSrvResponse
+import RavenDebridement.RavenCommand.kinematics as kin
+from RavenDebridement.RavenCommand.kinematics import JOINT_TYPES
+from RavenDebridement.RavenCommand.Trajectory import posesToMsgs
+
+INV_KIN_SERVICE = 'inv_kin_batch'
+FWD_KIN_SERVICE = 'fwd_kin_batch'
+
+ARM_IDS = {Constants.ARM_TYPE_GOLD : kin.GOLD_ARM_ID,
+           Constants.ARM_TYPE_GREEN : kin.GREEN_ARM_ID}
+
+LINK0 = '/0_link'
+
+def posesFromMsgs(poses):
+    """
+    (N,4,4) array from a list of geometry_msgs/Pose, without building tfx poses
+    """
+    n = len(poses)
+    positions = np.array([(p.position.x, p.position.y, p.position.z) for p in poses], dtype=float).reshape(n,3)
+    q = np.array([(p.orientation.x, p.orientation.y, p.orientation.z, p.orientation.w) for p in poses], dtype=float).reshape(n,4)
+    q /= np.maximum(np.linalg.norm(q, axis=1), 1e-12)[:,None]
+    x, y, z, w = q.T
+
+    T = np.zeros((n,4,4))
+    T[:,0,0] = 1 - 2*(y*y + z*z)
+    T[:,0,1] = 2*(x*y - z*w)
+    T[:,0,2] = 2*(x*z + y*w)
+    T[:,1,0] = 2*(x*y + z*w)
+    T[:,1,1] = 1 - 2*(x*x + z*z)
+    T[:,1,2] = 2*(y*z - x*w)
+    T[:,2,0] = 2*(x*z - y*w)
+    T[:,2,1] = 2*(y*z + x*w)
+    T[:,2,2] = 1 - 2*(x*x + y*y)
+    T[:,:3,3] = positions
+    T[:,3,3] = 1
+    return T
+
+def _frameId(frame):
+    if not frame:
+        return LINK0
+    return frame if frame.startswith('/') else '/' + frame
+
+class KinematicsServer(object):
+    """
+    Advertises INV_KIN_SERVICE and FWD_KIN_SERVICE and keeps timing
+    statistics of the requests
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {INV_KIN_SERVICE : [0, 0, 0.], FWD_KIN_SERVICE : [0, 0, 0.]}
+
+        self.invKinService = rospy.Service(INV_KIN_SERVICE, InvKinBatchSrv, self.invKin)
+        self.fwdKinService = rospy.Service(FWD_KIN_SERVICE, FwdKinBatchSrv, self.fwdKin)
+        rospy.loginfo('Batch kinematics server is ready')
+
+    def _record(self, service, n, solveTime):
+        with self.lock:
+            stats = self.stats[service]
+            stats[0] += 1
+            stats[1] += n
+            stats[2] += solveTime
+        rospy.loginfo('%s: %d poses in %.2f ms (%.1f us per pose)' % (service, n, solveTime*1000, solveTime*1e6/max(n,1)))
+
+    def getStats(self):
+        """
+        {service : (requests, poses, total solve time)}
+        """
+        with self.lock:
+            return dict((service, tuple(stats)) for service, stats in self.stats.iteritems())
+
+    def invKin(self, req):
+        armId = ARM_IDS[req.arm_type]
+        n = len(req.poses)
+        grasps = np.array(req.grasps, dtype=float)
+        if len(grasps) == 1:
+            grasps = grasps[0]
+        elif len(grasps) != n:
+            raise rospy.ServiceException('%d grasps given for %d poses' % (len(grasps), n))
+
+        poses = posesFromMsgs(req.poses)
+        frame = _frameId(req.header.frame_id)
+        if frame != LINK0:
+            poses = np.matmul(np.array(tfx.lookupTransform(LINK0, frame, wait=5).matrix, dtype=float), poses)
+
+        start = time.time()
+        joints, valid, _, _ = kin.invArmKinBatch(armId, poses, grasps)
+        solveTime = time.time() - start
+        self._record(INV_KIN_SERVICE, n, solveTime)
+
+        return InvKinBatchSrvResponse(joint_types=JOINT_TYPES, joints=joints.ravel().tolist(),
+                                      valid=valid.tolist(), solve_time=solveTime)
+
+    def fwdKin(self, req):
+        armId = ARM_IDS[req.arm_type]
+        jointTypes = list(req.joint_types) or JOINT_TYPES
+        missing = [jointType for jointType in JOINT_TYPES if jointType not in jointTypes]
+        if missing:
+            raise rospy.ServiceException('joint types %s missing' % missing)
+        joints = np.array(req.joints, dtype=float).reshape(-1,len(jointTypes))
+        joints = joints[:,[jointTypes.index(jointType) for jointType in JOINT_TYPES]]
+
+        start = time.time()
+        poses, grasps = kin.fwdArmKinBatch(armId, joints)
+        solveTime = time.time() - start
+        self._record(FWD_KIN_SERVICE, len(joints), solveTime)
+
+        resp = FwdKinBatchSrvResponse(poses=posesToMsgs(poses), grasps=np.asarray(grasps).tolist(), solve_time=solveTime)
+        resp.header.frame_id = LINK0
+        resp.header.stamp = rospy.Time.now()
+        return resp
+
+def main():
+    rospy.init_node('kinematics_server')
+    server = KinematicsServer()
+    rospy.spin()
+    for service, (requests, poses, solveTime) in server.getStats().iteritems():
+        print '%s: %d requests, %d poses, %.3f s solving' % (service, requests, poses, solveTime)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+Numerical fallback for poses the closed-form invArmKin rejects because
+the solution is just outside the joint limits
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import threading
+
+import numpy as np
+import tfx
+
+import RavenDebridement.RavenCommand.kinematics as kin
+from RavenDebridement.RavenCommand.kinematics import GRASP1, GRASP2
+from RavenDebridement.RavenCommand import DifferentialKinematics
+from RavenDebridement.RavenCommand.DifferentialKinematics import JACOBIAN_MIN_LIMITS, JACOBIAN_MAX_LIMITS
+
+# how far outside the limits the analytic solution may be, same as maxValidDist in invArmKin
+MAX_LIMIT_DIST = 3 * kin.DEG2RAD
+
+# weights of the distance outside the limits in JACOBIAN_JOINT_TYPES order (insertion is in meters)
+LIMIT_DIST_WEIGHTS = np.array([1., 1., 10., 1., 1., 1.])
+
+class FallbackStats(object):
+    """
+    Counts of how invArmKinWithFallback solved each pose
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.analytic = 0
+        self.approximate = 0
+        self.failures = 0
+
+    def record(self, approximate, joints):
+        with self.lock:
+            if joints is None:
+                self.failures += 1
+            elif approximate:
+                self.approximate += 1
+            else:
+                self.analytic += 1
+
+    def calls(self):
+        return self.analytic + self.approximate + self.failures
+
+    def fallbackRate(self):
+        """
+        Fraction of calls that needed the numerical fallback
+        """
+        calls = self.calls()
+        return float(self.approximate + self.failures) / calls if calls > 0 else 0.
+
+    def stats(self):
+        return {'calls' : self.calls(),
+                'analytic' : self.analytic,
+                'approximate' : self.approximate,
+                'failures' : self.failures,
+                'fallbackRate' : self.fallbackRate()}
+
+STATS = FallbackStats()
+
+def _nearestAnalyticSolution(armId, pose, grasp):
+    """
+    6-vector of the elbow branch closest to the joint limits and its
+    weighted distance outside of them, or (None, inf)
+    """
+    joints, valid, codes, limit_dist = kin._invArmKinBranches(armId, pose[None], grasp)
+    best, bestDist = None, np.inf
+    for branch in xrange(joints.shape[1]):
+        if np.isnan(joints[0,branch]).any():
+            continue
+        q, _ = DifferentialKinematics.jointsToVector(armId, kin.jointArrayToDicts(joints[0,branch:branch+1])[0])
+        dist = np.linalg.norm((q - np.clip(q, JACOBIAN_MIN_LIMITS, JACOBIAN_MAX_LIMITS)) * LIMIT_DIST_WEIGHTS)
+        if dist < bestDist:
+            best, bestDist = q, dist
+    return best, bestDist
+
+def invArmKinApproximate(armId, pose, grasp, maxLimitDist=MAX_LIMIT_DIST, damping=.01, maxIterations=50,
+                         posTolerance=1e-5, rotTolerance=1e-4, maxPosResidual=.005, maxRotResidual=3*kin.DEG2RAD):
+    """
+    Projects the nearest analytic solution onto the joint limits and refines
+    it with damped Gauss-Newton (Levenberg-Marquardt) steps that stay
+    within the limits.
+
+    Returns (joints, residual), a joint dict like invArmKin and the
+    (position, rotation) error of its tool pose, or (None, None) if the
+    analytic solution is further than maxLimitDist outside the limits or
+    the residual is above maxPosResidual/maxRotResidual
+    """
+    target = np.array(tfx.pose(pose).matrix, dtype=float)
+
+    q, limitDist = _nearestAnalyticSolution(armId, target, grasp)
+    if q is None or limitDist > maxLimitDist:
+        return None, None
+    q = np.clip(q, JACOBIAN_MIN_LIMITS, JACOBIAN_MAX_LIMITS)
+
+    J, tool = DifferentialKinematics.armJacobian(armId, q)
+    error = DifferentialKinematics.poseError(tool, target)
+    for _ in xrange(maxIterations):
+        if np.linalg.norm(error[:3]) < posTolerance and np.linalg.norm(error[3:]) < rotTolerance:
+            break
+        qNew = np.clip(q + DifferentialKinematics.dlsStep(J, error, damping), JACOBIAN_MIN_LIMITS, JACOBIAN_MAX_LIMITS)
+        JNew, toolNew = DifferentialKinematics.armJacobian(armId, qNew)
+        errorNew = DifferentialKinematics.poseError(toolNew, target)
+        if np.linalg.norm(errorNew) < np.linalg.norm(error):
+            q, J, error = qNew, JNew, errorNew
+            damping = max(damping / 2., 1e-4)
+        else:
+            # stuck against a limit or overshooting, trust the gradient more
+            damping *= 4.
+            if damping > 10.:
+                break
+
+    residual = (float(np.linalg.norm(error[:3])), float(np.linalg.norm(error[3:])))
+    if residual[0] > maxPosResidual or residual[1] > maxRotResidual:
+        return None, None
+
+    joints = DifferentialKinematics.vectorToJoints(armId, q, grasp)
+    if not (kin.TOOL_GRASP1_MIN_LIMIT <= joints[GRASP1] <= kin.TOOL_GRASP1_MAX_LIMIT and
+            kin.TOOL_GRASP2_MIN_LIMIT <= joints[GRASP2] <= kin.TOOL_GRASP2_MAX_LIMIT):
+        return None, None
+
+    return joints, residual
+
+def invArmKinWithFallback(armId, pose, grasp, stats=STATS, solver=kin.invArmKin, **kwargs):
+    """
+    solver (invArmKin or one with its signature), falling back to
+    invArmKinApproximate when it fails.
+
+    Returns (joints, approximate, residual). approximate is True when the
+    joints came from the fallback, residual is their tool pose error
+    ((0,0) for analytic solutions). joints is None if both fail
+    """
+    joints = solver(armId, pose, grasp)
+    approximate, residual = False, (0., 0.)
+    if joints is None:
+        joints, residual = invArmKinApproximate(armId, pose, grasp, **kwargs)
+        approximate = True
+    if stats is not None:
+        stats.record(approximate, joints)
+    return joints, approximate, residual
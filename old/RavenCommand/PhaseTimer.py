@@ -0,0 +1,147 @@
+"""
+Timers around the stages of planning, kept as rolling windows per phase,
+arm and caller, published as diagnostics and dumped to a file
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+import rospy
+
+import threading
+import collections
+import time
+import json
+import csv
+
+import numpy as np
+
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+
+# histogram bin edges in seconds, log spaced from .1 ms to 10 s
+BIN_EDGES = np.logspace(-4, 1, 11)
+
+PERCENTILES = [50, 90, 99]
+
+class _NullPhase(object):
+    """
+    What a disabled timer times with, does nothing
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+class _Phase(object):
+    __slots__ = ('timer', 'key', 'start')
+
+    def __init__(self, timer, key):
+        self.timer = timer
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.timer._record(self.key, time.time() - self.start)
+        return False
+
+class PhaseTimer(object):
+    """
+    with timer.phase('optimize', arm='R', caller='PlanTrajToObject'): ...
+    records the duration of the block in a window of the last window
+    durations of that (phase, arm, caller). Disabled, phase() returns a
+    shared context that does nothing
+    """
+    def __init__(self, enabled=True, window=1000):
+        self.enabled = enabled
+        self.window = window
+        self.lock = threading.Lock()
+        self.durations = dict()
+        self.counts = collections.defaultdict(int)
+
+    def phase(self, name, arm=None, caller=None):
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, (name, arm, caller))
+
+    def record(self, name, duration, arm=None, caller=None):
+        """
+        Records a duration measured elsewhere
+        """
+        if self.enabled:
+            self._record((name, arm, caller), duration)
+
+    def _record(self, key, duration):
+        with self.lock:
+            durations = self.durations.get(key)
+            if durations is None:
+                durations = self.durations[key] = collections.deque(maxlen=self.window)
+            durations.append(duration)
+            self.counts[key] += 1
+
+    def stats(self):
+        """
+        A dict per (phase, arm, caller) of its total count and the mean,
+        percentiles, max and histogram (counts in BIN_EDGES, with the
+        shorter and longer durations in the first and last bins) of its window
+        """
+        with self.lock:
+            windows = [(key, np.array(durations)) for key, durations in self.durations.iteritems()]
+            counts = dict(self.counts)
+        stats = []
+        for (phase, arm, caller), durations in sorted(windows):
+            stat = {'phase' : phase,
+                    'arm' : arm,
+                    'caller' : caller,
+                    'count' : counts[(phase, arm, caller)],
+                    'mean' : float(durations.mean()),
+                    'max' : float(durations.max()),
+                    'histogram' : np.histogram(np.clip(durations, BIN_EDGES[0], BIN_EDGES[-1]), BIN_EDGES)[0].tolist()}
+            for percentile, value in zip(PERCENTILES, np.percentile(durations, PERCENTILES)):
+                stat['p%d' % percentile] = float(value)
+            stats.append(stat)
+        return stats
+
+    def diagnostics(self, name='planner'):
+        """
+        DiagnosticArray with a status per (phase, arm, caller)
+        """
+        msg = DiagnosticArray()
+        msg.header.stamp = rospy.Time.now()
+        for stat in self.stats():
+            status = DiagnosticStatus()
+            status.level = DiagnosticStatus.OK
+            status.name = '%s: %s' % (name, '/'.join(str(stat[k]) for k in ('phase', 'arm', 'caller') if stat[k] is not None))
+            status.message = 'mean %.1f ms, p90 %.1f ms' % (stat['mean']*1000, stat['p90']*1000)
+            status.values = [KeyValue(key, str(stat[key])) for key in ['count', 'mean', 'max'] + ['p%d' % p for p in PERCENTILES]]
+            status.values.append(KeyValue('histogram', ' '.join(str(c) for c in stat['histogram'])))
+            msg.status.append(status)
+        return msg
+
+    def publishPeriodically(self, topic='/diagnostics', period=1.):
+        """
+        Publishes diagnostics() on topic every period seconds
+        """
+        pub = rospy.Publisher(topic, DiagnosticArray)
+        return rospy.Timer(rospy.Duration(period), lambda event: pub.publish(self.diagnostics()))
+
+    def dump(self, filename):
+        """
+        Writes stats() to filename, as csv if it ends in .csv and json otherwise
+        """
+        stats = self.stats()
+        if filename.endswith('.csv'):
+            columns = ['phase', 'arm', 'caller', 'count', 'mean'] + ['p%d' % p for p in PERCENTILES] + ['max']
+            binColumns = ['bin_%g' % edge for edge in BIN_EDGES[:-1]]
+            with open(filename, 'wb') as f:
+                writer = csv.writer(f)
+                writer.writerow(columns + binColumns)
+                for stat in stats:
+                    writer.writerow([stat[column] for column in columns] + stat['histogram'])
+        else:
+            with open(filename, 'w') as f:
+                json.dump({'binEdges' : BIN_EDGES.tolist(), 'phases' : stats}, f, indent=2)
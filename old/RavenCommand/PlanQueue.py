@@ -0,0 +1,222 @@
+"""
+Trajectory requests for RavenPlanner2 and the queue the optimizer thread
+takes them from. A request is also the future of its result
+"""
+
+import threading
+import collections
+import time
+
+class PlanTimeoutError(RuntimeError):
+    pass
+
+def waitFor(condition, predicate, timeout=None):
+    """
+    Waits on condition (which must be held) until predicate() is true or
+    timeout seconds pass, and returns predicate().
+
+    Condition.wait(timeout) in python 2 polls with sleeps of up to 50 ms,
+    so this only uses untimed waits and wakes itself with a Timer instead
+    """
+    if predicate():
+        return True
+    if timeout is None:
+        while not predicate():
+            condition.wait()
+        return True
+
+    expired = [False]
+    def wake():
+        with condition:
+            expired[0] = True
+            condition.notify_all()
+    timer = threading.Timer(timeout, wake)
+    timer.daemon = True
+    timer.start()
+    try:
+        while not predicate() and not expired[0]:
+            condition.wait()
+    finally:
+        timer.cancel()
+    return predicate()
+
+class Future(object):
+    """
+    Result of work done on another thread, set once with setResult or
+    setException
+    """
+    def __init__(self):
+        self.submitTime = None
+        self.finishTime = None
+
+        self._condition = threading.Condition(threading.Lock())
+        self._done = False
+        self._result = None
+        self._exception = None
+
+    def setResult(self, result):
+        with self._condition:
+            self._result = result
+            self._done = True
+            self.finishTime = time.time()
+            self._condition.notify_all()
+
+    def setException(self, exception):
+        with self._condition:
+            self._exception = exception
+            self._done = True
+            self.finishTime = time.time()
+            self._condition.notify_all()
+
+    def done(self):
+        return self._done
+
+    def wait(self, timeout=None):
+        """
+        Blocks until done or timeout seconds pass, returns done()
+        """
+        with self._condition:
+            return waitFor(self._condition, self.done, timeout)
+
+    def result(self, timeout=None):
+        """
+        Blocks until the result is set and returns it, raising the exception
+        that was set or PlanTimeoutError after timeout seconds
+        """
+        if not self.wait(timeout):
+            raise PlanTimeoutError(self._timeoutMessage(timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def _timeoutMessage(self, timeout):
+        return 'No result after %.2f s' % timeout
+
+class PlanRequest(Future):
+    """
+    Start and end of one arm's trajectory. The optimizer sets the result
+    (the delta pose trajectory, None if trajopt failed) or an exception
+    """
+    def __init__(self, armName, startJoints, endJoints, startPose=None, endPose=None,
+                 startGrasp=None, endGrasp=None, n_steps=50, approachDir=None):
+        Future.__init__(self)
+        self.armName = armName
+        self.startJoints = startJoints
+        self.endJoints = endJoints
+        self.startPose = startPose
+        self.endPose = endPose
+        self.startGrasp = startGrasp
+        self.endGrasp = endGrasp
+        self.n_steps = n_steps
+        self.approachDir = approachDir
+        # who asked for it, for the phase timings
+        self.caller = None
+        # planned ahead of being asked for, by the SpeculativePlanner
+        self.speculative = False
+        # JointTrajectory of the result, set by the planner
+        self.jointTraj = None
+        # time.time() the result is wanted by, None to wait for trajopt. With
+        # refine, a fallback returned at the deadline is followed by trajopt's
+        # result in the refinement Future
+        self.deadline = None
+        self.refine = False
+        self.refinement = None
+
+    def _timeoutMessage(self, timeout):
+        return 'No trajectory for %s after %.2f s' % (self.armName, timeout)
+
+    def __repr__(self):
+        return 'PlanRequest(%r, n_steps=%d, done=%s)' % (self.armName, self.n_steps, self._done)
+
+class PlanQueue(object):
+    """
+    A FIFO of PlanRequests per arm. The arms are planned together, so
+    take() waits until every arm has a request and pops one of each.
+    Decoupled, each arm is planned on its own and take() pops the oldest
+    request of an arm that is not being planned
+    """
+    def __init__(self, armNames, decoupled=False):
+        self.armNames = list(armNames)
+        self.decoupled = decoupled
+        self.condition = threading.Condition(threading.Lock())
+        self.queues = dict((armName, collections.deque()) for armName in self.armNames)
+        self.running = 0
+        # arms taken and not yet done, so an arm's requests are planned in order
+        self.busy = set()
+        self.closed = False
+
+    def submit(self, request):
+        """
+        Queues request, waking the optimizer thread, and returns it
+        """
+        with self.condition:
+            request.submitTime = time.time()
+            self.queues[request.armName].append(request)
+            self.condition.notify_all()
+        return request
+
+    def readyArms(self):
+        if self.decoupled:
+            return [armName for armName in self.armNames if self.queues[armName] and armName not in self.busy]
+        if all(self.queues[armName] for armName in self.armNames):
+            return list(self.armNames)
+        return []
+
+    def ready(self):
+        return len(self.readyArms()) > 0
+
+    def pending(self, armName=None):
+        """
+        Number of queued requests (of armName or of all arms)
+        """
+        with self.condition:
+            if armName is not None:
+                return len(self.queues[armName])
+            return sum(len(queue) for queue in self.queues.itervalues())
+
+    def take(self, timeout=None):
+        """
+        Waits until every arm (decoupled, any arm) has a request and returns
+        a dict of armName to its oldest request. Decoupled, the dict has the
+        one arm whose request has waited longest. Returns None if closed or
+        after timeout seconds. Call taskDone(requests) once the requests are
+        finished
+        """
+        with self.condition:
+            waitFor(self.condition, lambda: self.closed or self.ready(), timeout)
+            if self.closed or not self.ready():
+                return None
+            armNames = self.readyArms()
+            if self.decoupled:
+                armNames = [min(armNames, key=lambda armName: self.queues[armName][0].submitTime)]
+            self.running += 1
+            self.busy.update(armNames)
+            return dict((armName, self.queues[armName].popleft()) for armName in armNames)
+
+    def taskDone(self, requests=None):
+        with self.condition:
+            self.running -= 1
+            if requests is not None:
+                self.busy.difference_update(requests)
+            self.condition.notify_all()
+
+    def idle(self):
+        return self.running == 0 and not any(self.queues.itervalues())
+
+    def waitIdle(self, timeout=None):
+        """
+        Blocks until every queued request has been planned, returns idle()
+        """
+        with self.condition:
+            return waitFor(self.condition, lambda: self.closed or self.idle(), timeout) and self.idle()
+
+    def close(self):
+        """
+        Wakes and stops the optimizer thread, failing the queued requests
+        """
+        with self.condition:
+            self.closed = True
+            for queue in self.queues.itervalues():
+                while queue:
+                    queue.popleft().setException(RuntimeError('Planner closed'))
+            self.condition.notify_all()
@@ -0,0 +1,126 @@
+"""
+Worker processes that each keep an OpenRAVE environment of the Raven
+model loaded and solve trajopt problems in parallel
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import itertools
+import multiprocessing
+import threading
+import time
+
+import numpy as np
+
+from RavenDebridement.RavenCommand.PlanQueue import Future
+
+def _worker(ravenFile, jobs, results):
+    """
+    Loads the model once, then solves (jobId, requestJson, activeDOFs,
+    dofValues) jobs until it gets None. Puts (jobId, (traj, safe,
+    solveTime, cost), None) or (jobId, None, error) on results
+    """
+    import openravepy as rave
+    import trajoptpy
+    from trajoptpy.check_traj import traj_is_safe
+
+    env = rave.Environment()
+    env.Load(ravenFile)
+    robot = env.GetRobots()[0]
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        jobId, requestJson, activeDOFs, dofValues = job
+        try:
+            robot.SetDOFValues(dofValues)
+            robot.SetActiveDOFs(activeDOFs)
+            start = time.time()
+            prob = trajoptpy.ConstructProblem(requestJson, env)
+            result = trajoptpy.OptimizeProblem(prob)
+            solveTime = time.time() - start
+            traj = np.array(result.GetTraj())
+            cost = sum(value for _, value in result.GetCosts())
+            prob.SetRobotActiveDOFs()
+            safe = bool(traj_is_safe(traj, robot))
+            results.put((jobId, (traj, safe, solveTime, cost), None))
+        except Exception as e:
+            results.put((jobId, None, '%s: %s' % (type(e).__name__, e)))
+
+    env.Destroy()
+
+class PlannerPool(object):
+    """
+    processes workers (default one per core), each with its own
+    environment loaded from ravenFile. Objects added to the planner's
+    environment after loading are not seen by the workers.
+
+    Create the pool before any OpenRAVE environment in this process, so
+    the workers are not forked with its threads
+    """
+    def __init__(self, ravenFile, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.jobs = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.workers = []
+        for _ in xrange(self.processes):
+            worker = multiprocessing.Process(target=_worker, args=(ravenFile, self.jobs, self.results))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        self.jobIds = itertools.count()
+        self.futures = dict()
+        self.lock = threading.Lock()
+
+        self._resultThread = threading.Thread(target=self._collectResults)
+        self._resultThread.daemon = True
+        self._resultThread.start()
+
+    def _collectResults(self):
+        while True:
+            jobId, result, error = self.results.get()
+            if jobId is None:
+                break
+            with self.lock:
+                future = self.futures.pop(jobId, None)
+            if future is None:
+                continue
+            if error is not None:
+                future.setException(RuntimeError('Trajopt worker failed: %s' % error))
+            else:
+                future.setResult(result)
+
+    def submit(self, requestJson, activeDOFs, dofValues):
+        """
+        Queues a trajopt problem (the json string of a jointRequest) to be
+        solved from the robot state given by dofValues (all dofs) and
+        activeDOFs. Returns a Future of (traj, safe, solveTime, cost)
+        """
+        future = Future()
+        with self.lock:
+            jobId = self.jobIds.next()
+            self.futures[jobId] = future
+        future.submitTime = time.time()
+        self.jobs.put((jobId, requestJson, list(activeDOFs), list(dofValues)))
+        return future
+
+    def solve(self, requestJson, activeDOFs, dofValues, timeout=None):
+        return self.submit(requestJson, activeDOFs, dofValues).result(timeout)
+
+    def pending(self):
+        with self.lock:
+            return len(self.futures)
+
+    def close(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join(1.)
+        self.results.put((None, None, None))
+        with self.lock:
+            futures, self.futures = self.futures.values(), dict()
+        for future in futures:
+            future.setException(RuntimeError('Planner pool closed'))
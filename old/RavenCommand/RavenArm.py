@@ -23,6 +23,7 @@ from RavenDebridement.Utils import Constants as MyConstants
 from RavenDebridement.Utils import Util
 #from RavenPlanner import Request, RavenPlanner
 from RavenController import RavenController
+from RavenDebridement.RavenCommand.Trajectory import PoseList, applyDeltaPoses
 from RavenDebridement.ImageProcessing.ARImageDetection import ARImageDetector
 
 
@@ -129,13 +130,20 @@ class RavenArm:
         Each deltaPose in deltaPoses is with respect to the startPose
         
         Assuming deltaPoses and startPose in same frame (0_link)
+        
+        deltaPoses from the planner are a PoseList, whose end poses are
+        computed together
         """
         if startPose is None:
             startPose = self.getGripperPose()
             if startPose is None:
                 return
         
-        endPoses = [Util.endPose(startPose, deltaPose, self.commandFrame) for deltaPose in deltaPoses]
+        if isinstance(deltaPoses, PoseList):
+            startPose = Util.convertToFrame(tfx.pose(startPose), self.commandFrame)
+            endPoses = PoseList(applyDeltaPoses(np.array(startPose.matrix), deltaPoses.matrices), frame=startPose.frame)
+        else:
+            endPoses = [Util.endPose(startPose, deltaPose, self.commandFrame) for deltaPose in deltaPoses]
             
         return self.executePoseTrajectory(endPoses, block=block, speed=speed, ignoreOrientation=ignoreOrientation)
             
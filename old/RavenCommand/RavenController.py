@@ -26,6 +26,7 @@ import threading
 
 from RavenDebridement.Utils import Util
 from RavenDebridement.Utils import Constants as MyConstants
+from RavenDebridement.RavenCommand.JointState import JointState
 
 
 class Stage(object):
@@ -100,11 +101,11 @@ class RavenController():
                 self.currentPose = tfx.pose(arm.tool.pose, header=msg.header)
                 self.currentGrasp = arm.tool.grasp
 
-                self.currentJoints = dict((joint.type, joint.position) for joint in arm.joints)
+                self.currentJoints = JointState.fromMsg(self.arm, arm.joints)
 
     def getCurrentJoints(self):
         """
-        Returns is dictionary of {jointType : jointPos}
+        Returns a JointState, read like a dictionary of {jointType : jointPos}
         
         jointType is from raven_2_msgs.msg.Constants
         jointPos is position in radians
@@ -329,6 +330,10 @@ class RavenController():
             if startJoints == None:
                 rospy.loginfo('Have not received startJoints yet, aborting goToJoints')
                 return
+        
+        # copies, since joints are removed below (and JointStates are read-only)
+        startJoints = dict(startJoints.items())
+        endJoints = dict(endJoints.items())
 
         # if there doesn't exist a start joint for an end joint, return
         for endJointType in endJoints.keys():
@@ -0,0 +1,238 @@
+"""
+Flattened Raven kinematics with per-arm constants precomputed at import.
+
+Transforms are kept as flat 12-tuples (rows of the top 3x4 of the
+homogeneous matrix) so a single FK or IK call only does float math.
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import numpy as np
+
+from math import *
+
+import RavenDebridement.RavenCommand.kinematics as kin
+from RavenDebridement.RavenCommand.kinematics import (SHOULDER, ELBOW, Z_INS, TOOL_ROT, WRIST, GRASP1, GRASP2, YAW, GRASP,
+                                                      GOLD_ARM_ID, GREEN_ARM_ID, JOINT_TYPES)
+from RavenDebridement.RavenCommand.JointState import JointState
+
+def _flat(tf):
+    """
+    Converts a tfx transform to a flat 12-tuple
+    """
+    m = np.asarray(kin._tf_array(tf))
+    return tuple(float(v) for v in m[:3,:].flatten())
+
+def _mul(a, b):
+    """
+    a * b for flat 12-tuples
+    """
+    a00,a01,a02,a03, a10,a11,a12,a13, a20,a21,a22,a23 = a
+    b00,b01,b02,b03, b10,b11,b12,b13, b20,b21,b22,b23 = b
+    return (a00*b00 + a01*b10 + a02*b20, a00*b01 + a01*b11 + a02*b21, a00*b02 + a01*b12 + a02*b22, a00*b03 + a01*b13 + a02*b23 + a03,
+            a10*b00 + a11*b10 + a12*b20, a10*b01 + a11*b11 + a12*b21, a10*b02 + a11*b12 + a12*b22, a10*b03 + a11*b13 + a12*b23 + a13,
+            a20*b00 + a21*b10 + a22*b20, a20*b01 + a21*b11 + a22*b21, a20*b02 + a21*b12 + a22*b22, a20*b03 + a21*b13 + a22*b23 + a23)
+
+def _mulZ(a, theta, d=0.):
+    """
+    a * Z(theta,d) for a flat 12-tuple
+    """
+    a00,a01,a02,a03, a10,a11,a12,a13, a20,a21,a22,a23 = a
+    c = cos(theta)
+    s = sin(theta)
+    return (a00*c + a01*s, a01*c - a00*s, a02, a03 + a02*d,
+            a10*c + a11*s, a11*c - a10*s, a12, a13 + a12*d,
+            a20*c + a21*s, a21*c - a20*s, a22, a23 + a22*d)
+
+def _inv(a):
+    """
+    Inverse of a rigid flat 12-tuple
+    """
+    a00,a01,a02,a03, a10,a11,a12,a13, a20,a21,a22,a23 = a
+    return (a00, a10, a20, -(a00*a03 + a10*a13 + a20*a23),
+            a01, a11, a21, -(a01*a03 + a11*a13 + a21*a23),
+            a02, a12, a22, -(a02*a03 + a12*a13 + a22*a23))
+
+def _matrix(a):
+    m = np.eye(4)
+    m[:3,:] = np.reshape(a, (3,4))
+    return m
+
+class RavenKinematicModel(object):
+    """
+    Scalar FK/IK for one arm, equivalent to kinematics.fwdArmKin
+    and kinematics.invArmKin but without any tfx allocation
+    """
+    def __init__(self, armId):
+        self.armId = armId
+        self.gold = (armId == GOLD_ARM_ID)
+
+        # actual world -> shoulder, and its inverse for the ik
+        self.base = _flat(kin.actual_world_to_ik_world(armId) * kin.Tw2b)
+        self.ikWorldToActualWorld = _flat(kin.ik_world_to_actual_world(armId))
+        self.Xu = _flat(kin.Xu)
+        self.Xf = _flat(kin.Xf)
+        self.Xip = _flat(kin.Xip)
+        self.Xpy = _flat(kin.Xpy)
+        self.Tg = _flat(kin.Tg)
+        # Tg followed by the tool pose axes flip
+        self.tool = (1., 0., 0., kin.Tg.position.x,
+                     0.,-1., 0., kin.Tg.position.y,
+                     0., 0.,-1., kin.Tg.position.z)
+        # inverse of the above, applied to the tool pose in the ik
+        self.toolInv = _inv(self.tool)
+
+        self.ks12 = sin(kin.THETA_12)
+        self.kc12 = cos(kin.THETA_12)
+        self.ks23 = sin(kin.THETA_23)
+        self.kc23 = cos(kin.THETA_23)
+        self.dw = kin.DW
+
+    def _jointValues(self, joints):
+        if isinstance(joints, JointState):
+            return joints.positions.tolist()
+        if isinstance(joints, dict):
+            return [joints[jointType] for jointType in JOINT_TYPES]
+        return [float(v) for v in joints]
+
+    def fwdArmKinFlat(self, joints):
+        """
+        joints is a dict or a sequence in kinematics.JOINT_TYPES order.
+        Returns the tool transform as a flat 12-tuple and the grasp
+        """
+        armId = self.armId
+        ths, the, d, thr, thp, g1, g2 = self._jointValues(joints)
+
+        tf = _mulZ(self.base, kin.THS_TO_IK(armId,ths))
+        tf = _mul(tf, self.Xu)
+        tf = _mulZ(tf, kin.THE_TO_IK(armId,the))
+        tf = _mul(tf, self.Xf)
+        tf = _mulZ(tf, kin.THR_TO_IK(armId,thr))
+        tf = _mulZ(tf, 0., kin.D_TO_IK(armId,d))
+        tf = _mul(tf, self.Xip)
+        tf = _mulZ(tf, kin.THP_TO_IK(armId,thp))
+        tf = _mul(tf, self.Xpy)
+        tf = _mulZ(tf, kin.THY_TO_IK_FROM_FINGERS(armId,g1,g2))
+        tf = _mul(tf, self.tool)
+
+        grasp = (g2 + g1) if self.gold else -(g2 + g1)
+        return tf, grasp
+
+    def fwdArmKin(self, joints):
+        """
+        Returns the tool transform as a 4x4 array in '/0_link' and the grasp
+        """
+        tf, grasp = self.fwdArmKinFlat(joints)
+        return _matrix(tf), grasp
+
+    def invArmKin(self, pose, grasp):
+        """
+        pose is a 4x4 array (or anything with a 4x4 .matrix) in '/0_link'.
+        Returns the same joint dict as kinematics.invArmKin, or None
+        """
+        armId = self.armId
+        m = getattr(pose, 'matrix', pose)
+        pose = (float(m[0][0]), float(m[0][1]), float(m[0][2]), float(m[0][3]),
+                float(m[1][0]), float(m[1][1]), float(m[1][2]), float(m[1][3]),
+                float(m[2][0]), float(m[2][1]), float(m[2][2]), float(m[2][3]))
+
+        ik_pose = _mul(_mul(self.ikWorldToActualWorld, pose), self.toolInv)
+        Tgripper_to_world = _inv(ik_pose)
+
+        px = Tgripper_to_world[3]
+        py = Tgripper_to_world[7]
+        pz = Tgripper_to_world[11]
+
+        dw = self.dw
+        thy = atan2(py,-px)
+        if abs(thy) < 0.001:
+            thp = atan2(-pz, -px/cos(thy) - dw)
+        else:
+            thp = atan2(-pz,  py/sin(thy) - dw)
+        d = -pz / sin(thp)
+
+        d_act = kin.D_FROM_IK(armId,d)
+        thp_act = kin.THP_FROM_IK(armId,thp)
+        g1_act = kin.FINGER1_FROM_IK(armId,thy,grasp)
+        g2_act = kin.FINGER2_FROM_IK(armId,thy,grasp)
+
+        if not (kin.Z_INS_MIN_LIMIT <= d_act <= kin.Z_INS_MAX_LIMIT and
+                kin.TOOL_WRIST_MIN_LIMIT <= thp_act <= kin.TOOL_WRIST_MAX_LIMIT and
+                kin.TOOL_GRASP1_MIN_LIMIT <= g1_act <= kin.TOOL_GRASP1_MAX_LIMIT and
+                kin.TOOL_GRASP2_MIN_LIMIT <= g2_act <= kin.TOOL_GRASP2_MAX_LIMIT):
+            return None
+
+        # roll frame -> world is ik_pose * (Zi*Xip*Zp*Xpy*Zy*Tg)^-1, with
+        # [0,0,1] and [1,0,0] mapped as points as in invArmKin
+        roll_to_gripper = self.Xip[:11] + (self.Xip[11] + d,)
+        roll_to_gripper = _mulZ(roll_to_gripper, thp)
+        roll_to_gripper = _mul(roll_to_gripper, self.Xpy)
+        roll_to_gripper = _mulZ(roll_to_gripper, thy)
+        roll_to_gripper = _mul(roll_to_gripper, self.Tg)
+        r = _mul(ik_pose, _inv(roll_to_gripper))
+
+        zx = r[2] + r[3]
+        zy = r[6] + r[7]
+        zz = r[10] + r[11]
+        xx = r[0] + r[3]
+        xy = r[4] + r[7]
+
+        ks12, kc12, ks23, kc23 = self.ks12, self.kc12, self.ks23, self.kc23
+        cthe = (zy + kc12*kc23) / (ks12*ks23)
+        if not -1. <= cthe <= 1.:
+            return None
+
+        joints = None
+        for the in (acos(cthe), -acos(cthe)):
+            sthe = sin(the)
+            C1 = ks12*kc23 + kc12*ks23*cthe
+            C2 = ks23 * sthe
+            C3 = C2 + C1*C1 / C2
+            sign = copysign(1., C3) if C3 != 0 else 0.
+
+            ths = atan2(-sign*(zx - C1 * zz / C2),
+                         sign*(zz + C1 * zx / C2))
+            sths = sin(ths)
+            cths = cos(ths)
+
+            C4 = ks12 * sthe
+            C5 = kc12 * ks23 + ks12 * kc23 * cthe
+            C6 = kc23*(sthe * sths - kc12*cthe*cths) + cths*ks12*ks23
+            C7 = cthe*sths + kc12*cths*sthe
+
+            thr = atan2((xx - C7 * xy / C4) / (C6 + C7*C5/C4),
+                        (xx + C6 * xy / C5) / (-C6*C4/C5 - C7))
+
+            ths_act = kin.THS_FROM_IK(armId,ths)
+            the_act = kin.THE_FROM_IK(armId,the)
+            thr_act = kin.THR_FROM_IK(armId,thr)
+
+            # later branches win, as in invArmKin
+            if (kin.SHOULDER_MIN_LIMIT <= ths_act <= kin.SHOULDER_MAX_LIMIT and
+                kin.ELBOW_MIN_LIMIT <= the_act <= kin.ELBOW_MAX_LIMIT and
+                kin.TOOL_ROLL_MIN_LIMIT <= thr_act <= kin.TOOL_ROLL_MAX_LIMIT):
+                joints = {SHOULDER : ths_act,
+                          ELBOW : the_act,
+                          Z_INS : d_act,
+                          TOOL_ROT : thr_act,
+                          WRIST : thp_act,
+                          GRASP1 : g1_act,
+                          GRASP2 : g2_act}
+
+        if joints is None:
+            return None
+
+        if not self.gold:
+            joints[YAW] = (joints[GRASP1] - joints[GRASP2])/2.
+        else:
+            joints[YAW] = (joints[GRASP2] - joints[GRASP1])/2.
+        joints[GRASP] = grasp
+
+        return joints
+
+MODELS = {GOLD_ARM_ID : RavenKinematicModel(GOLD_ARM_ID),
+          GREEN_ARM_ID : RavenKinematicModel(GREEN_ARM_ID)}
+
+def getModel(armId):
+    return MODELS[armId]
@@ -19,6 +19,21 @@ from visualization_msgs.msg import Marker
 
 from RavenDebridement.srv import InvKinSrv
 import RavenDebridement.RavenCommand.kinematics as kin
+from RavenDebridement.RavenCommand.IKCache import IKCache
+from RavenDebridement.RavenCommand.JointState import JointState, JointTrajectory
+from RavenDebridement.RavenCommand.Trajectory import Trajectory
+from RavenDebridement.RavenCommand import DifferentialKinematics
+from RavenDebridement.RavenCommand import NumericalIK
+from RavenDebridement.RavenCommand import ArmClearance
+from RavenDebridement.RavenCommand.CartesianPath import cartesianPathIK, CartesianPathError
+from RavenDebridement.RavenCommand.PlanQueue import PlanQueue, PlanRequest, Future
+from RavenDebridement.RavenCommand.TrajectoryLibrary import TrajectoryLibrary
+from RavenDebridement.RavenCommand.PlannerPool import PlannerPool
+from RavenDebridement.RavenCommand.Speculation import SpeculativePlanner
+from RavenDebridement.RavenCommand import TieredPlanning
+from RavenDebridement.RavenCommand import Discretization
+from RavenDebridement.RavenCommand.PhaseTimer import PhaseTimer
+from RavenDebridement.RavenCommand import Anytime
 from RavenDebridement.msg import TrajoptCall
 
 import openravepy as rave
@@ -27,6 +42,8 @@ import json
 import numpy as np
 
 import threading
+import time
+import sys
 
 import tfx
 
@@ -35,6 +52,11 @@ from RavenDebridement.Utils import Constants as MyConstants
 
 import IPython
 
+# tool speed (m/s) a committed trajectory is assumed to be executed at,
+# RavenController's default pose speed, and the seconds added to that
+# estimate before the commitment expires
+COMMIT_POSE_SPEED = .01
+COMMIT_MARGIN = 2.
 
 
 def transformRelativePoseForIk(manip, poseMatrix, refLinkName, targLinkName):
@@ -63,13 +85,30 @@ def transformRelativePoseForIk(manip, poseMatrix, refLinkName, targLinkName):
 
     return newWorldFromEE
 
-def jointRequest(n_steps, endJointPositions, startPoses, endPoses, toolFrames, manips, approachDirs=None, approachDist=0.02):
+# trajopt problems have at least this many steps
+MIN_STEPS = 5
+
+def callerName():
+    """
+    Class (or function) name of the first code up the stack outside this
+    module, to tag the timings of its requests with
+    """
+    frame = sys._getframe(1)
+    while frame.f_back is not None and frame.f_globals.get('__name__') == __name__:
+        frame = frame.f_back
+    instance = frame.f_locals.get('self')
+    return type(instance).__name__ if instance is not None else frame.f_code.co_name
+
+def jointRequest(n_steps, endJointPositions, startPoses, endPoses, toolFrames, manips, approachDirs=None, approachDist=0.02, initTraj=None):
     """
     approachDirs is a list of 3d vectors dictating approach direction
     w.r.t. 0_link
     To come from above, approachDir = np.array([0,0,1])
+
+    initTraj is an optional (n_steps, dofs) joint trajectory to initialize
+    trajopt with, instead of the straight line to endJointPositions
     """
-    n_steps = n_steps if n_steps > 5 else 5
+    n_steps = n_steps if n_steps > MIN_STEPS else MIN_STEPS
     approachDirs = approachDirs or [None for _ in range(len(endPoses))]
     
     request = {
@@ -113,6 +152,12 @@ def jointRequest(n_steps, endJointPositions, startPoses, endPoses, toolFrames, m
             }
         }
     
+    if initTraj is not None:
+        request["init_info"] = {
+            "type" : "given_traj",
+            "data" : np.asarray(initTraj).tolist()
+            }
+    
     for startPose, endPose, toolFrame, manip, approachDir in zip(startPoses, endPoses, toolFrames, manips, approachDirs):
             if approachDir is not None and tfx.point(np.array(endPose.position.list) - np.array(startPose.position.list)).norm > approachDist:
                 #pose = tfx.pose(endPose)
@@ -147,6 +192,36 @@ def jointRequest(n_steps, endJointPositions, startPoses, endPoses, toolFrames, m
 
     return request
 
+class TrajoptProblem(object):
+    """
+    The joints, poses and frames of a plan of one or more arms in the order
+    of the trajopt problem (the sorted arms, each in GetArmIndices order),
+    the waypoints it is solved with and sent at, and the TrajoptCall
+    message that logs it
+    """
+    def __init__(self, armNames, n_steps):
+        self.armNames = armNames
+        self.n_steps = n_steps
+        self.solveSteps = n_steps
+        self.startJointPositions = []
+        self.endJointPositions = []
+        self.startPoses = []
+        self.endPoses = []
+        self.toolFrames = []
+        self.manips = []
+        self.approachDirs = []
+        self.msg = TrajoptCall()
+    
+    def minSolveSteps(self):
+        return max(self.solveSteps, MIN_STEPS)
+    
+    def straightLinesAllowed(self):
+        return all(approachDir is None for approachDir in self.approachDirs)
+    
+    def jointRequest(self, initTraj=None):
+        return jointRequest(self.solveSteps, self.endJointPositions, self.startPoses, self.endPoses, self.toolFrames, self.manips,
+                            approachDirs=self.approachDirs, approachDist=0.03, initTraj=initTraj)
+
 
 
 
@@ -169,23 +244,58 @@ class RavenPlanner:
     defaultJointPositions = [.512, 1.6, -.2, .116, .088, 0]
     defaultJoints = dict([(jointType,jointPos) for jointType, jointPos in zip(rosJointTypes,defaultJointPositions)])
 
-    def __init__(self, armNames, thread=True, withWorkspace=False):
+    def __init__(self, armNames, thread=True, withWorkspace=False, reachabilityMaps=None, correctionThreshold=0,
+                 approximateIK=False, minArmClearance=None, trajectoryCache=None, warmStart=False, compareWarmStart=False,
+                 processes=0, speculate=False, tiered=False, adaptiveSteps=False, phaseTimer=None, decoupled=False,
+                 planBudget=None):
+        """
+        processes > 0 solves trajopt in that many worker processes, each
+        with its own copy of the model, with as many optimizer threads
+        taking requests from the queue
+
+        speculate plans the trajectories given to speculate() in the
+        background for getTrajectoryFromPose to reuse
+
+        tiered tries straight lines in joint and Cartesian space before trajopt
+
+        adaptiveSteps sizes the trajopt problem from the move (see
+        Discretization) and resamples the solution to the requested n_steps
+
+        phaseTimer (a PhaseTimer) times the stages of planning
+
+        decoupled plans each arm's requests as they come, with the other
+        arm fixed at the end of its committed trajectory (or its current
+        joints) instead of waiting for a request of every arm
+
+        planBudget (seconds after submission) is the deadline of requests
+        submitted without one. At its deadline a request gets the best
+        feasible trajectory found without trajopt if trajopt isn't done
+        """
         if isinstance(armNames,basestring):
             armNames = [armNames]
         self.armNames = sorted(armNames)
         
         self.refFrame = MyConstants.Frames.Link0
 
-        self.env = rave.Environment()
-
-        rospy.loginfo('Before loading model')
         if withWorkspace:
             ravenFile = os.path.join(roslib.packages.get_pkg_subdir('RavenDebridement','models'),'raven_with_workspace.zae')
         else:
             ravenFile = os.path.join(roslib.packages.get_pkg_subdir('RavenDebridement','models'),'myRaven.xml')
         #ravenFile = '/home/gkahn/ros_workspace/RavenDebridement/models/myRaven.xml'
+        
+        # forked before this process has an environment
+        self.plannerPool = None
+        if processes > 0:
+            self.plannerPool = PlannerPool(ravenFile, processes)
+            rospy.on_shutdown(self.plannerPool.close)
+
+        self.env = rave.Environment()
+
+        rospy.loginfo('Before loading model')
         self.env.Load(ravenFile)
         rospy.loginfo('After loading model')
+        # part of the trajectory cache key, plans in one model are not valid in the other
+        self.workspace = os.path.basename(ravenFile)
 
 
         self.robot = self.env.GetRobots()[0]
@@ -202,23 +312,42 @@ class RavenPlanner:
         self.raveGrasperJointNames = dict()
         self.raveGrasperJointTypes = dict()
         
-        self.trajRequest = dict()
-        
-        self.trajEndJoints = dict()
-        self.trajEndGrasp = dict()
-        self.trajEndPose = dict()
-        
-        self.trajStartJoints = dict()
-        self.trajStartGrasp = dict()
-        self.trajStartPose = dict()
-        
-        self.trajSteps = dict()
+        # requests wait here until every arm has one (decoupled, until their
+        # arm is free), the optimizer thread wakes on submission and sets
+        # each request's result
+        self.decoupled = decoupled
+        self.planQueue = PlanQueue(self.armNames, decoupled=decoupled)
+        # (trajectory, expiry) of the last trajectory handed out for each
+        # arm, an obstacle to the other arm's decoupled plans until it is
+        # executed, expires or is released
+        self.committed = dict()
         
+        # results of the last plan of each arm
+        self.trajectory = dict()
         self.jointTraj = dict() # for debugging
         self.poseTraj = dict()
         self.deltaPoseTraj = dict()
         
-        self.approachDir = dict()
+        # repeated targets (start poses, holding/receptacle poses) skip the ik.
+        # caches all the ik solutions so each call can pick the one closest to its seed
+        self.ikCache = IKCache(solver=kin.invArmKinSolutions)
+        # optional dict of armName -> ReachabilityMap to reject targets before the ik
+        self.reachabilityMaps = reachabilityMaps or dict()
+        
+        # moves shorter than this (in meters) use resolved-rate ik instead of trajopt
+        self.correctionThreshold = correctionThreshold
+        self.correctionRotThreshold = 10 * pi / 180.
+        
+        # poses just outside the joint limits get a numerical ik solution instead of failing
+        self.approximateIK = approximateIK
+        self.ikFallbackStats = NumericalIK.STATS
+        
+        # two-arm plans whose start or end joints are closer than this (in meters,
+        # capsule model) are rejected before trajopt. None disables the check
+        self.minArmClearance = minArmClearance
+        
+        # optional TrajectoryCache, repeated queries skip trajopt and only get a collision check
+        self.trajectoryCache = trajectoryCache
         
         activeDOFs = []
         for armName in self.armNames:
@@ -227,6 +356,34 @@ class RavenPlanner:
             
         self.robot.SetActiveDOFs(activeDOFs)
         
+        # trajopt starts from the nearest past trajectory instead of a straight line.
+        # compareWarmStart also solves from a straight line and logs the difference
+        self.trajectoryLibrary = None
+        if warmStart:
+            weights = [10. if self.raveJointTypesToRos[armName][raveJointType] == Constants.JOINT_TYPE_INSERTION else 1.
+                       for armName in self.armNames for raveJointType in self.manip[armName].GetArmIndices()]
+            self.trajectoryLibrary = TrajectoryLibrary(weights=weights)
+        self.compareWarmStart = compareWarmStart
+        
+        # straight lines that pass a discrete collision check skip trajopt
+        self.tiered = tiered
+        self.tierStats = TieredPlanning.TierStats()
+        
+        self.adaptiveSteps = adaptiveSteps
+        
+        self.planBudget = planBudget
+        self.anytimeStats = Anytime.AnytimeStats()
+        
+        # a disabled timer costs a method call per stage
+        self.phaseTimer = phaseTimer or PhaseTimer(enabled=False)
+        
+        # coupled, the arms are planned together, so a speculative plan of
+        # one arm can't stand in for its request when planning both
+        self.speculator = None
+        if speculate and (len(self.armNames) == 1 or decoupled):
+            self.speculator = SpeculativePlanner(self.optimize1, self.rosJointTypes)
+            rospy.on_shutdown(self.speculator.close)
+        
         self.currentState = None
         rospy.Subscriber(MyConstants.RavenTopics.RavenState, RavenState, self._ravenStateCallback)
         
@@ -238,10 +395,15 @@ class RavenPlanner:
         
         
         self.lock = threading.RLock()
+        rospy.on_shutdown(self.planQueue.close)
         if thread:
-            self.thread = threading.Thread(target=self.optimizeLoop)
-            self.thread.setDaemon(True)
-            self.thread.start()
+            self.threads = []
+            for _ in xrange(max(processes, 1)):
+                thread = threading.Thread(target=self.optimizeLoop)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+            self.thread = self.threads[0]
 
     def _init_arm(self, armName):
         if armName == MyConstants.Arm.Left:
@@ -266,11 +428,7 @@ class RavenPlanner:
         self.raveGrasperJointNames[armName] = ['grasper_joint_1_{0}'.format(armName[0].upper()), 'grasper_joint_2_{0}'.format(armName[0].upper())]
         self.raveGrasperJointTypes[armName] = [self.robot.GetJointIndex(name) for name in self.raveGrasperJointNames[armName]]
         
-        self.approachDir[armName] = None
-        
         self.updateOpenraveJoints(armName, dict(self.defaultJoints), grasp=0)
-
-        self.trajRequest[armName] = False
         
 
 
@@ -310,7 +468,7 @@ class RavenPlanner:
             return None
         currentJoints = {}
         for arm in self.currentState.arms:
-            armJoints = dict((joint.type, joint.position) for joint in arm.joints)
+            armJoints = JointState.fromMsg(arm.name, arm.joints)
             if armName is None:
                 currentJoints[arm.name] = armJoints
             elif arm.name == armName:
@@ -327,27 +485,50 @@ class RavenPlanner:
             
 
     
-    def getJointsFromPose(self, armName, pose, grasp, quiet=False):
+    def getJointsFromPose(self, armName, pose, grasp, quiet=False, seedJoints=None, withApproximate=False):
         """
         Calls IK server and returns a dictionary of {jointType : jointPos}
         
         jointType is from raven_2_msgs.msg.Constants
         jointPos is position in radians
 
+        Of the valid ik solutions (elbow branch and tool roll +-2pi), returns
+        the one closest to seedJoints, which defaults to the current joints
+
+        With approximateIK, poses just outside the joint limits return the
+        numerical solution. withApproximate returns (joints, approximate,
+        residual) as NumericalIK.invArmKinWithFallback does
+
         Needs to return finger1 and finger2
         """
 
         pose = Util.convertToFrame(tfx.pose(pose), self.refFrame)
         
-        joints = kin.invArmKin(armName, pose, grasp)
+        if seedJoints is None and self.currentState is not None:
+            seedJoints = self.getCurrentJoints(armName)
+        
+        def closestSolution(armName, pose, grasp):
+            reachabilityMap = self.reachabilityMaps.get(armName)
+            if reachabilityMap is not None and reachabilityMap.isReachable(pose, grasp) is False:
+                return None
+            return kin.selectClosestSolution(self.ikCache.invArmKin(armName, pose, grasp), seedJoints or None)
+        
+        if self.approximateIK:
+            joints, approximate, residual = NumericalIK.invArmKinWithFallback(armName, pose, grasp, stats=self.ikFallbackStats,
+                                                                              solver=closestSolution)
+            if approximate and joints is not None:
+                rospy.loginfo('Approximate IK for %s, residual %.4f m %.4f rad, fallback rate %.3f' %
+                              (armName, residual[0], residual[1], self.ikFallbackStats.fallbackRate()))
+        else:
+            joints, approximate, residual = closestSolution(armName, pose, grasp), False, (0., 0.)
         
         if joints is None:
             rospy.loginfo('IK failed!')
-            if quiet:
-                return None
-            else:
+            if not quiet:
                 raise RuntimeError("IK failed!")
         
+        if withApproximate:
+            return joints, approximate, residual
         return joints
         
 
@@ -400,14 +581,11 @@ class RavenPlanner:
 
         self.robot.SetJointValues(jointPositions, raveJointTypes)
 
-    def jointTrajToDicts(self, armName, jointTrajArray, **kwargs):
+    def jointTrajToTrajectory(self, armName, jointTrajArray, **kwargs):
         """
-        Converts a numpy array trajectory
-        to a list of joint dictionaries
-
-        dicts contain ros joints1:
-        shoulder, elbow, insertion,
-        rotation, pitch, finger1, finger2
+        Converts a numpy array trajectory of the rosJointTypes
+        (shoulder, elbow, insertion, rotation, pitch, yaw)
+        to a JointTrajectory, splitting the yaw into finger1 and finger2
         """
         startGrasp = kwargs.get('startGrasp',kwargs.get('grasp'))
         endGrasp = kwargs.get('startGrasp',kwargs.get('grasp'))
@@ -417,37 +595,29 @@ class RavenPlanner:
             endGrasp = startGrasp
         
         grasps = np.linspace(startGrasp, endGrasp, len(jointTrajArray))
-        jointTrajDicts = []
-        for trajIndex in range(len(jointTrajArray)):
-            grasp = grasps[trajIndex]
-            
-            waypointJointPositions = list(jointTrajArray[trajIndex])
-            
-            # since yaw is pseudo-joint, convert to finger1 and finger2
-            yaw = waypointJointPositions[-1]
-            finger1 = yaw - grasp/2
-            finger2 = -(yaw + grasp/2)
-            if armName == MyConstants.Arm.Left:
-                finger1 = -finger1
-                finger2 = -finger2
-            # try keeping yaw
-            waypointJointPositions = waypointJointPositions[:] + [finger1, finger2]
-            rosJointTypesPlusFingers = self.rosJointTypes[:] + [Constants.JOINT_TYPE_GRASP_FINGER1, Constants.JOINT_TYPE_GRASP_FINGER2]
-            
-            waypointDict = dict(zip(rosJointTypesPlusFingers, waypointJointPositions))
-            jointTrajDicts.append(waypointDict)
+        return JointTrajectory.fromYawArray(armName, jointTrajArray, grasps)
+    
+    def jointTrajToDicts(self, armName, jointTrajArray, **kwargs):
+        """
+        Converts a numpy array trajectory
+        to a list of joint dictionaries
 
-        return jointTrajDicts
+        dicts contain ros joints1:
+        shoulder, elbow, insertion,
+        rotation, pitch, finger1, finger2
+        """
+        return self.jointTrajToTrajectory(armName, jointTrajArray, **kwargs).toDicts()
     
     def jointDictsToPoses(self, armName, jointTrajDicts):
         """
-        Converts a list of joint trajectory dicts
-        to a list of poses using openrave FK
+        Converts a list of joint trajectory dicts (or a JointTrajectory)
+        to a list of poses using batch FK
         """
-        poseList = []
-        for jointDict in jointTrajDicts:
-            pose, grasp = kin.fwdArmKin(armName, jointDict)
-            poseList.append(pose)
+        if len(jointTrajDicts) == 0:
+            return []
+        
+        toolTfs, grasps = kin.fwdArmKinBatch(armName, kin.jointDictsToArray(jointTrajDicts))
+        poseList = [tfx.transform(toolTf).as_pose(frame='/0_link') for toolTf in toolTfs]
         
         return poseList
     
@@ -461,100 +631,454 @@ class RavenPlanner:
         return [Util.deltaPose(startPose, pose) for pose in poseList[1:]]
             
     
-    def optimize1(self, n_steps, trajStartJoints, trajEndJoints):
-        msg = TrajoptCall()
+    def armClearance(self, leftJointTraj, rightJointTraj):
+        """
+        Minimum clearance between the arms along the two joint trajectories
+        (lists of joint dicts or JointTrajectories) and the waypoint index
+        """
+        return ArmClearance.minClearance(leftJointTraj, rightJointTraj)
+    
+    def commit(self, armName, jointTraj, duration=None):
+        """
+        Records jointTraj as the trajectory armName is about to execute
+        (None when planning failed, which leaves the arm where it is). It
+        expires COMMIT_MARGIN seconds after duration, by default the time
+        its tool path takes at COMMIT_POSE_SPEED
+        """
+        if jointTraj is None or len(jointTraj) == 0:
+            self.release(armName)
+            return
+        if duration is None:
+            poses, _ = kin.fwdArmKinBatch(armName, jointTraj.joints)
+            duration = np.sum(np.linalg.norm(np.diff(poses[:,:3,3], axis=0), axis=1)) / COMMIT_POSE_SPEED
+        with self.lock:
+            self.committed[armName] = (jointTraj, time.time() + duration + COMMIT_MARGIN)
+    
+    def release(self, armName):
+        """
+        Drops armName's committed trajectory, for executors that stop it,
+        cut it short or don't run it
+        """
+        with self.lock:
+            self.committed.pop(armName, None)
+    
+    def committedTrajectory(self, armName):
+        """
+        The last trajectory handed out for armName, until it expires, is
+        released or the arm is within a waypoint step
+        (Discretization.MAX_JOINT_STEP) of its end. None after that or if
+        there is none
+        """
+        with self.lock:
+            commitment = self.committed.get(armName)
+        if commitment is None:
+            return None
+        jointTraj, expiry = commitment
+        currentJoints = self.getCurrentJoints(armName)
+        if time.time() > expiry or (currentJoints and
+            np.all([abs(currentJoints[k] - jointTraj[-1][k]) <= Discretization.MAX_JOINT_STEP[k] for k in self.rosJointTypes])):
+            with self.lock:
+                if self.committed.get(armName) is commitment:
+                    del self.committed[armName]
+            return None
+        return jointTraj
+    
+    def obstacleJoints(self, armName):
+        """
+        Joints the other arm's decoupled plans see armName at: the end of
+        its committed trajectory, or its current joints
+        """
+        jointTraj = self.committedTrajectory(armName)
+        if jointTraj is not None:
+            return jointTraj[-1]
+        return self.getCurrentJoints(armName) or None
+    
+    def placeObstacleArms(self, armNames):
+        """
+        Sets the arms not in armNames to their obstacleJoints in the model.
+        Call with the lock held
+        """
+        for armName in self.armNames:
+            if armName not in armNames:
+                self.updateOpenraveJoints(armName, self.obstacleJoints(armName))
+    
+    def sweptObstacleClearance(self, armName, jointTraj):
+        """
+        Smallest clearance (capsule model) between any waypoint of jointTraj
+        of armName and the other arm's current joints or any waypoint of its
+        committed trajectory, as the timing of the two is unknown. inf if
+        the other arm's joints are not known
+        """
+        clearance = np.inf
+        joints = kin.jointDictsToArray(jointTraj)
+        for otherArm in self.armNames:
+            if otherArm == armName:
+                continue
+            otherJoints = []
+            currentJoints = self.getCurrentJoints(otherArm)
+            if currentJoints:
+                otherJoints.append(currentJoints.positions)
+            committed = self.committedTrajectory(otherArm)
+            if committed is not None:
+                otherJoints.extend(committed.joints)
+            if not otherJoints:
+                continue
+            clearance = min(clearance, ArmClearance.armSweptClearance(armName, joints, np.array(otherJoints)))
+        return clearance
+    
+    def solveTrajopt(self, request, startJoints, tags=None, clone=False):
+        """
+        Solves a jointRequest of the arms in startJoints (dict of armName to
+        joints) from those joints, the other arms fixed as obstacles.
+        Returns the joint trajectory, whether it passed traj_is_safe, the
+        solve time and the final total cost. tags (arm and caller) are
+        passed to the phase timer
+
+        Without a planner pool the solve holds the lock (and the model)
+        throughout, unless clone, which solves in a copy of the model
+        """
+        tags = tags or {}
+        timer = self.phaseTimer
+        
+        # convert dictionary into json-formatted string
+        with timer.phase('json', **tags):
+            s = json.dumps(request)
+        
+        with self.lock:
+            # trajopt starts from the model's joints, which earlier checks may have moved
+            with timer.phase('update_joints', **tags):
+                for armName, joints in startJoints.iteritems():
+                    self.updateOpenraveJoints(armName, joints)
+                self.placeObstacleArms(startJoints.keys())
+                # the problem's "active" manip is the planned arms
+                self.robot.SetActiveDOFs(np.concatenate([self.manip[armName].GetArmIndices() for armName in sorted(startJoints)]))
+            
+            if self.plannerPool is not None:
+                dofValues = self.robot.GetDOFValues()
+                activeDOFs = self.robot.GetActiveDOFIndices()
+            elif clone:
+                with timer.phase('clone', **tags):
+                    env = self.env.CloneSelf(rave.CloningOptions.Bodies)
+                    activeDOFs = self.robot.GetActiveDOFIndices()
+            else:
+                return self._solveIn(self.env, self.robot, s, tags)
+        
+        if self.plannerPool is None:
+            # the copy is this solve's own, other requests don't wait on it
+            robot = env.GetRobots()[0]
+            robot.SetActiveDOFs(activeDOFs)
+            try:
+                return self._solveIn(env, robot, s, tags)
+            finally:
+                env.Destroy()
+        
+        # the workers' environments are separate, other requests don't wait on this one
+        with timer.phase('pool_solve', **tags):
+            return self.plannerPool.solve(s, activeDOFs, dofValues)
+    
+    def _solveIn(self, env, robot, s, tags):
+        from trajoptpy.check_traj import traj_is_safe
+        timer = self.phaseTimer
+        start = time.time()
+        # create object that stores optimization problem
+        with timer.phase('construct_problem', **tags):
+            prob = trajoptpy.ConstructProblem(s, env)
+        # do optimization
+        with timer.phase('optimize', **tags):
+            result = trajoptpy.OptimizeProblem(prob)
+        solveTime = time.time() - start
+        traj = result.GetTraj()
+        cost = sum(value for _, value in result.GetCosts())
+        
+        # check trajectory safety
+        with timer.phase('traj_is_safe', **tags):
+            prob.SetRobotActiveDOFs()
+            safe = traj_is_safe(traj, robot)
+        return traj, safe, solveTime, cost
+    
+    def solveTrajoptAsync(self, request, startJoints, tags=None):
+        """
+        solveTrajopt on its own thread, in a copy of the model so a caller
+        given a fallback doesn't wait on the lock. Returns the Future of its
+        result. Trajopt can't be stopped, a solve runs to the end even if
+        its result is no longer wanted
+        """
+        future = Future()
+        future.submitTime = time.time()
+        def solve():
+            try:
+                future.setResult(self.solveTrajopt(request, startJoints, tags, clone=True))
+            except Exception as e:
+                future.setException(e)
+        thread = threading.Thread(target=solve)
+        thread.setDaemon(True)
+        thread.start()
+        return future
+    
+    def optimize1(self, requests):
+        """
+        Plans the PlanRequests of all arms together (a dict of armName to
+        request, one arm when decoupled or speculating). Returns a dict of
+        armName to delta pose trajectory, with None for every arm if trajopt
+        failed
+        """
+        planStart = time.time()
+        armNames = sorted(requests.keys())
+        
+        timer = self.phaseTimer
+        callers = sorted(set(request.caller for request in requests.itervalues() if request.caller is not None))
+        tags = {'arm' : '+'.join(armNames), 'caller' : '+'.join(callers) or None}
+        
+        if not self.endsClear(requests):
+            with self.lock:
+                for armName in armNames:
+                    self.poseTraj[armName] = None
+                    self.deltaPoseTraj[armName] = None
+            return dict((armName, None) for armName in armNames)
+        
+        problem = self.trajoptProblem(requests)
+        
+        # earliest deadline of the requests, None if none has one
+        deadlines = [requests[armName].deadline for armName in armNames if requests[armName].deadline is not None]
+        deadline = min(deadlines) if deadlines else None
+        
+        traj, safe, tier, outcome = self._planOnce(requests, problem, deadline, tags)
+        
+        planTime = time.time() - planStart
+        self.tierStats.record(tier, planTime)
+        timer.record('plan', planTime, **tags)
+        rospy.loginfo('Planned by the %s tier in %.3f s' % (tier, planTime))
+        
+        # results of this plan, other optimizer threads may overwrite self.deltaPoseTraj
+        trajectories, jointTrajs, poseTrajs, deltaPoseTrajs = self.planResults(requests, traj, safe, problem, tags)
+        
+        with self.lock:
+            self.trajectory.update(trajectories)
+            self.jointTraj.update(jointTrajs) # for debugging
+            self.poseTraj.update(poseTrajs)
+            self.deltaPoseTraj.update(deltaPoseTrajs)
+        
+        publishStart = time.time()
+        self.publishPlan(problem.msg, trajectories)
+        timer.record('publish', time.time() - publishStart, **tags)
+        timer.record('total', time.time() - planStart, **tags)
+        
+        if deadline is not None:
+            self.recordDeadline(requests, deadline, outcome, planStart, traj, deltaPoseTrajs)
+        
+        return deltaPoseTrajs
+    
+    def endsClear(self, requests):
+        """
+        False if the start or end joints of a two-arm plan are closer than
+        minArmClearance, in which case trajopt is skipped
+        """
+        if self.minArmClearance is None or len(requests) != 2:
+            return True
+        left, right = requests[MyConstants.Arm.Left], requests[MyConstants.Arm.Right]
+        clearance, index = self.armClearance([left.startJoints, left.endJoints],
+                                             [right.startJoints, right.endJoints])
+        if clearance < self.minArmClearance:
+            rospy.loginfo('Arm clearance %.4f at the %s joints, skipping trajopt' % (clearance, ['start','end'][index]))
+            return False
+        return True
+    
+    def trajoptProblem(self, requests):
+        """
+        TrajoptProblem of the requests, with solveSteps from the move when
+        adaptiveSteps is set
+        """
+        n_steps = max(request.n_steps for request in requests.itervalues())
+        problem = TrajoptProblem(sorted(requests), n_steps)
+        
+        msg = problem.msg
         msg.header.stamp = rospy.Time.now()
         msg.header.frame_id = '/0_link'
         
-        startJointPositions = []
-        endJointPositions = []
-        startPoses = []
-        endPoses = []
-        toolFrames = []
-        manips = []
-        approachDirs = []
-        for armName in self.armNames:
-            endJoints = trajEndJoints[armName]
-            if endJoints is None:
-                print trajEndJoints, self.trajRequest
-            endJoints = dict([(jointType,jointPos) for jointType, jointPos in endJoints.items() if jointType in self.rosJointTypes])
-            
-            startJoints = trajStartJoints[armName]
-            startJoints = dict([(jointType,jointPos) for jointType, jointPos in startJoints.items() if jointType in self.rosJointTypes])
+        for armName in problem.armNames:
+            request = requests[armName]
+            startJoints = request.startJoints
+            endJoints = request.endJoints
             
-            print 'start joints %s: %s' % (armName, [startJoints[k] for k in sorted(startJoints.keys())])
-            print 'end joints %s: %s' % (armName, [endJoints[k] for k in sorted(endJoints.keys())])
+            print 'start joints %s: %s' % (armName, [startJoints[k] for k in self.rosJointTypes])
+            print 'end joints %s: %s' % (armName, [endJoints[k] for k in self.rosJointTypes])
             
             for raveJointType in self.manip[armName].GetArmIndices():
                 rosJointType = self.raveJointTypesToRos[armName][raveJointType]
-                endJointPositions.append(endJoints[rosJointType])
-                startJointPositions.append(startJoints[rosJointType])
-            
-            startPoses.append(self.trajStartPose[armName])
-            endPoses.append(self.trajEndPose[armName])
-            toolFrames.append(self.toolFrame[armName])
-            manips.append(self.manip[armName])
-            approachDirs.append(self.approachDir[armName])
+                problem.endJointPositions.append(endJoints[rosJointType])
+                problem.startJointPositions.append(startJoints[rosJointType])
             
-            self.updateOpenraveJoints(armName, trajStartJoints[armName])
+            problem.startPoses.append(request.startPose)
+            problem.endPoses.append(request.endPose)
+            problem.toolFrames.append(self.toolFrame[armName])
+            problem.manips.append(self.manip[armName])
+            problem.approachDirs.append(request.approachDir)
             
             if armName == 'L':
-                msg.start_L = self.trajStartPose[armName]
-                msg.end_L = self.trajEndPose[armName]
+                msg.start_L = request.startPose
+                msg.end_L = request.endPose
             else:
-                msg.start_R = self.trajStartPose[armName]
-                msg.end_R = self.trajEndPose[armName]
-                
-        #request = jointRequest(n_steps, endJointPositions)
-        request = jointRequest(n_steps, endJointPositions, startPoses, endPoses, toolFrames, manips, approachDirs=approachDirs, approachDist=0.03)
-    
-        #IPython.embed()
+                msg.start_R = request.startPose
+                msg.end_R = request.endPose
+        
+        if self.adaptiveSteps:
+            problem.solveSteps = self.solveSteps(requests, problem.startJointPositions, problem.endJointPositions)
+            rospy.loginfo('Solving with %d waypoints for %d' % (problem.solveSteps, n_steps))
+        return problem
     
-        # convert dictionary into json-formatted string
-        s = json.dumps(request)
-        #print s
-        #print self.robot.GetActiveDOFValues()
-        #return
-        # create object that stores optimization problem
-        prob = trajoptpy.ConstructProblem(s, self.env)
-        # do optimization
-        result = trajoptpy.OptimizeProblem(prob)
+    def _planOnce(self, requests, problem, deadline, tags):
+        """
+        The trajectory of the first tier that has one: the trajectory cache,
+        the straight lines (with tiered) and trajopt, against the deadline
+        if there is one. Returns (traj, safe, tier, Anytime outcome)
+        """
+        traj, cacheKey = self.cachedTrajectory(requests, problem.n_steps, tags)
+        if traj is not None:
+            return traj, True, TieredPlanning.CACHE, Anytime.MET
+        
+        # the straight lines can't follow an approach direction
+        if self.tiered and problem.straightLinesAllowed():
+            with self.phaseTimer.phase('straight_line', **tags):
+                traj, tier = self.straightLineTrajectory(requests, problem.endJointPositions, problem.minSolveSteps())
+            if traj is not None:
+                return traj, True, tier, Anytime.MET
+        
+        initTraj = None
+        if self.trajectoryLibrary is not None:
+            initTraj = self.trajectoryLibrary.initTrajectory(problem.startJointPositions, problem.endJointPositions, problem.minSolveSteps())
+        request = problem.jointRequest(initTraj)
+        startJoints = dict((armName, requests[armName].startJoints) for armName in problem.armNames)
+        addSolution = lambda traj: self.addSolution(traj, problem.startJointPositions, problem.endJointPositions, cacheKey)
+        
+        if deadline is None:
+            # speculations may go unused, they don't hold up the real requests
+            solution = self.solveTrajopt(request, startJoints, tags,
+                                         clone=any(planRequest.speculative for planRequest in requests.itervalues()))
+        else:
+            solution, fallback, fallbackTier = self._withDeadline(requests, problem, request, startJoints, initTraj, deadline, addSolution, tags)
+            if solution is None:
+                return fallback, True, fallbackTier, Anytime.FALLBACK
+        
+        traj, safe, _, _ = solution
+        if self.trajectoryLibrary is not None:
+            self.recordWarmStart(problem, request, solution, initTraj, startJoints, deadline, tags)
+        if safe:
+            addSolution(traj)
+        return traj, safe, TieredPlanning.TRAJOPT, Anytime.MET
+    
+    def _withDeadline(self, requests, problem, request, startJoints, initTraj, deadline, addSolution, tags):
+        """
+        Solves the trajopt request in the background after finding the best
+        fallback without it. Returns (solution, None, None) if trajopt is done
+        by the deadline or there is no fallback, else (None, fallback, its
+        tier), with trajopt's result going to the refinement of the requests
+        that ask for it
+        """
+        # found before trajopt takes the model
+        with self.phaseTimer.phase('fallback', **tags):
+            fallback, fallbackTier = self.fallbackTrajectory(requests, problem.endJointPositions, initTraj, problem.minSolveSteps(),
+                                                             lines=not self.tiered and problem.straightLinesAllowed())
+        solve = self.solveTrajoptAsync(request, startJoints, tags)
+        if solve.wait(max(deadline - time.time(), 0.)) or fallback is None:
+            return solve.result(), None, None
         
+        rospy.loginfo('Trajopt not done by the deadline, using the %s trajectory' % fallbackTier)
+        if any(planRequest.refine for planRequest in requests.itervalues()):
+            self.refineLater(requests, solve, fallback, problem.n_steps, tags, addSolution)
+        return None, fallback, fallbackTier
     
-        # check trajectory safety
+    def cachedTrajectory(self, requests, n_steps, tags):
+        """
+        The cached trajectory of the requests if it is still safe, None
+        otherwise, and the cache key. (None, None) without a trajectoryCache
+        """
+        if self.trajectoryCache is None:
+            return None, None
         from trajoptpy.check_traj import traj_is_safe
-        prob.SetRobotActiveDOFs()
-        if not traj_is_safe(result.GetTraj(), self.robot):
+        
+        armNames = sorted(requests)
+        cacheKey = self.trajectoryCache.key(armNames,
+            dict((armName, [requests[armName].startJoints[k] for k in self.rosJointTypes]) for armName in armNames),
+            dict((armName, [requests[armName].endJoints[k] for k in self.rosJointTypes]) for armName in armNames),
+            n_steps, dict((armName, requests[armName].approachDir) for armName in armNames), self.workspace)
+        traj = self.trajectoryCache.get(cacheKey)
+        if traj is None:
+            return None, cacheKey
+        
+        with self.lock, self.phaseTimer.phase('cache_check', **tags):
+            for armName in armNames:
+                self.updateOpenraveJoints(armName, requests[armName].startJoints)
+            self.placeObstacleArms(armNames)
+            # same dofs, in the same order, as the trajopt problem
+            self.robot.SetActiveDOFs(np.concatenate([self.manip[armName].GetArmIndices() for armName in armNames]))
+            safe = traj_is_safe(traj, self.robot)
+        if not safe:
+            rospy.loginfo('Cached trajectory is not safe, replanning')
+            self.trajectoryCache.invalidate(cacheKey)
+            return None, cacheKey
+        rospy.loginfo('Trajectory cache hit, hit rate %.3f' % self.trajectoryCache.hitRate())
+        return traj, cacheKey
+    
+    def recordWarmStart(self, problem, request, solution, initTraj, startJoints, deadline, tags):
+        """
+        Records the solve in the trajectory library's stats. With
+        compareWarmStart, also solves from a straight line to compare
+        """
+        _, _, solveTime, cost = solution
+        stats = self.trajectoryLibrary.stats
+        stats.record(request["init_info"]["type"], solveTime, cost)
+        # a second solve would only make a deadline later
+        if initTraj is not None and self.compareWarmStart and deadline is None:
+            _, _, straightTime, straightCost = self.solveTrajopt(problem.jointRequest(), startJoints, dict(tags, caller='compare_warm_start'))
+            stats.recordComparison(solveTime, straightTime, cost, straightCost)
+            rospy.loginfo('Warm start %.3f s cost %.4f, straight line %.3f s cost %.4f' % (solveTime, cost, straightTime, straightCost))
+    
+    def planResults(self, requests, traj, safe, problem, tags):
+        """
+        Splits traj, resampled to n_steps, into each arm's trajectories and
+        sets the requests' jointTraj. A decoupled plan that passes too close
+        to the other arm is dropped. Returns dicts of armName to Trajectory,
+        JointTrajectory, pose list and delta pose list, None for every arm
+        if traj is not safe
+        """
+        armNames = problem.armNames
+        trajectories = dict((armName, None) for armName in armNames)
+        poseTrajs = dict((armName, None) for armName in armNames)
+        deltaPoseTrajs = dict((armName, None) for armName in armNames)
+        jointTrajs = dict()
+        if not safe:
             rospy.loginfo('Trajopt trajectory is not safe. Trajopt failed!')
-            for armName in self.armNames:
-                self.poseTraj[armName] = None
-                self.deltaPoseTraj[armName] = None
-        else:
-            startIndex = 0
-            for armName in self.armNames:
-                endIndex = startIndex + len(self.manipJoints[armName])
-                
-                graspKwargs = {}
-                if self.trajStartGrasp[armName] is not None:
-                    graspKwargs['startGrasp'] = self.trajStartGrasp[armName]
-                if self.trajEndGrasp[armName] is not None:
-                    graspKwargs['endGrasp'] = self.trajEndGrasp[armName]
-                
-                armJointTrajArray = result.GetTraj()[:,startIndex:endIndex]
-                jointTrajDicts = self.jointTrajToDicts(armName, armJointTrajArray, **graspKwargs)
-                self.jointTraj[armName] = jointTrajDicts # for debugging
-                poseTraj = self.jointDictsToPoses(armName, jointTrajDicts)
-                self.poseTraj[armName] = poseTraj
-                deltaPoseTraj = self.posesToDeltaPoses(poseTraj)
-                self.deltaPoseTraj[armName] = deltaPoseTraj
-                
-                startIndex = endIndex
-                
-                if armName == 'L':
-                    msg.traj_L = [p.msg.Pose() for p in self.poseTraj[armName]]
-                else:
-                    msg.traj_R = [p.msg.Pose() for p in self.poseTraj[armName]]
+            return trajectories, jointTrajs, poseTrajs, deltaPoseTrajs
+        
+        # cached trajectories are stored at the length they were solved
+        # with, which is not n_steps with adaptiveSteps
+        traj = Discretization.resample(traj, max(problem.n_steps, 2))
+        
+        jointTrajs, trajectories = self.splitTrajectory(requests, traj, tags['caller'])
+        for armName in armNames:
+            requests[armName].jointTraj = jointTrajs[armName]
+            poseTrajs[armName] = trajectories[armName].poseList()
+            deltaPoseTrajs[armName] = trajectories[armName].deltaPoseList()
+            
+            if armName == 'L':
+                problem.msg.traj_L = trajectories[armName].poseMsgs()
+            else:
+                problem.msg.traj_R = trajectories[armName].poseMsgs()
         
+        if len(armNames) == 2:
+            clearance, index = self.armClearance(jointTrajs[MyConstants.Arm.Left], jointTrajs[MyConstants.Arm.Right])
+            rospy.loginfo('Arm clearance along the trajectory %.4f at waypoint %d' % (clearance, index))
+        elif not self.clearOfOtherArm(armNames[0], jointTrajs[armNames[0]]):
+            armName = armNames[0]
+            trajectories[armName] = poseTrajs[armName] = deltaPoseTrajs[armName] = None
+            requests[armName].jointTraj = None
+            del jointTrajs[armName]
+        return trajectories, jointTrajs, poseTrajs, deltaPoseTrajs
+    
+    def publishPlan(self, msg, trajectories):
+        """
+        Publishes the TrajoptCall and the waypoints of the trajectories as markers
+        """
         self.trajopt_pub.publish(msg)
         marker = Marker()
         marker.header.frame_id = '/0_link'
@@ -569,137 +1093,478 @@ class RavenPlanner:
         marker.color.r = 0.0
         marker.color.g = 1.0
         marker.color.b = 0.5
-        for arm in self.poseTraj:
-            for p in self.poseTraj[arm]:
-                marker.points.append(p.position.msg.Point())
+        for arm in sorted(trajectories):
+            if trajectories[arm] is not None:
+                marker.points += [Point(*position) for position in trajectories[arm].poses[:,:3,3].tolist()]
         #marker.lifetime = rospy.Duration(1.5)
         self.trajopt_marker_pub.publish(marker)
     
-    def optimize2(self, n_steps):
-        return self.optimize1(n_steps, self.trajStartJoints, self.trajEndJoints)
+    def recordDeadline(self, requests, deadline, outcome, planStart, traj, deltaPoseTrajs):
+        """
+        Records a plan with a deadline in anytimeStats, as its result is
+        handed back, after any wait on the lock
+        """
+        submitTime = min(request.submitTime or planStart for request in requests.itervalues())
+        if time.time() > deadline:
+            outcome = Anytime.LATE
+            rospy.loginfo('Missed the planning deadline by %.3f s' % (time.time() - deadline))
+        returned = any(deltaPoseTraj is not None for deltaPoseTraj in deltaPoseTrajs.itervalues())
+        self.anytimeStats.record(deadline - submitTime, time.time() - submitTime, outcome,
+                                 Anytime.normalizedCost(traj) if returned else None)
     
-    def optimize3(self):
-        n_steps = max(self.trajSteps.values())
-        return self.optimize2(n_steps)
     
-    def optimizeLoop(self, once=False):
-        while not rospy.is_shutdown():
-            rospy.sleep(.05)
+    def splitTrajectory(self, requests, traj, caller=None):
+        """
+        Dicts of armName to JointTrajectory and to Trajectory of the arms of
+        requests, from traj in the trajopt dof order, with the requests'
+        grasps
+        """
+        jointTrajs = dict()
+        trajectories = dict()
+        startIndex = 0
+        for armName in sorted(requests):
+            endIndex = startIndex + len(self.manipJoints[armName])
             
-            # block until all traj submissions received
-            while False in [self.trajRequest.get(armName,False) for armName in self.armNames]:
-                if rospy.is_shutdown():
-                    return
-                rospy.sleep(0.05)
+            graspKwargs = {}
+            if requests[armName].startGrasp is not None:
+                graspKwargs['startGrasp'] = requests[armName].startGrasp
+            if requests[armName].endGrasp is not None:
+                graspKwargs['endGrasp'] = requests[armName].endGrasp
             
-            print "it's go time"
-            self.optimize3()
+            armJointTrajArray = traj[:,startIndex:endIndex]
+            with self.phaseTimer.phase('fk', arm=armName, caller=caller):
+                jointTrajs[armName] = self.jointTrajToTrajectory(armName, armJointTrajArray, **graspKwargs)
+                # the tfx poses are only made when read
+                trajectories[armName] = Trajectory.fromJointTrajectory(jointTrajs[armName], frame=self.refFrame)
             
+            startIndex = endIndex
+        return jointTrajs, trajectories
+    
+    def clearOfOtherArm(self, armName, jointTraj):
+        """
+        False if a decoupled plan of armName comes closer than
+        minArmClearance to the other arm. The other arm was fixed at one
+        configuration, so the plan is checked against everywhere it is or
+        is committed to go
+        """
+        if self.minArmClearance is None or len(self.armNames) != 2:
+            return True
+        clearance = self.sweptObstacleClearance(armName, jointTraj)
+        rospy.loginfo('Swept clearance from the other arm %.4f' % clearance)
+        if clearance < self.minArmClearance:
+            rospy.loginfo('Trajectory of %s passes too close to the other arm. Planning failed!' % armName)
+            return False
+        return True
+    
+    def addSolution(self, traj, startJointPositions, endJointPositions, cacheKey=None):
+        """
+        Adds a safe trajopt solution to the trajectory library and cache
+        """
+        if self.trajectoryLibrary is not None:
+            self.trajectoryLibrary.add(startJointPositions, endJointPositions, traj)
+        if cacheKey is not None and self.trajectoryCache is not None:
+            self.trajectoryCache.put(cacheKey, traj)
+    
+    def fallbackTrajectory(self, requests, endJointPositions, initTraj, n_steps, lines=True):
+        """
+        The best (by Anytime.normalizedCost) feasible trajectory available
+        without trajopt, from the trajectory library's warm start and (with
+        lines) the straight lines. Returns (traj, tier) or (None, None)
+        """
+        candidates = []
+        if initTraj is not None:
+            armNames = sorted(requests)
             with self.lock:
-                for armName in self.armNames:
-                    self.trajRequest[armName] = False
+                for armName in armNames:
+                    self.updateOpenraveJoints(armName, requests[armName].startJoints)
+                self.placeObstacleArms(armNames)
+                # same dofs, in the same order, as the trajopt problem
+                self.robot.SetActiveDOFs(np.concatenate([self.manip[armName].GetArmIndices() for armName in armNames]))
+                if TieredPlanning.checkTrajectory(self.env, self.robot, initTraj):
+                    candidates.append((np.asarray(initTraj), Anytime.WARM_START))
+        if lines:
+            traj, tier = self.straightLineTrajectory(requests, endJointPositions, n_steps)
+            if traj is not None:
+                candidates.append((traj, tier))
+        if not candidates:
+            return None, None
+        return min(candidates, key=lambda candidate: Anytime.normalizedCost(candidate[0]))
+    
+    def refineLater(self, requests, solve, fallback, n_steps, tags, addSolution):
+        """
+        Once the solve Future of requests (answered with fallback at their
+        deadline) is done, sets each request's refinement Future to its
+        delta pose trajectory (None if trajopt failed) and adds the solution
+        with addSolution(traj)
+        """
+        for request in requests.itervalues():
+            request.refinement = Future()
+        
+        def refine():
+            try:
+                traj, safe, _, _ = solve.result()
+                if not safe:
+                    rospy.loginfo('Refinement is not safe')
+                    for request in requests.itervalues():
+                        request.refinement.setResult(None)
+                    return
+                addSolution(traj)
+                self.anytimeStats.recordRefinement(Anytime.normalizedCost(fallback), Anytime.normalizedCost(traj))
+                traj = Discretization.resample(traj, max(n_steps, 2))
+                jointTrajs, trajectories = self.splitTrajectory(requests, traj, tags['caller'])
+                rospy.loginfo('Refined trajectory ready %.3f s after submission' % (time.time() - solve.submitTime))
+                for armName, request in requests.iteritems():
+                    request.refinement.jointTraj = jointTrajs[armName]
+                    if len(requests) == 1 and not self.clearOfOtherArm(armName, jointTrajs[armName]):
+                        request.refinement.setResult(None)
+                    else:
+                        request.refinement.setResult(trajectories[armName].deltaPoseList())
+            except Exception as e:
+                rospy.logerr('Refinement failed: %s' % e)
+                for request in requests.itervalues():
+                    request.refinement.setException(e)
+        
+        thread = threading.Thread(target=refine)
+        thread.setDaemon(True)
+        thread.start()
+    
+    def solveSteps(self, requests, startJointPositions, endJointPositions):
+        """
+        Number of trajopt waypoints for the requests from the joint distance,
+        the tool rotation and the clearance of the start and end tool
+        positions from the workspace bodies. The joint positions are those of
+        the trajopt problem, in GetArmIndices order of the sorted arms
+        """
+        maxJointStep = [Discretization.MAX_JOINT_STEP[self.raveJointTypesToRos[armName][raveJointType]]
+                        for armName in sorted(requests) for raveJointType in self.manip[armName].GetArmIndices()]
+        rotation = max(Discretization.rotationAngle(np.array(requests[armName].startPose.matrix), np.array(requests[armName].endPose.matrix))
+                       for armName in requests)
+        with self.lock:
+            toolPositions = []
+            for armName in sorted(requests):
+                for joints in (requests[armName].startJoints, requests[armName].endJoints):
+                    self.updateOpenraveJoints(armName, joints)
+                    toolPositions.append(self.robot.GetLink(self.toolFrame[armName]).GetTransform()[:3,3])
+            clearance = Discretization.workspaceClearance(self.env, self.robot, toolPositions)
+        return Discretization.adaptiveSteps(startJointPositions, endJointPositions, maxJointStep, rotation, clearance)
+    
+    def straightLineTrajectory(self, requests, endJointPositions, n_steps):
+        """
+        The joint space, then Cartesian, straight line from the start to the
+        end joints of the requests, if it is within the joint limits and
+        collision free. Returns (traj, tier) or (None, None)
+        """
+        armNames = sorted(requests)
+        with self.lock:
+            for armName in armNames:
+                self.updateOpenraveJoints(armName, requests[armName].startJoints)
+            self.placeObstacleArms(armNames)
+            # same dofs, in the same order, as the trajopt problem
+            self.robot.SetActiveDOFs(np.concatenate([self.manip[armName].GetArmIndices() for armName in armNames]))
+            
+            traj = TieredPlanning.interpolateJoints(self.robot.GetActiveDOFValues(), endJointPositions, n_steps)
+            if TieredPlanning.checkTrajectory(self.env, self.robot, traj):
+                return traj, TieredPlanning.JOINT_LINE
+            
+            traj = self.cartesianTrajectory(requests, n_steps)
+            if traj is not None and TieredPlanning.checkTrajectory(self.env, self.robot, traj):
+                return traj, TieredPlanning.CARTESIAN_LINE
+        return None, None
+    
+    def cartesianTrajectory(self, requests, n_steps):
+        """
+        (n_steps, dofs) Cartesian straight line of every arm in the trajopt
+        dof order, None if a waypoint has no ik
+        """
+        columns = []
+        for armName in sorted(requests):
+            request = requests[armName]
+            startGrasp = request.startGrasp if request.startGrasp is not None else 0
+            try:
+                jointTrajDicts, _ = cartesianPathIK(armName, np.array(request.startPose.matrix), np.array(request.endPose.matrix),
+                                                    startGrasp, request.endGrasp, n_steps=n_steps, seedJoints=request.startJoints)
+            except CartesianPathError:
+                return None
+            jointTraj = JointTrajectory.fromDicts(armName, jointTrajDicts)
+            for raveJointType in self.manip[armName].GetArmIndices():
+                columns.append(jointTraj.column(self.raveJointTypesToRos[armName][raveJointType]))
+        return np.array(columns).T
+    
+    def optimizeLoop(self, once=False):
+        while not rospy.is_shutdown():
+            # wakes as soon as every arm (decoupled, any free arm) has a request
+            requests = self.planQueue.take()
+            if requests is None:
+                return
+            
+            print "it's go time"
+            try:
+                results = self.optimize1(requests)
+                for armName, request in requests.iteritems():
+                    self.commit(armName, request.jointTraj)
+                    request.setResult(results[armName])
+            except Exception as e:
+                rospy.logerr('Planning failed: %s' % e)
+                for request in requests.itervalues():
+                    request.setException(e)
+            finally:
+                self.planQueue.taskDone(requests)
             
             if once:
                 break
     
-    def setStartAndEndJoints(self, armName, startJoints, endJoints, **kwargs):
-        self.trajStartGrasp[armName] = kwargs.get('startGrasp',kwargs.get('grasp',None))
-        self.trajEndGrasp[armName] = kwargs.get('endGrasp',kwargs.get('grasp',None))
-        self.trajStartJoints[armName] = startJoints
-        self.trajEndJoints[armName] = endJoints
+    def _poseFromJoints(self, armName, joints):
+        pose, _ = kin.fwdArmKin(armName, joints)
+        return pose
     
-    def setStartJointsAndEndPose(self, armName, startJoints, endPose,**kwargs):
+    def requestFromJoints(self, armName, startJoints, endJoints, n_steps=50, approachDir=None, **kwargs):
+        """
+        PlanRequest between two joint configurations, not yet submitted
+        """
+        return PlanRequest(armName, startJoints, endJoints,
+                           startPose=self._poseFromJoints(armName, startJoints),
+                           endPose=self._poseFromJoints(armName, endJoints),
+                           startGrasp=kwargs.get('startGrasp',kwargs.get('grasp',None)),
+                           endGrasp=kwargs.get('endGrasp',kwargs.get('grasp',None)),
+                           n_steps=n_steps, approachDir=approachDir)
+    
+    def requestFromStartJointsAndEndPose(self, armName, startJoints, endPose, n_steps=50, approachDir=None, **kwargs):
         startGrasp = kwargs.get('startGrasp',kwargs.get('grasp',0))
         endGrasp = kwargs.get('endGrasp',kwargs.get('grasp',0))
-        endJoints = self.getJointsFromPose(armName, endPose, grasp=endGrasp)
+        endJoints = self.getJointsFromPose(armName, endPose, grasp=endGrasp, seedJoints=startJoints)
         
-        self.trajStartGrasp[armName] = startGrasp
-        self.trajEndGrasp[armName] = endGrasp
         endPose = Util.convertToFrame(tfx.pose(endPose), MyConstants.Frames.Link0)
-        self.trajStartJoints[armName] = startJoints
-        self.trajEndJoints[armName] = endJoints
+        return PlanRequest(armName, startJoints, endJoints,
+                           startPose=self._poseFromJoints(armName, startJoints), endPose=endPose,
+                           startGrasp=startGrasp, endGrasp=endGrasp, n_steps=n_steps, approachDir=approachDir)
     
-    def setStartPoseAndEndJoints(self, armName, startPose, endJoints, **kwargs):
+    def requestFromStartPoseAndEndJoints(self, armName, startPose, endJoints, n_steps=50, approachDir=None, **kwargs):
         startGrasp = kwargs.get('startGrasp',kwargs.get('grasp',0))
         endGrasp = kwargs.get('endGrasp',kwargs.get('grasp',0))
-        startJoints = self.getJointsFromPose(armName, startPose, grasp=startGrasp)
+        startJoints = self.getJointsFromPose(armName, startPose, grasp=startGrasp, seedJoints=endJoints)
         
-        self.trajStartGrasp[armName] = startGrasp
-        self.trajEndGrasp[armName] = endGrasp
         startPose = Util.convertToFrame(tfx.pose(startPose), MyConstants.Frames.Link0)
-        self.trajStartJoints[armName] = startJoints
-        self.trajEndJoints[armName] = endJoints
+        return PlanRequest(armName, startJoints, endJoints,
+                           startPose=startPose, endPose=self._poseFromJoints(armName, endJoints),
+                           startGrasp=startGrasp, endGrasp=endGrasp, n_steps=n_steps, approachDir=approachDir)
     
-    def setStartAndEndPose(self, armName, startPose, endPose, **kwargs):
+    def requestFromPoses(self, armName, startPose, endPose, n_steps=50, approachDir=None, quiet=False, **kwargs):
+        """
+        PlanRequest between two poses, not yet submitted. With quiet, a
+        failed ik leaves its joints None instead of raising
+        """
         startGrasp = kwargs.get('startGrasp',kwargs.get('grasp',0))
         endGrasp = kwargs.get('endGrasp',kwargs.get('grasp',0))
-        startJoints = self.getJointsFromPose(armName, startPose, grasp=startGrasp)
-        endJoints = self.getJointsFromPose(armName, endPose, grasp=endGrasp)
+        # start closest to the current joints, end closest to the start
+        startJoints = self.getJointsFromPose(armName, startPose, grasp=startGrasp, quiet=quiet)
+        endJoints = self.getJointsFromPose(armName, endPose, grasp=endGrasp, quiet=quiet, seedJoints=startJoints)
         
-        self.trajStartGrasp[armName] = startGrasp
-        self.trajEndGrasp[armName] = endGrasp
         startPose = Util.convertToFrame(tfx.pose(startPose), MyConstants.Frames.Link0)
-        self.trajStartPose[armName] = startPose
         endPose = Util.convertToFrame(tfx.pose(endPose), MyConstants.Frames.Link0)
-        self.trajEndPose[armName] = endPose
-        self.trajStartJoints[armName] = startJoints
-        self.trajEndJoints[armName] = endJoints
+        return PlanRequest(armName, startJoints, endJoints, startPose=startPose, endPose=endPose,
+                           startGrasp=startGrasp, endGrasp=endGrasp, n_steps=n_steps, approachDir=approachDir)
+    
+    def submit(self, request):
+        """
+        Queues a PlanRequest for the optimizer thread and returns it as the
+        future of the delta pose trajectory
+        """
+        if request.caller is None and self.phaseTimer.enabled:
+            request.caller = callerName()
+        if request.deadline is None and self.planBudget is not None:
+            request.deadline = time.time() + self.planBudget
+        return self.planQueue.submit(request)
     
     def getTrajectoryJointsToPose(self, armName, endPose, startJoints=None, n_steps=50, debug=False, **kwargs):
-        self.setStartJointsAndEndPose(armName, startJoints, endPose, **kwargs)
-        self.trajSteps[armName] = n_steps
-        with self.lock:
-            self.trajRequest[armName] = True
-        if self.trajEndJoints[armName] is None:
-            print armName, endPose, startJoints, kwargs
-            raise Exception()
+        """
+        Submits a trajectory from startJoints (default current joints) to
+        endPose and returns its PlanRequest
+        """
+        if startJoints is None:
+            self.waitForState()
+            startJoints = self.getCurrentJoints(armName)
+        return self.submit(self.requestFromStartJointsAndEndPose(armName, startJoints, endPose, n_steps=n_steps, **kwargs))
     
     def getTrajectoryPoseToPose(self, armName, startPose, endPose, n_steps=50, **kwargs):
-        self.setStartAndEndPose(armName, startPose, endPose, **kwargs)
-        self.trajSteps[armName] = n_steps
-        with self.lock:
-            self.trajRequest[armName] = True
-        if self.trajEndJoints[armName] is None:
-            print armName, startPose, endPose, kwargs
-            raise Exception() 
+        """
+        Submits a trajectory from startPose to endPose and returns its PlanRequest
+        """
+        return self.submit(self.requestFromPoses(armName, startPose, endPose, n_steps=n_steps, **kwargs))
     
-    def getTrajectoryFromPose(self, armName, endPose, startPose=None, endGrasp = None, n_steps=50, block=True, approachDir=None):
+    def getCorrectionTrajectory(self, armName, endPose, endGrasp=None, n_steps=10):
+        """
+        Resolved-rate trajectory from the current joints to endPose, for
+        corrections under correctionThreshold. Returns the delta pose
+        trajectory (as getTrajectoryFromPose does) or None if the move is
+        too large or the solver fails, in which case trajopt should be used
+        """
+        self.waitForState()
+        startJoints = self.getCurrentJoints(armName)
+        endPose = Util.convertToFrame(tfx.pose(endPose), self.refFrame)
+        
+        startPose, _ = kin.fwdArmKin(armName, startJoints)
+        deltaPose = tfx.pose(Util.deltaPose(startPose, endPose))
+        if deltaPose.position.norm > self.correctionThreshold:
+            return None
+        if np.linalg.norm(DifferentialKinematics.rotationToAxisAngle(np.array(deltaPose.orientation.matrix))) > self.correctionRotThreshold:
+            return None
+        
+        result = DifferentialKinematics.resolvedRateTrajectory(armName, startJoints, np.array(endPose.matrix),
+                                                               n_steps=n_steps, endGrasp=endGrasp)
+        if result is None:
+            rospy.loginfo('Resolved-rate correction failed, falling back to trajopt')
+            return None
+        jointTrajDicts, toolTfs = result
+        
+        jointTraj = JointTrajectory.fromDicts(armName, jointTrajDicts)
+        trajectory = Trajectory(armName, jointTraj.joints, jointTraj.grasps, toolTfs, frame=self.refFrame)
+        with self.lock:
+            self.trajectory[armName] = trajectory
+            self.jointTraj[armName] = jointTraj
+            self.poseTraj[armName] = trajectory.poseList()
+            self.deltaPoseTraj[armName] = trajectory.deltaPoseList()
+        self.commit(armName, jointTraj)
+        return self.deltaPoseTraj[armName]
+    
+    def getCartesianTrajectoryFromPose(self, armName, endPose, startPose=None, endGrasp=None, n_steps=None, stepsPerMeter=200):
+        """
+        Straight-line trajectory from startPose (default current pose) to endPose
+        solved with the batch IK, without trajopt or collision checking.
+        Returns the delta pose trajectory like getTrajectoryFromPose, or None
+        if a waypoint has no ik solution
+        """
         self.waitForState()
-        joints1 = self.getCurrentJoints(armName)
+        seedJoints = self.getCurrentJoints(armName)
         if startPose is None:
             startPose = self.getCurrentPose(armName)
+        startPose = Util.convertToFrame(tfx.pose(startPose), self.refFrame)
+        endPose = Util.convertToFrame(tfx.pose(endPose), self.refFrame)
         startGrasp = self.getCurrentGrasp(armName)
         if endGrasp is None:
             endGrasp = startGrasp
-        self.setStartAndEndPose(armName, startPose, endPose, startGrasp=startGrasp, endGrasp=endGrasp)
-        self.trajSteps[armName] = n_steps
+        
+        try:
+            jointTrajDicts, toolTfs = cartesianPathIK(armName, np.array(startPose.matrix), np.array(endPose.matrix),
+                                                      startGrasp, endGrasp, n_steps=n_steps, stepsPerMeter=stepsPerMeter,
+                                                      seedJoints=seedJoints)
+        except CartesianPathError as e:
+            rospy.loginfo('Cartesian path failed: %s' % e)
+            return None
+        
+        jointTraj = JointTrajectory.fromDicts(armName, jointTrajDicts)
+        trajectory = Trajectory(armName, jointTraj.joints, jointTraj.grasps, toolTfs, frame=self.refFrame)
         with self.lock:
-            self.trajRequest[armName] = True
-        if self.trajEndJoints[armName] is None:
-            print armName, startPose, startGrasp, endPose, endGrasp
-            raise Exception()
+            self.trajectory[armName] = trajectory
+            self.jointTraj[armName] = jointTraj
+            self.poseTraj[armName] = trajectory.poseList()
+            self.deltaPoseTraj[armName] = trajectory.deltaPoseList()
+        self.commit(armName, jointTraj)
+        return self.deltaPoseTraj[armName]
+    
+    def getTrajectoryFromPose(self, armName, endPose, startPose=None, endGrasp = None, n_steps=50, block=True, approachDir=None, timeout=None,
+                              deadline=None, refine=False):
+        """
+        Plans from startPose (default current pose) to endPose. With block,
+        waits up to timeout seconds (forever if None) and returns the delta
+        pose trajectory, None if trajopt failed. Raises PlanTimeoutError on
+        timeout. Without block, returns the PlanRequest to wait on
+
+        deadline (a time.time(), default planBudget after submission) gets
+        the best fallback if trajopt isn't done by then. With refine, the
+        refinement Future of the PlanRequest (returned without block) gets
+        trajopt's result once it is done
+        """
+        self.waitForState()
+        timer = self.phaseTimer
+        caller = callerName() if timer.enabled else None
+        if startPose is None and approachDir is None and self.correctionThreshold > 0:
+            with timer.phase('correction', arm=armName, caller=caller):
+                deltaPoseTraj = self.getCorrectionTrajectory(armName, endPose, endGrasp=endGrasp, n_steps=n_steps)
+            if deltaPoseTraj is not None:
+                return deltaPoseTraj
+        
+        if startPose is None:
+            startPose = self.getCurrentPose(armName)
+        startGrasp = self.getCurrentGrasp(armName)
+        if endGrasp is None:
+            endGrasp = startGrasp
+        with timer.phase('ik', arm=armName, caller=caller):
+            request = self.requestFromPoses(armName, startPose, endPose, n_steps=n_steps, approachDir=approachDir,
+                                            startGrasp=startGrasp, endGrasp=endGrasp)
+        request.caller = caller
+        request.deadline = deadline
+        request.refine = refine
+        
+        self.start_pose_pubs[armName].publish(request.startPose.msg.PoseStamped())
+        self.end_pose_pubs[armName].publish(request.endPose.msg.PoseStamped())
         
-        self.approachDir[armName] = approachDir
+        if block and self.speculator is not None and request.startJoints is not None and request.endJoints is not None:
+            with timer.phase('speculation_wait', arm=armName, caller=caller):
+                deltaPoseTraj = self.speculator.use(request, timeout)
+            if deltaPoseTraj is not None:
+                rospy.loginfo('Using speculative trajectory for arm %s' % armName)
+                self.commit(armName, request.jointTraj)
+                return deltaPoseTraj
         
-        self.start_pose_pubs[armName].publish(startPose.msg.PoseStamped())
-        self.end_pose_pubs[armName].publish(endPose.msg.PoseStamped())
+        self.submit(request)
+        if not block:
+            return request
         
-        if block:
-            print 'waiting for arm {} traj'.format(armName)
-            while self.trajRequest[armName] and not rospy.is_shutdown():
-                rospy.sleep(0.05)
-             
-            return self.deltaPoseTraj[armName]   
-            #return self.poseTraj[armName]
+        print 'waiting for arm {} traj'.format(armName)
+        with timer.phase('wait', arm=armName, caller=caller):
+            return request.result(timeout)
         
     getPoseTrajectory = getTrajectoryFromPose
     
+    def speculate(self, armName, startPose, endPose, grasp=None, n_steps=50, approachDir=None):
+        """
+        Plans startPose (the predicted end of the trajectory being executed)
+        to endPose in the background. A later getTrajectoryFromPose whose
+        start and end joints are within tolerance returns this plan instead.
+        Returns the PlanRequest, None if not speculating or there is no ik
+        """
+        if self.speculator is None:
+            return None
+        if grasp is None:
+            grasp = self.getCurrentGrasp(armName)
+        request = self.requestFromPoses(armName, startPose, endPose, n_steps=n_steps, approachDir=approachDir,
+                                        startGrasp=grasp, endGrasp=grasp, quiet=True)
+        if request.startJoints is None or request.endJoints is None:
+            return None
+        request.caller = 'speculation'
+        request.speculative = True
+        return self.speculator.speculate(request)
+    
+    def getSpeculativeTrajectory(self, armName, endPose, startPose=None, endGrasp=None, n_steps=50, approachDir=None, timeout=None):
+        """
+        The delta pose trajectory of the speculation matching the move from
+        startPose (default current pose) to endPose, as getTrajectoryFromPose
+        would use it, waiting up to timeout seconds for it. None if there is
+        none or it failed, without planning anything
+        """
+        if self.speculator is None:
+            return None
+        self.waitForState()
+        if startPose is None:
+            startPose = self.getCurrentPose(armName)
+        startGrasp = self.getCurrentGrasp(armName)
+        if endGrasp is None:
+            endGrasp = startGrasp
+        request = self.requestFromPoses(armName, startPose, endPose, n_steps=n_steps, approachDir=approachDir,
+                                        startGrasp=startGrasp, endGrasp=endGrasp, quiet=True)
+        if request.startJoints is None or request.endJoints is None:
+            return None
+        deltaPoseTraj = self.speculator.use(request, timeout)
+        if deltaPoseTraj is not None:
+            rospy.loginfo('Using speculative trajectory for arm %s' % armName)
+            self.commit(armName, request.jointTraj)
+        return deltaPoseTraj
+    
     def trajReady(self):
-        return not any(self.trajRequest.values())
+        return self.planQueue.idle()
     
-    def waitForTrajReady(self):
-        while not self.trajReady() and not rospy.is_shutdown():
-            rospy.sleep(.05)
+    def waitForTrajReady(self, timeout=None):
+        return self.planQueue.waitIdle(timeout)
 
 def testSwitchPlaces(show=True):
     #trajoptpy.SetInteractive(True)
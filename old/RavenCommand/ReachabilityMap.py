@@ -0,0 +1,191 @@
+"""
+Voxelized workspace reachability of one arm, swept with the batch IK
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+import rospy
+
+import numpy as np
+import tfx
+
+import RavenDebridement.RavenCommand.kinematics as kin
+
+JOINT_MIN_LIMITS = np.array([kin.SHOULDER_MIN_LIMIT, kin.ELBOW_MIN_LIMIT, kin.Z_INS_MIN_LIMIT, kin.TOOL_ROLL_MIN_LIMIT,
+                             kin.TOOL_WRIST_MIN_LIMIT, kin.TOOL_GRASP1_MIN_LIMIT, kin.TOOL_GRASP2_MIN_LIMIT])
+JOINT_MAX_LIMITS = np.array([kin.SHOULDER_MAX_LIMIT, kin.ELBOW_MAX_LIMIT, kin.Z_INS_MAX_LIMIT, kin.TOOL_ROLL_MAX_LIMIT,
+                             kin.TOOL_WRIST_MAX_LIMIT, kin.TOOL_GRASP1_MAX_LIMIT, kin.TOOL_GRASP2_MAX_LIMIT])
+
+# default sweep volume in '/0_link', covers the foam tray for both arms
+DEFAULT_LOWER = (-.20, -.10, -.20)
+DEFAULT_UPPER = ( .06,  .06, -.02)
+
+def jointLimitMargin(joints):
+    """
+    Smallest distance to a joint limit of each row of an (N,7) joint
+    array, as a fraction of that joint's range. Negative when outside
+    the limits, -1 where there is no solution
+    """
+    joints = np.asarray(joints, dtype=float)
+    jointRange = JOINT_MAX_LIMITS - JOINT_MIN_LIMITS
+    with np.errstate(invalid='ignore'):
+        margin = np.minimum(joints - JOINT_MIN_LIMITS, JOINT_MAX_LIMITS - joints) / jointRange
+        margin = margin.min(axis=-1)
+    margin[np.isnan(margin)] = -1.
+    return np.clip(margin, -1., 1.)
+
+class ReachabilityMap(object):
+    """
+    margin is an (nx,ny,nz,K) grid holding, for the voxel centers
+    origin + index*resolution and each of the K tool orientations,
+    the joint limit margin of the ik solution (see jointLimitMargin).
+    Voxels that are not reachable hold a negative margin
+    """
+    def __init__(self, armId, origin, resolution, orientations, grasp, margin):
+        self.armId = armId
+        self.origin = np.asarray(origin, dtype=float)
+        self.resolution = float(resolution)
+        self.orientations = np.asarray(orientations, dtype=float).reshape(-1,3,3)
+        self.grasp = float(grasp)
+        self.margin = margin
+
+        self.shape = np.array(margin.shape[:3])
+        self.orientationTolerance = 1e-3
+        self.graspTolerance = 1e-3
+
+    @classmethod
+    def build(cls, armId, lower=DEFAULT_LOWER, upper=DEFAULT_UPPER, resolution=.005,
+              orientations=(tfx.tb_angles(-90,90,0),), grasp=np.pi/4, chunkSize=100000):
+        """
+        Sweeps the box [lower,upper] with the batch IK for each orientation
+        """
+        lower = np.asarray(lower, dtype=float)
+        upper = np.asarray(upper, dtype=float)
+        shape = tuple((np.floor((upper - lower) / resolution) + 1).astype(int))
+        rotations = np.array([tfx.rotation(orientation).matrix for orientation in orientations], dtype=float).reshape(-1,3,3)
+
+        indices = np.indices(shape).reshape(3,-1).T
+        positions = lower + indices * resolution
+
+        margin = np.empty(shape + (len(rotations),), dtype=np.float32)
+        for k, rotation in enumerate(rotations):
+            voxelMargin = np.empty(len(positions))
+            for start in xrange(0, len(positions), chunkSize):
+                chunk = positions[start:start+chunkSize]
+                poses = np.tile(np.eye(4), (len(chunk),1,1))
+                poses[:,:3,:3] = rotation
+                poses[:,:3,3] = chunk
+                joints, valid, branch, limits = kin.invArmKinBatch(armId, poses, grasp)
+                chunkMargin = jointLimitMargin(joints)
+                # valid solutions on a limit still count as reachable
+                chunkMargin[valid] = np.maximum(chunkMargin[valid], 0.)
+                chunkMargin[~valid] = np.minimum(chunkMargin[~valid], -1e-3)
+                voxelMargin[start:start+chunkSize] = chunkMargin
+            margin[...,k] = voxelMargin.reshape(shape)
+
+        return cls(armId, lower, resolution, rotations, grasp, margin)
+
+    def save(self, prefix):
+        """
+        Writes prefix.npz with the grid parameters and prefix_margin.npy,
+        which load() memory-maps
+        """
+        np.savez(prefix + '.npz', armId=self.armId, origin=self.origin, resolution=self.resolution,
+                 orientations=self.orientations, grasp=self.grasp)
+        np.save(prefix + '_margin.npy', np.asarray(self.margin, dtype=np.float32))
+
+    @classmethod
+    def load(cls, prefix, mmap=True):
+        params = np.load(prefix + '.npz')
+        margin = np.load(prefix + '_margin.npy', mmap_mode='r' if mmap else None)
+        return cls(str(params['armId']), params['origin'], float(params['resolution']),
+                   params['orientations'], float(params['grasp']), margin)
+
+    def orientationIndex(self, rotation):
+        """
+        Index of the stored orientation matching the 3x3 rotation, or None
+        """
+        err = np.abs(self.orientations - np.asarray(rotation, dtype=float)).reshape(len(self.orientations),-1).max(axis=1)
+        k = int(np.argmin(err))
+        if err[k] > self.orientationTolerance:
+            return None
+        return k
+
+    def _cell(self, position):
+        """
+        Lower corner index and fractional offset of the cell containing position,
+        or None if the cell is not inside the grid
+        """
+        offset = (np.asarray(position, dtype=float) - self.origin) / self.resolution
+        index = np.floor(offset).astype(int)
+        if np.any(index < 0) or np.any(index + 1 >= self.shape):
+            return None
+        return index, offset - index
+
+    def lookup(self, position, orientationIndex=0):
+        """
+        Margin of the nearest voxel, or None outside the grid
+        """
+        index = np.round((np.asarray(position, dtype=float) - self.origin) / self.resolution).astype(int)
+        if np.any(index < 0) or np.any(index >= self.shape):
+            return None
+        return float(self.margin[index[0],index[1],index[2],orientationIndex])
+
+    def interpolate(self, position, orientationIndex=0):
+        """
+        Trilinear interpolation of the margin, or None outside the grid
+        """
+        cell = self._cell(position)
+        if cell is None:
+            return None
+        (i, j, k), (fx, fy, fz) = cell
+        c = np.asarray(self.margin[i:i+2,j:j+2,k:k+2,orientationIndex], dtype=float)
+        c = c[0]*(1-fx) + c[1]*fx
+        c = c[0]*(1-fy) + c[1]*fy
+        return float(c[0]*(1-fz) + c[1]*fz)
+
+    def isReachable(self, pose, grasp=None):
+        """
+        True if all eight voxels around the pose are reachable, False if none
+        are, and None when the pose is near the boundary, outside the grid,
+        or at an orientation/grasp the map was not built for. Callers should
+        fall back to exact ik on None
+        """
+        if grasp is not None and abs(grasp - self.grasp) > self.graspTolerance:
+            return None
+        pose = tfx.pose(pose)
+        matrix = np.asarray(pose.matrix, dtype=float)
+        orientationIndex = self.orientationIndex(matrix[:3,:3])
+        if orientationIndex is None:
+            return None
+        cell = self._cell(matrix[:3,3])
+        if cell is None:
+            return None
+        (i, j, k), _ = cell
+        corners = self.margin[i:i+2,j:j+2,k:k+2,orientationIndex]
+        if corners.min() > 0:
+            return True
+        if corners.max() < 0:
+            return False
+        return None
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Builds the reachability map for an arm')
+    parser.add_argument('arm',choices=[kin.GOLD_ARM_ID,kin.GREEN_ARM_ID])
+    parser.add_argument('prefix',help='writes prefix.npz and prefix_margin.npy')
+    parser.add_argument('--lower',type=float,nargs=3,default=DEFAULT_LOWER)
+    parser.add_argument('--upper',type=float,nargs=3,default=DEFAULT_UPPER)
+    parser.add_argument('--resolution',type=float,default=.005)
+    parser.add_argument('--grasp',type=float,default=np.pi/4)
+    args = parser.parse_args(rospy.myargv()[1:])
+
+    reachabilityMap = ReachabilityMap.build(args.arm, lower=args.lower, upper=args.upper,
+                                            resolution=args.resolution, grasp=args.grasp)
+    reachabilityMap.save(args.prefix)
+
+    margin = np.asarray(reachabilityMap.margin)
+    print 'arm %s: %s voxels, %.1f%% reachable' % (args.arm, margin.shape, 100. * (margin > 0).mean())
+
+if __name__ == '__main__':
+    main()
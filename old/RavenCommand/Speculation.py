@@ -0,0 +1,228 @@
+"""
+Speculative planning of the next trajectory from the predicted end of the
+one being executed, reused when the real request starts close enough
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import threading
+import collections
+import time
+
+import numpy as np
+
+# how far the real start and end joints may be from the speculative ones
+# (shoulder, elbow, insertion, rotation, pitch, yaw), insertion in meters
+JOINT_TOLERANCE = np.array([.01, .01, .001, .02, .02, .02])
+
+class SpeculationStats(object):
+    """
+    Hits and misses of real requests, and the planning time saved by the
+    hits (the speculative planning time minus the time waited for it),
+    totalled per piece with markPiece(). Speculations dropped without being
+    used are counted with the planning time they took
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.unused = 0
+        self.wastedTime = 0.
+        self.savedTimes = []
+        self.pieceSavings = []
+        self._pieceSaved = 0.
+
+    def recordHit(self, planTime, waitTime):
+        with self.lock:
+            saved = max(planTime - waitTime, 0.)
+            self.hits += 1
+            self.savedTimes.append(saved)
+            self._pieceSaved += saved
+
+    def recordMiss(self):
+        with self.lock:
+            self.misses += 1
+
+    def recordFailure(self):
+        """
+        A matching speculation that failed, so the request was planned again
+        """
+        with self.lock:
+            self.failures += 1
+
+    def recordUnused(self, planTime):
+        """
+        A speculation dropped without a request using it, planTime the time
+        spent planning it (0 if it never started)
+        """
+        with self.lock:
+            self.unused += 1
+            self.wastedTime += planTime
+
+    def markPiece(self):
+        """
+        Ends a piece, returns the time saved since the last call
+        """
+        with self.lock:
+            saved, self._pieceSaved = self._pieceSaved, 0.
+            self.pieceSavings.append(saved)
+            return saved
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses + self.failures
+            return {'hits' : self.hits,
+                    'misses' : self.misses,
+                    'failures' : self.failures,
+                    'unused' : self.unused,
+                    'wastedPlanTime' : self.wastedTime,
+                    'hitRate' : float(self.hits) / total if total > 0 else 0.,
+                    'meanSavedPerHit' : float(np.mean(self.savedTimes)) if self.savedTimes else 0.,
+                    'pieces' : len(self.pieceSavings),
+                    'meanSavedPerPiece' : float(np.mean(self.pieceSavings)) if self.pieceSavings else 0.}
+
+class SpeculativePlanner(object):
+    """
+    Plans PlanRequests in a background thread with optimize (a function of a
+    dict of armName to request returning a dict of armName to delta pose
+    trajectory, like RavenPlanner.optimize1) and keeps up to maxSize of them
+    for use() to match against real requests.
+
+    jointTypes are the keys of the request joints compared with jointTolerance
+    """
+    def __init__(self, optimize, jointTypes, jointTolerance=JOINT_TOLERANCE, graspTolerance=.05, maxSize=4):
+        self.optimize = optimize
+        self.jointTypes = list(jointTypes)
+        self.jointTolerance = np.asarray(jointTolerance, dtype=float)
+        self.graspTolerance = graspTolerance
+        self.maxSize = maxSize
+
+        self.condition = threading.Condition(threading.Lock())
+        self.speculations = collections.deque()
+        self.queued = collections.deque()
+        self.closed = False
+
+        self.stats = SpeculationStats()
+
+        self.thread = threading.Thread(target=self._planLoop)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def speculate(self, request):
+        """
+        Queues request to be planned in the background and returns it.
+        The oldest speculation is dropped beyond maxSize
+        """
+        with self.condition:
+            self.speculations.append(request)
+            self.queued.append(request)
+            while len(self.speculations) > self.maxSize:
+                dropped = self.speculations.popleft()
+                self._recordUnused(dropped)
+                if dropped in self.queued:
+                    self.queued.remove(dropped)
+                    dropped.setException(RuntimeError('Speculation dropped'))
+            self.condition.notify_all()
+        return request
+
+    def _planLoop(self):
+        while True:
+            with self.condition:
+                while not self.queued and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                request = self.queued.popleft()
+            request.startTime = time.time()
+            try:
+                request.setResult(self.optimize({request.armName : request})[request.armName])
+            except Exception as e:
+                request.setException(e)
+
+    def _matches(self, speculation, request):
+        if speculation.armName != request.armName or speculation.n_steps != request.n_steps:
+            return False
+        for a, b in ((speculation.startJoints, request.startJoints), (speculation.endJoints, request.endJoints)):
+            a = np.array([a[k] for k in self.jointTypes])
+            b = np.array([b[k] for k in self.jointTypes])
+            if np.any(np.abs(a - b) > self.jointTolerance):
+                return False
+        for a, b in ((speculation.startGrasp, request.startGrasp), (speculation.endGrasp, request.endGrasp)):
+            if (a is None) != (b is None) or (a is not None and abs(a - b) > self.graspTolerance):
+                return False
+        if (speculation.approachDir is None) != (request.approachDir is None):
+            return False
+        if request.approachDir is not None and not np.allclose(speculation.approachDir, request.approachDir):
+            return False
+        return True
+
+    def take(self, request):
+        """
+        Removes and returns the newest speculation matching request, moving
+        it to the front of the queue if it has not been planned yet. None if
+        there is none
+        """
+        with self.condition:
+            for speculation in reversed(self.speculations):
+                if self._matches(speculation, request):
+                    self.speculations.remove(speculation)
+                    if speculation in self.queued:
+                        self.queued.remove(speculation)
+                        self.queued.appendleft(speculation)
+                    return speculation
+            return None
+
+    def use(self, request, timeout=None):
+        """
+        The delta pose trajectory of the speculation matching request, waiting
+        up to timeout seconds for it. None if there is no match or its
+        planning failed, in which case request should be planned as usual
+        """
+        speculation = self.take(request)
+        if speculation is None:
+            self.stats.recordMiss()
+            return None
+
+        start = time.time()
+        if not speculation.wait(timeout):
+            self.stats.recordFailure()
+            return None
+        waitTime = time.time() - start
+        try:
+            deltaPoseTraj = speculation.result()
+        except Exception:
+            deltaPoseTraj = None
+        if deltaPoseTraj is None:
+            self.stats.recordFailure()
+            return None
+
+        self.stats.recordHit(speculation.finishTime - speculation.startTime, waitTime)
+        request.jointTraj = speculation.jointTraj
+        return deltaPoseTraj
+
+    def _recordUnused(self, speculation):
+        planTime = 0.
+        startTime = getattr(speculation, 'startTime', None)
+        if startTime is not None:
+            planTime = (speculation.finishTime if speculation.done() else time.time()) - startTime
+        self.stats.recordUnused(planTime)
+
+    def clear(self):
+        with self.condition:
+            for speculation in self.speculations:
+                self._recordUnused(speculation)
+            for request in self.queued:
+                request.setException(RuntimeError('Speculation dropped'))
+            self.queued.clear()
+            self.speculations.clear()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.clear()
@@ -0,0 +1,93 @@
+"""
+Cheap planning tiers tried before trajopt: straight lines in joint space
+(or Cartesian space) accepted if they pass a discrete collision and joint
+limit check
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import threading
+from collections import defaultdict
+
+import numpy as np
+
+CACHE = 'cache'
+JOINT_LINE = 'joint_line'
+CARTESIAN_LINE = 'cartesian_line'
+TRAJOPT = 'trajopt'
+TIERS = [CACHE, JOINT_LINE, CARTESIAN_LINE, TRAJOPT]
+
+def interpolateJoints(startJoints, endJoints, n_steps):
+    """
+    (n_steps, dofs) straight line from startJoints to endJoints
+    """
+    startJoints = np.asarray(startJoints, dtype=float)
+    endJoints = np.asarray(endJoints, dtype=float)
+    s = np.linspace(0., 1., n_steps)[:,None]
+    return startJoints + s * (endJoints - startJoints)
+
+def densify(traj, maxStep):
+    """
+    traj with waypoints added so no joint moves more than maxStep between
+    consecutive ones
+    """
+    traj = np.asarray(traj, dtype=float)
+    if len(traj) < 2:
+        return traj
+    steps = np.abs(np.diff(traj, axis=0)).max(axis=1)
+    dense = [traj[:1]]
+    for i, step in enumerate(steps):
+        n = max(int(np.ceil(step / maxStep)), 1)
+        dense.append(interpolateJoints(traj[i], traj[i+1], n + 1)[1:])
+    return np.concatenate(dense)
+
+def withinLimits(traj, lower, upper):
+    traj = np.asarray(traj, dtype=float)
+    return bool(np.all(traj >= lower) and np.all(traj <= upper))
+
+def collisionFree(env, robot, traj, maxStep=.02):
+    """
+    Discrete check of the robot's active dofs along traj (densified to
+    maxStep) against the environment and itself. Leaves the robot at the
+    last configuration checked
+    """
+    for joints in densify(traj, maxStep):
+        robot.SetActiveDOFValues(joints)
+        if env.CheckCollision(robot) or robot.CheckSelfCollision():
+            return False
+    return True
+
+def checkTrajectory(env, robot, traj, maxStep=.02):
+    """
+    Joint limits then collisions of the robot's active dofs along traj
+    """
+    lower, upper = robot.GetActiveDOFLimits()
+    return withinLimits(traj, lower, upper) and collisionFree(env, robot, traj, maxStep)
+
+class TierStats(object):
+    """
+    Which tier served each request and its planning latency
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.latencies = defaultdict(list)
+
+    def record(self, tier, latency):
+        with self.lock:
+            self.latencies[tier].append(latency)
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            allLatencies = []
+            for tier, latencies in self.latencies.iteritems():
+                stats[tier] = {'requests' : len(latencies),
+                               'medianLatency' : float(np.median(latencies))}
+                allLatencies += latencies
+            if allLatencies:
+                stats['medianLatency'] = float(np.median(allLatencies))
+            return stats
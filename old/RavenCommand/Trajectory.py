@@ -0,0 +1,180 @@
+"""
+Array-backed planner output: joints, tool poses and delta poses of a
+trajectory as numpy arrays, with tfx and ROS message views made on demand
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import numpy as np
+import tfx
+
+from geometry_msgs.msg import Pose
+
+import RavenDebridement.RavenCommand.kinematics as kin
+from RavenDebridement.RavenCommand.JointState import JointTrajectory
+
+LINK0 = '/0_link'
+
+def quaternionsFromMatrices(poses):
+    """
+    (N,4) quaternions (x,y,z,w) of the rotations of (N,4,4) or (N,3,3) arrays
+    """
+    R = np.asarray(poses, dtype=float)[:,:3,:3]
+    trace = R[:,0,0] + R[:,1,1] + R[:,2,2]
+    # each row is converted from its largest of w, x, y, z for stability
+    candidates = np.array([trace, R[:,0,0], R[:,1,1], R[:,2,2]]).T
+    largest = np.argmax(candidates, axis=1)
+
+    q = np.empty((len(R),4))
+    for index in xrange(4):
+        rows = largest == index
+        if not rows.any():
+            continue
+        r = R[rows]
+        if index == 0:
+            s = 2. * np.sqrt(1. + trace[rows])
+            q[rows] = np.array([(r[:,2,1] - r[:,1,2]) / s, (r[:,0,2] - r[:,2,0]) / s, (r[:,1,0] - r[:,0,1]) / s, s / 4.]).T
+        elif index == 1:
+            s = 2. * np.sqrt(1. + r[:,0,0] - r[:,1,1] - r[:,2,2])
+            q[rows] = np.array([s / 4., (r[:,0,1] + r[:,1,0]) / s, (r[:,0,2] + r[:,2,0]) / s, (r[:,2,1] - r[:,1,2]) / s]).T
+        elif index == 2:
+            s = 2. * np.sqrt(1. + r[:,1,1] - r[:,0,0] - r[:,2,2])
+            q[rows] = np.array([(r[:,0,1] + r[:,1,0]) / s, s / 4., (r[:,1,2] + r[:,2,1]) / s, (r[:,0,2] - r[:,2,0]) / s]).T
+        else:
+            s = 2. * np.sqrt(1. + r[:,2,2] - r[:,0,0] - r[:,1,1])
+            q[rows] = np.array([(r[:,0,2] + r[:,2,0]) / s, (r[:,1,2] + r[:,2,1]) / s, s / 4., (r[:,1,0] - r[:,0,1]) / s]).T
+    return q
+
+def posesToMsgs(poses):
+    """
+    List of geometry_msgs/Pose from an (N,4,4) array
+    """
+    poses = np.asarray(poses, dtype=float)
+    positions = poses[:,:3,3].tolist()
+    quaternions = quaternionsFromMatrices(poses).tolist()
+    msgs = []
+    for position, quaternion in zip(positions, quaternions):
+        msg = Pose()
+        msg.position.x, msg.position.y, msg.position.z = position
+        msg.orientation.x, msg.orientation.y, msg.orientation.z, msg.orientation.w = quaternion
+        msgs.append(msg)
+    return msgs
+
+def deltaPoses(poses):
+    """
+    (N-1,4,4) delta of each pose after the first from the first, as
+    Util.deltaPose: the position difference and the rotation R0^T R
+    """
+    poses = np.asarray(poses, dtype=float)
+    deltas = np.zeros((len(poses)-1,4,4))
+    deltas[:,:3,:3] = np.einsum('ji,njk->nik', poses[0,:3,:3], poses[1:,:3,:3])
+    deltas[:,:3,3] = poses[1:,:3,3] - poses[0,:3,3]
+    deltas[:,3,3] = 1
+    return deltas
+
+def applyDeltaPoses(startPose, deltas):
+    """
+    (N,4,4) end poses of the (N,4,4) deltas from the 4x4 startPose, as
+    Util.endPose
+    """
+    startPose = np.asarray(startPose, dtype=float)
+    deltas = np.asarray(deltas, dtype=float)
+    poses = np.zeros(deltas.shape)
+    poses[:,:3,:3] = np.einsum('ij,njk->nik', startPose[:3,:3], deltas[:,:3,:3])
+    poses[:,:3,3] = startPose[:3,3] + deltas[:,:3,3]
+    poses[:,3,3] = 1
+    return poses
+
+class PoseList(object):
+    """
+    (N,4,4) poses read like a list of tfx poses in frame. Each tfx pose is
+    made when accessed, slices are PoseLists of the same array
+    """
+    __slots__ = ('matrices', 'frame')
+
+    def __init__(self, matrices, frame=None):
+        self.matrices = np.asarray(matrices, dtype=float).reshape(-1,4,4)
+        self.frame = frame
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return PoseList(self.matrices[index], self.frame)
+        return tfx.transform(self.matrices[index]).as_pose(frame=self.frame)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self.matrices)
+
+    def msgs(self):
+        return posesToMsgs(self.matrices)
+
+    def __repr__(self):
+        return 'PoseList(%d poses, frame=%r)' % (len(self), self.frame)
+
+class Trajectory(object):
+    """
+    Planner output of one arm: joints is the (N,7) JOINT_TYPES array and
+    grasps the (N,) grasps, as in JointTrajectory, poses the (N,4,4) tool
+    poses in frame and stamps optional (N,) times from the start
+    """
+    __slots__ = ('armName', 'joints', 'grasps', 'poses', 'stamps', 'frame', '_deltaPoses')
+
+    def __init__(self, armName, joints, grasps, poses, stamps=None, frame=LINK0):
+        self.armName = armName
+        self.joints = np.asarray(joints, dtype=float)
+        self.grasps = np.asarray(grasps, dtype=float)
+        self.poses = np.asarray(poses, dtype=float).reshape(-1,4,4)
+        self.stamps = None if stamps is None else np.asarray(stamps, dtype=float)
+        self.frame = frame
+        self._deltaPoses = None
+
+    @classmethod
+    def fromJointTrajectory(cls, jointTraj, stamps=None, frame=LINK0):
+        """
+        From a JointTrajectory, with the poses from the batch FK
+        """
+        if len(jointTraj) == 0:
+            poses = np.zeros((0,4,4))
+        else:
+            poses, _ = kin.fwdArmKinBatch(jointTraj.armName, jointTraj.joints)
+        return cls(jointTraj.armName, jointTraj.joints, jointTraj.grasps, poses, stamps, frame)
+
+    def jointTrajectory(self):
+        return JointTrajectory(self.armName, self.joints, self.grasps)
+
+    def deltaPoses(self):
+        """
+        (N-1,4,4) deltas of the poses after the first from the first
+        """
+        if self._deltaPoses is None:
+            self._deltaPoses = deltaPoses(self.poses) if len(self.poses) > 0 else np.zeros((0,4,4))
+        return self._deltaPoses
+
+    def poseList(self):
+        return PoseList(self.poses, self.frame)
+
+    def deltaPoseList(self):
+        """
+        The deltas read like the list of tfx delta poses (without a frame)
+        the planner returns
+        """
+        return PoseList(self.deltaPoses())
+
+    def endPoses(self, startPose):
+        """
+        (N-1,4,4) poses of the deltas applied to the 4x4 startPose
+        """
+        return applyDeltaPoses(startPose, self.deltaPoses())
+
+    def poseMsgs(self):
+        return posesToMsgs(self.poses)
+
+    def __len__(self):
+        return len(self.poses)
+
+    def __repr__(self):
+        return 'Trajectory(%r, %d waypoints)' % (self.armName, len(self))
@@ -0,0 +1,143 @@
+"""
+LRU cache of trajopt results for repeated planning queries, optionally
+saved to disk between runs
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import os
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+
+import numpy as np
+
+# quantization of the planner joints (shoulder, elbow, insertion, rotation,
+# pitch, yaw) in radians, insertion in meters
+JOINT_RESOLUTION = np.array([.002, .002, .0002, .002, .002, .002])
+
+class TrajectoryCache(object):
+    """
+    Caches trajopt joint trajectories (the (n_steps, dofs) array of all
+    arms) keyed by the quantized start and end joints of every arm, n_steps,
+    the approach directions and the workspace model.
+
+    A hit was planned from joints within one quantization cell of the
+    query. Callers should re-check it for collisions before use and call
+    invalidate() if it fails
+    """
+    def __init__(self, maxSize=256, jointResolution=JOINT_RESOLUTION, approachResolution=.01):
+        self.maxSize = maxSize
+        self.jointResolution = np.asarray(jointResolution, dtype=float)
+        self.approachResolution = approachResolution
+
+        self.cache = OrderedDict()
+        self.lock = threading.RLock()
+
+        self.clearStats()
+
+    def _quantize(self, joints):
+        return tuple(np.floor(np.asarray(joints, dtype=float) / self.jointResolution).astype(int).tolist())
+
+    def key(self, armNames, startJoints, endJoints, n_steps, approachDirs=None, workspace=None):
+        """
+        startJoints and endJoints are dicts of armName to the planner joint
+        array, approachDirs a dict of armName to direction (or None)
+        """
+        approachDirs = approachDirs or {}
+        key = [int(n_steps), workspace]
+        for armName in sorted(armNames):
+            approachDir = approachDirs.get(armName)
+            if approachDir is not None:
+                approachDir = np.asarray(approachDir, dtype=float)
+                approachDir = tuple(np.round(approachDir / np.linalg.norm(approachDir) / self.approachResolution).astype(int).tolist())
+            key.append((armName, self._quantize(startJoints[armName]), self._quantize(endJoints[armName]), approachDir))
+        return tuple(key)
+
+    def get(self, key):
+        """
+        Copy of the cached trajectory or None
+        """
+        with self.lock:
+            traj = self.cache.pop(key, None)
+            if traj is None:
+                self.misses += 1
+                return None
+            self.cache[key] = traj
+            self.hits += 1
+            return traj.copy()
+
+    def put(self, key, traj):
+        with self.lock:
+            self.cache.pop(key, None)
+            self.cache[key] = np.array(traj, dtype=float)
+            while len(self.cache) > self.maxSize:
+                self.cache.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Drops a hit that failed its collision check
+        """
+        with self.lock:
+            if self.cache.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def save(self, filename):
+        with self.lock:
+            data = {'maxSize' : self.maxSize,
+                    'jointResolution' : self.jointResolution,
+                    'approachResolution' : self.approachResolution,
+                    'cache' : self.cache.items()}
+            tmpFilename = filename + '.tmp'
+            with open(tmpFilename, 'wb') as f:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpFilename, filename)
+
+    @classmethod
+    def load(cls, filename, maxSize=None):
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+        cache = cls(maxSize or data['maxSize'], data['jointResolution'], data['approachResolution'])
+        for key, traj in data['cache']:
+            cache.put(key, traj)
+        cache.evictions = 0
+        return cache
+
+    @classmethod
+    def loadOrCreate(cls, filename, **kwargs):
+        """
+        Loads filename if it exists, otherwise returns an empty cache
+        """
+        if os.path.exists(filename):
+            return cls.load(filename, kwargs.get('maxSize'))
+        return cls(**kwargs)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def clearStats(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def hitRate(self):
+        """
+        Fraction of lookups that returned a trajectory which was not invalidated
+        """
+        total = self.hits + self.misses
+        return float(self.hits - self.invalidations) / total if total > 0 else 0.
+
+    def stats(self):
+        return {'size' : len(self.cache),
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'invalidations' : self.invalidations,
+                'evictions' : self.evictions,
+                'hitRate' : self.hitRate()}
+
+    def __len__(self):
+        return len(self.cache)
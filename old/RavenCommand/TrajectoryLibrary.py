@@ -0,0 +1,134 @@
+"""
+Library of past trajopt trajectories, searched with a KD-tree over their
+start and end joints to warm start new problems
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import threading
+from collections import defaultdict
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+def warpTrajectory(traj, n_steps, startJoints=None, endJoints=None):
+    """
+    Resamples an (N,dofs) joint trajectory to n_steps waypoints, linear in
+    normalized time. If given, the start and end are moved onto startJoints
+    and endJoints, blending the offsets linearly along the trajectory
+    """
+    traj = np.asarray(traj, dtype=float)
+    t = np.linspace(0., 1., len(traj))
+    s = np.linspace(0., 1., n_steps)
+    warped = np.array([np.interp(s, t, traj[:,dof]) for dof in xrange(traj.shape[1])]).T
+
+    if startJoints is not None:
+        warped += (1. - s)[:,None] * (np.asarray(startJoints, dtype=float) - warped[0])
+    if endJoints is not None:
+        warped += s[:,None] * (np.asarray(endJoints, dtype=float) - warped[-1])
+    return warped
+
+class WarmStartStats(object):
+    """
+    Solve times and final costs by init type ('straight_line' or
+    'given_traj'), and the paired differences when both were solved
+    for the same problem (warm minus straight)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.solveTimes = defaultdict(list)
+        self.costs = defaultdict(list)
+        self.timeDeltas = []
+        self.costDeltas = []
+
+    def record(self, initType, solveTime, cost):
+        with self.lock:
+            self.solveTimes[initType].append(solveTime)
+            self.costs[initType].append(cost)
+
+    def recordComparison(self, warmTime, straightTime, warmCost, straightCost):
+        with self.lock:
+            self.timeDeltas.append(warmTime - straightTime)
+            self.costDeltas.append(warmCost - straightCost)
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for initType, times in self.solveTimes.iteritems():
+                stats[initType] = {'solves' : len(times),
+                                   'meanSolveTime' : float(np.mean(times)),
+                                   'meanCost' : float(np.mean(self.costs[initType]))}
+            if self.timeDeltas:
+                stats['comparisons'] = len(self.timeDeltas)
+                stats['meanSolveTimeDelta'] = float(np.mean(self.timeDeltas))
+                stats['meanCostDelta'] = float(np.mean(self.costDeltas))
+            return stats
+
+class TrajectoryLibrary(object):
+    """
+    Keeps up to maxSize trajectories (oldest dropped first). Each is
+    indexed by its start and end joints scaled by weights (per dof, so
+    insertion in meters can weigh more than the angles)
+    """
+    def __init__(self, weights=None, maxSize=500, maxDistance=None):
+        self.weights = None if weights is None else np.asarray(weights, dtype=float)
+        self.maxSize = maxSize
+        self.maxDistance = maxDistance
+
+        self.features = []
+        self.trajs = []
+        self.tree = None
+        self.lock = threading.RLock()
+
+        self.stats = WarmStartStats()
+
+    def _feature(self, startJoints, endJoints):
+        startJoints = np.asarray(startJoints, dtype=float)
+        endJoints = np.asarray(endJoints, dtype=float)
+        if self.weights is not None:
+            startJoints = startJoints * self.weights
+            endJoints = endJoints * self.weights
+        return np.concatenate((startJoints, endJoints))
+
+    def add(self, startJoints, endJoints, traj):
+        with self.lock:
+            self.features.append(self._feature(startJoints, endJoints))
+            self.trajs.append(np.array(traj, dtype=float))
+            if len(self.trajs) > self.maxSize:
+                del self.features[0]
+                del self.trajs[0]
+            self.tree = None
+
+    def nearest(self, startJoints, endJoints):
+        """
+        The stored trajectory with the closest start and end joints and its
+        distance, or (None, None) if the library is empty or the closest one
+        is further than maxDistance
+        """
+        with self.lock:
+            if not self.trajs:
+                return None, None
+            # rebuilt lazily, adds come in bursts between queries
+            if self.tree is None:
+                self.tree = cKDTree(np.array(self.features))
+            distance, index = self.tree.query(self._feature(startJoints, endJoints))
+            if self.maxDistance is not None and distance > self.maxDistance:
+                return None, None
+            return self.trajs[index], float(distance)
+
+    def initTrajectory(self, startJoints, endJoints, n_steps):
+        """
+        The nearest trajectory warped to n_steps with its ends on startJoints
+        and endJoints, for a given_traj init. None if there is none
+        """
+        traj, distance = self.nearest(startJoints, endJoints)
+        if traj is None or traj.shape[1] != len(startJoints):
+            return None
+        return warpTrajectory(traj, n_steps, startJoints, endJoints)
+
+    def __len__(self):
+        return len(self.trajs)
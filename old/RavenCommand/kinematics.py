@@ -230,6 +230,8 @@ TOOL_GRASP2_MIN_LIMIT = (-TOOL_GRASP_LIMIT)
 TOOL_GRASP2_MAX_LIMIT =   TOOL_GRASP_LIMIT
 
 def fix_angle(angle, center=0.):
+    if isinstance(angle, np.ndarray):
+        return fix_angle_array(angle, center)
     test_angle = angle;
     cnt = 1;
     while (test_angle-center) > pi:
@@ -242,6 +244,37 @@ def fix_angle(angle, center=0.):
         cnt += 1
     return test_angle;
 
+def _wrap_count(angles, center, sign):
+    """
+    Number of 2*pi steps the fix_angle loops take for each angle,
+    where sign is -1 for the upper wrap and +1 for the lower wrap
+    """
+    cnt = np.maximum(np.ceil(-sign * (angles - center) / (2*pi) - .5), 1)
+    outside = lambda cnt: sign * ((angles + sign * cnt * 2*pi) - center) < -pi
+    # the estimate can be off by one from rounding, so step it
+    # to the first count the loop would have stopped at
+    lower = (cnt > 1) & ~outside(cnt - 1)
+    cnt[lower] -= 1
+    cnt[outside(cnt)] += 1
+    return cnt
+
+def fix_angle_array(angles, center=0.):
+    """
+    Vectorized fix_angle. Steps by the same multiples of 2*pi
+    as the scalar loops so results match fix_angle exactly
+    """
+    angles = np.array(angles, dtype=float)
+
+    over = (angles - center) > pi
+    if over.any():
+        angles[over] = angles[over] - _wrap_count(angles[over], center, -1) * 2*pi
+
+    under = (angles - center) < -pi
+    if under.any():
+        angles[under] = angles[under] + _wrap_count(angles[under], center, +1) * 2*pi
+
+    return angles
+
 def check_joint_limits1(d_act, thp_act, g1_act, g2_act):
     validity = [0,0,0,0]
     
@@ -634,6 +667,326 @@ def fwdArmKin(armId, joints):
     return tool_tf.as_pose(frame='/0_link'), grasp
 
 
+#########################
+#   BATCH KINEMATICS    #
+#########################
+
+# column order of the (N,7) joint arrays used by the batch functions
+JOINT_TYPES = [SHOULDER, ELBOW, Z_INS, TOOL_ROT, WRIST, GRASP1, GRASP2]
+
+def jointDictsToArray(jointDicts):
+    """
+    Converts a list of joint dicts (or a JointTrajectory) to an (N,7) array in JOINT_TYPES order
+    """
+    if hasattr(jointDicts, 'joints'):
+        return np.asarray(jointDicts.joints, dtype=float)
+    return np.array([[joints[jointType] for jointType in JOINT_TYPES] for joints in jointDicts], dtype=float).reshape(-1,len(JOINT_TYPES))
+
+def jointArrayToDicts(jointArray):
+    """
+    Converts an (N,7) array in JOINT_TYPES order to a list of joint dicts
+    """
+    return [dict(zip(JOINT_TYPES, row)) for row in np.asarray(jointArray, dtype=float).tolist()]
+
+def _tf_array(tf):
+    return np.array(tfx.transform(tf).matrix, dtype=float)
+
+def _Z_batch(theta, d=0.):
+    """
+    (N,4,4) stack of Z(theta,d)
+    """
+    theta = np.asarray(theta, dtype=float)
+    T = np.zeros(theta.shape + (4,4))
+    c, s = np.cos(theta), np.sin(theta)
+    T[...,0,0] = c
+    T[...,0,1] = -s
+    T[...,1,0] = s
+    T[...,1,1] = c
+    T[...,2,2] = 1
+    T[...,2,3] = d
+    T[...,3,3] = 1
+    return T
+
+_TOOL_POSE_AXES_SIGNS = np.array([1.,-1.,-1.])
+
+def fwdArmKinBatch(armId, joints):
+    """
+    Forward kinematics for many joint configurations of one arm
+
+    joints is an (N,7) array with columns in JOINT_TYPES order.
+    Returns an (N,4,4) array of tool transforms in '/0_link'
+    and an (N,) array of grasps, matching fwdArmKin row by row
+    """
+    joints = np.asarray(joints, dtype=float).reshape(-1,len(JOINT_TYPES))
+    ths, the, d, thr, thp, g1, g2 = joints.T
+
+    n = joints.shape[0]
+    Zi_batch = np.tile(np.eye(4), (n,1,1))
+    Zi_batch[:,2,3] = D_TO_IK(armId,d)
+
+    tool_tf = _tf_array(actual_world_to_ik_world(armId) * Tw2b)
+    tool_tf = np.matmul(tool_tf, _Z_batch(THS_TO_IK(armId,ths)))
+    tool_tf = np.matmul(tool_tf, _tf_array(Xu))
+    tool_tf = np.matmul(tool_tf, _Z_batch(THE_TO_IK(armId,the)))
+    tool_tf = np.matmul(tool_tf, _tf_array(Xf))
+    tool_tf = np.matmul(tool_tf, _Z_batch(THR_TO_IK(armId,thr)))
+    tool_tf = np.matmul(tool_tf, Zi_batch)
+    tool_tf = np.matmul(tool_tf, _tf_array(Xip))
+    tool_tf = np.matmul(tool_tf, _Z_batch(THP_TO_IK(armId,thp)))
+    tool_tf = np.matmul(tool_tf, _tf_array(Xpy))
+    tool_tf = np.matmul(tool_tf, _Z_batch(THY_TO_IK_FROM_FINGERS(armId,g1,g2)))
+    tool_tf = np.matmul(tool_tf, _tf_array(Tg))
+
+    tool_tf[:,:3,:3] *= _TOOL_POSE_AXES_SIGNS
+    grasp = ACTUAL_GRASP_FROM_MECH_GRASP(armId,MECH_GRASP_FROM_MECH_FINGERS(armId,g1,g2))
+    return tool_tf, grasp
+
+def posesToArray(poses):
+    """
+    Converts a list of poses to an (N,4,4) array
+    """
+    return np.array([tfx.pose(pose).matrix for pose in poses], dtype=float).reshape(-1,4,4)
+
+def _rigid_inverse(T):
+    """
+    Inverse of an (N,4,4) stack of rigid transforms
+    """
+    Tinv = np.zeros_like(T)
+    Rt = np.swapaxes(T[...,:3,:3], -1, -2)
+    Tinv[...,:3,:3] = Rt
+    Tinv[...,:3,3] = -np.einsum('...ij,...j->...i', Rt, T[...,:3,3])
+    Tinv[...,3,3] = 1
+    return Tinv
+
+def _limit_codes(values, minLimit, maxLimit):
+    """
+    -1 below the min limit, +1 above the max limit, 0 otherwise (and for nan)
+    """
+    with np.errstate(invalid='ignore'):
+        return (values > maxLimit).astype(np.int8) - (values < minLimit).astype(np.int8)
+
+def _limit_dist(values, minLimit, maxLimit):
+    """
+    Distance outside of the limits, as in check_joint_limits2
+    """
+    with np.errstate(invalid='ignore'):
+        return np.where(values < minLimit, values - minLimit, np.where(values > maxLimit, values - maxLimit, 0.))
+
+def _invArmKinBranches(armId, poses, grasps):
+    """
+    Vectorized body of invArmKin that keeps both elbow branches
+
+    Returns joints (N,2,7) in JOINT_TYPES order, a validity mask (N,2),
+    limit-violation codes (N,2,7) and the distance outside of the
+    shoulder/elbow/roll limits for each branch (N,2)
+    """
+    poses = np.array(poses, dtype=float).reshape(-1,4,4)
+    n = poses.shape[0]
+    grasps = np.broadcast_to(np.asarray(grasps, dtype=float), (n,))
+
+    poses[:,:3,:3] *= _TOOL_POSE_AXES_SIGNS
+
+    # yaw frame in the ik world, see invArmKin
+    ik_pose = np.matmul(np.matmul(_tf_array(ik_world_to_actual_world(armId)), poses), _tf_array(Tg.inverse()))
+
+    th12 = THETA_12;
+    th23 = THETA_23;
+
+    ks12 = sin(th12);
+    kc12 = cos(th12);
+    ks23 = sin(th23);
+    kc23 = cos(th23);
+
+    dw = DW;
+
+    Tgripper_to_world = _rigid_inverse(ik_pose)
+    px, py, pz = Tgripper_to_world[:,:3,3].T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        thy = np.arctan2(py,-px)
+        thp = np.where(np.abs(thy) < 0.001,
+                       np.arctan2(-pz, -px/np.cos(thy) - dw),
+                       np.arctan2(-pz,  py/np.sin(thy) - dw))
+        d = -pz / np.sin(thp)
+
+    d_act = D_FROM_IK(armId,d)
+    thp_act = THP_FROM_IK(armId,thp)
+    g1_act = FINGER1_FROM_IK(armId,thy,grasps)
+    g2_act = FINGER2_FROM_IK(armId,thy,grasps)
+
+    codes = np.zeros((n,2,len(JOINT_TYPES)), dtype=np.int8)
+    codes[:,:,2] = _limit_codes(d_act, Z_INS_MIN_LIMIT, Z_INS_MAX_LIMIT)[:,None]
+    codes[:,:,4] = _limit_codes(thp_act, TOOL_WRIST_MIN_LIMIT, TOOL_WRIST_MAX_LIMIT)[:,None]
+    codes[:,:,5] = _limit_codes(g1_act, TOOL_GRASP1_MIN_LIMIT, TOOL_GRASP1_MAX_LIMIT)[:,None]
+    codes[:,:,6] = _limit_codes(g2_act, TOOL_GRASP2_MIN_LIMIT, TOOL_GRASP2_MAX_LIMIT)[:,None]
+    valid1 = ~np.isnan(d_act + thp_act + g1_act + g2_act) & ~np.any(codes[:,0,:] != 0, axis=1)
+
+    Zi_batch = np.tile(np.eye(4), (n,1,1))
+    Zi_batch[:,2,3] = d
+    roll_to_gripper = np.matmul(Zi_batch, _tf_array(Xip))
+    roll_to_gripper = np.matmul(roll_to_gripper, _Z_batch(thp))
+    roll_to_gripper = np.matmul(roll_to_gripper, _tf_array(Xpy))
+    roll_to_gripper = np.matmul(roll_to_gripper, _Z_batch(thy))
+    roll_to_gripper = np.matmul(roll_to_gripper, _tf_array(Tg))
+    roll_to_world = _rigid_inverse(np.matmul(roll_to_gripper, Tgripper_to_world))
+
+    # [0,0,1] and [1,0,0] mapped as points, as the C++ invXform does
+    zx, zy, zz = (roll_to_world[:,:3,2] + roll_to_world[:,:3,3]).T
+    xx, xy, xz = (roll_to_world[:,:3,0] + roll_to_world[:,:3,3]).T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cthe = ((zy + kc12*kc23) / (ks12*ks23))[:,None]
+
+        the_opt = np.arccos(cthe) * np.array([1.,-1.])
+        zx, zy, zz = zx[:,None], zy[:,None], zz[:,None]
+        xx, xy = xx[:,None], xy[:,None]
+
+        sthe_tmp = np.sin(the_opt);
+        C1 = ks12*kc23 + kc12*ks23*cthe;
+        C2 = ks23 * sthe_tmp;
+        C3 = C2 + C1*C1 / C2;
+
+        ths_opt = np.arctan2(
+                -np.sign(C3)*(zx - C1 * zz / C2),
+                 np.sign(C3)*(zz + C1 * zx / C2));
+
+        sths_tmp = np.sin(ths_opt);
+        cths_tmp = np.cos(ths_opt);
+
+        C4 = ks12 * np.sin(the_opt);
+        C5 = kc12 * ks23 + ks12 * kc23 * np.cos(the_opt);
+        C6 = kc23*(sthe_tmp * sths_tmp - kc12*cthe*cths_tmp) + cths_tmp*ks12*ks23;
+        C7 = cthe*sths_tmp + kc12*cths_tmp*sthe_tmp;
+
+        thr_opt = np.arctan2(
+                (xx - C7 * xy / C4) / (C6 + C7*C5/C4),
+                (xx + C6 * xy / C5) / (-C6*C4/C5 - C7));
+
+    ths_act = THS_FROM_IK(armId,ths_opt)
+    the_act = THE_FROM_IK(armId,the_opt)
+    thr_act = THR_FROM_IK(armId,thr_opt)
+
+    codes[:,:,0] = _limit_codes(ths_act, SHOULDER_MIN_LIMIT, SHOULDER_MAX_LIMIT)
+    codes[:,:,1] = _limit_codes(the_act, ELBOW_MIN_LIMIT, ELBOW_MAX_LIMIT)
+    codes[:,:,3] = _limit_codes(thr_act, TOOL_ROLL_MIN_LIMIT, TOOL_ROLL_MAX_LIMIT)
+    valid2 = ~np.isnan(ths_act + the_act + thr_act) & ~np.any(codes[:,:,[0,1,3]] != 0, axis=2)
+
+    limit_dist = np.sqrt(_limit_dist(ths_act, SHOULDER_MIN_LIMIT, SHOULDER_MAX_LIMIT)**2 +
+                         _limit_dist(the_act, ELBOW_MIN_LIMIT, ELBOW_MAX_LIMIT)**2 +
+                         _limit_dist(thr_act, TOOL_ROLL_MIN_LIMIT, TOOL_ROLL_MAX_LIMIT)**2)
+
+    joints = np.empty((n,2,len(JOINT_TYPES)))
+    joints[:,:,0] = ths_act
+    joints[:,:,1] = the_act
+    joints[:,:,2] = d_act[:,None]
+    joints[:,:,3] = thr_act
+    joints[:,:,4] = thp_act[:,None]
+    joints[:,:,5] = g1_act[:,None]
+    joints[:,:,6] = g2_act[:,None]
+
+    return joints, valid1[:,None] & valid2, codes, limit_dist
+
+def invArmKinBatch(armId, poses, grasps):
+    """
+    Inverse kinematics for many target poses of one arm
+
+    poses is an (N,4,4) array of tool poses in '/0_link' and grasps is
+    a scalar or an (N,) array. Returns
+      joints: (N,7) array in JOINT_TYPES order
+      valid:  (N,) bool mask, True where invArmKin would return joints
+      branch: (N,) elbow branch (0 is +acos, 1 is -acos)
+      limits: (N,7) int8 limit codes, -1/+1 below/above a joint limit
+
+    Valid rows match invArmKin, which prefers branch 1 when both are valid.
+    Invalid rows hold the unclamped solution of the branch closest to the
+    limits (nan where there is no solution)
+    """
+    joints, valid, codes, limit_dist = _invArmKinBranches(armId, poses, grasps)
+    n = joints.shape[0]
+
+    branch = np.where(valid[:,1], 1, np.where(valid[:,0], 0,
+                      (limit_dist[:,1] < limit_dist[:,0]).astype(int)))
+    rows = np.arange(n)
+
+    return joints[rows,branch], valid[rows,branch], branch, codes[rows,branch]
+
+# tool roll offsets tried for each elbow branch, the roll limits are just over +-pi
+ROLL_SHIFTS = [0., -2*pi, 2*pi]
+
+def _invArmKinCandidates(armId, poses, grasps):
+    """
+    Every ik solution of each pose: elbow branch x tool roll shifted by ROLL_SHIFTS.
+    Returns joints (N,6,7) in JOINT_TYPES order and a validity mask (N,6),
+    where candidate c is branch c // 3 with roll shift ROLL_SHIFTS[c % 3]
+    """
+    joints, valid, codes, limit_dist = _invArmKinBranches(armId, poses, grasps)
+
+    candidates = np.repeat(joints, len(ROLL_SHIFTS), axis=1)
+    candidates[:,:,3] += np.tile(ROLL_SHIFTS, 2)
+
+    otherCodes = codes[:,:,[0,1,2,4,5,6]]
+    others_ok = ~np.isnan(joints).any(axis=2) & (otherCodes == 0).all(axis=2)
+    with np.errstate(invalid='ignore'):
+        roll_ok = (candidates[:,:,3] >= TOOL_ROLL_MIN_LIMIT) & (candidates[:,:,3] <= TOOL_ROLL_MAX_LIMIT)
+
+    return candidates, np.repeat(others_ok, len(ROLL_SHIFTS), axis=1) & roll_ok
+
+# weights of the joint distance between ik solutions, in JOINT_TYPES order
+# (insertion is in meters)
+JOINT_WEIGHTS = np.array([1., 1., 10., 1., 1., 1., 1.])
+
+def _ikJointDicts(armId, joints, grasps):
+    """
+    (N,7) ik joints to joint dicts with YAW and GRASP, as returned by invArmKin
+    """
+    jointDicts = jointArrayToDicts(joints)
+    for jointDict, grasp in zip(jointDicts, np.asarray(grasps, dtype=float) * np.ones(len(jointDicts))):
+        if armId == GREEN_ARM_ID:
+            jointDict[YAW] = (jointDict[GRASP1] - jointDict[GRASP2])/2.
+        else:
+            jointDict[YAW] = (jointDict[GRASP2] - jointDict[GRASP1])/2.
+        jointDict[GRASP] = float(grasp)
+    return jointDicts
+
+def invArmKinSolutions(armId, pose, grasp):
+    """
+    All valid ik solutions of pose (elbow branch x tool roll +-2pi) as a list
+    of joint dicts, empty if there are none. The first solution is the one
+    invArmKin returns
+    """
+    candidates, valid = _invArmKinCandidates(armId, posesToArray([pose]), grasp)
+    candidates, valid = candidates[0], valid[0]
+    # invArmKin prefers branch 1, then branch 0, each with the unshifted roll first
+    order = [c for c in range(len(ROLL_SHIFTS), 2*len(ROLL_SHIFTS)) + range(len(ROLL_SHIFTS)) if valid[c]]
+    return _ikJointDicts(armId, candidates[order], grasp)
+
+def jointDistance(joints0, joints1, weights=JOINT_WEIGHTS):
+    """
+    Weighted euclidean distance between two joint dicts over the
+    JOINT_TYPES both have
+    """
+    delta = np.array([joints0[jointType] - joints1[jointType] if jointType in joints0 and jointType in joints1 else 0.
+                      for jointType in JOINT_TYPES])
+    return float(np.linalg.norm(delta * weights))
+
+def selectClosestSolution(solutions, seedJoints=None, weights=JOINT_WEIGHTS):
+    """
+    The solution closest to seedJoints under the weighted joint distance.
+    Without a seed, returns the first solution. None if there are no solutions
+    """
+    if not solutions:
+        return None
+    if seedJoints is None:
+        return solutions[0]
+    return min(solutions, key=lambda joints: jointDistance(joints, seedJoints, weights))
+
+def invArmKinClosest(armId, pose, grasp, seedJoints, weights=JOINT_WEIGHTS):
+    """
+    invArmKin returning the valid solution closest to seedJoints, or None
+    """
+    return selectClosestSolution(invArmKinSolutions(armId, pose, grasp), seedJoints, weights)
+
+
 
 
 
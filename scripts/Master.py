@@ -21,6 +21,8 @@ from RavenDebridement.Utils import Util
 from RavenDebridement.Utils import Constants
 from RavenDebridement.RavenCommand.RavenArm import RavenArm
 from RavenDebridement.RavenCommand.RavenPlanner2 import RavenPlanner
+from RavenDebridement.RavenCommand.TrajectoryCache import TrajectoryCache
+from RavenDebridement.RavenCommand.PhaseTimer import PhaseTimer
 from RavenDebridement.RavenCommand.RavenBSP import RavenBSP
 from RavenDebridement.ImageProcessing.ARImageDetection import ARImageDetector
 
@@ -227,7 +229,7 @@ class MoveVertical(smach.State):
     Move vertical in open-loop
     """
     def __init__(self, ravenArm, ravenPlanner, openLoopSpeed):
-        smach.State.__init__(self, outcomes = ['success'], input_keys=['vertAmount'])
+        smach.State.__init__(self, outcomes = ['success'], input_keys=['vertAmount','homePose'])
         self.ravenArm = ravenArm
         self.ravenPlanner = ravenPlanner
         self.openLoopSpeed = openLoopSpeed
@@ -241,9 +243,16 @@ class MoveVertical(smach.State):
         deltaPose = tfx.pose([0,0,userdata.vertAmount]).msg.Pose()
         
         endPose = Util.endPose(self.ravenArm.getGripperPose(), deltaPose)
-        endPoseTraj = self.ravenPlanner.getTrajectoryFromPose(self.ravenArm.name, endPose)
+        endPoseTraj = self.ravenPlanner.getCartesianTrajectoryFromPose(self.ravenArm.name, endPose)
+        if endPoseTraj is None:
+            endPoseTraj = self.ravenPlanner.getTrajectoryFromPose(self.ravenArm.name, endPose)
 
         if endPoseTraj != None:
+            # next is home, from the top of this move
+            homePose = tfx.pose(userdata.homePose)
+            homePose.orientation = tfx.pose(endPose).orientation
+            self.ravenPlanner.speculate(self.ravenArm.name, endPose, homePose)
+            
             self.ravenArm.executePoseTrajectory(endPoseTraj)
         
         return 'success'
@@ -309,7 +318,12 @@ class MoveToReceptacle(smach.State):
         receptaclePose.orientation = currPose.orientation
 
         print 'getting trajectory'
-        endPoseTraj = self.ravenPlanner.getTrajectoryFromPose(self.ravenArm.name, receptaclePose)
+        # planned while moving home, if it matches
+        endPoseTraj = self.ravenPlanner.getSpeculativeTrajectory(self.ravenArm.name, receptaclePose)
+        if endPoseTraj is None:
+            endPoseTraj = self.ravenPlanner.getCartesianTrajectoryFromPose(self.ravenArm.name, receptaclePose)
+        if endPoseTraj is None:
+            endPoseTraj = self.ravenPlanner.getTrajectoryFromPose(self.ravenArm.name, receptaclePose)
         print 'got receptacle trajectory', endPoseTraj is None
 
         if endPoseTraj != None:
@@ -325,13 +339,17 @@ class MoveToReceptacle(smach.State):
 class MoveToHome(smach.State):
     """
     Move to the home position in open-loop
+
+    nextPoseKey is the userdata pose moved to next, planned speculatively
+    while moving home. Without one this is the last move of a piece
     """
-    def __init__(self, ravenArm, ravenPlanner, imageDetector, openLoopSpeed):
-        smach.State.__init__(self, outcomes=['success'], input_keys=['homePose'])
+    def __init__(self, ravenArm, ravenPlanner, imageDetector, openLoopSpeed, nextPoseKey=None):
+        smach.State.__init__(self, outcomes=['success'], input_keys=['homePose'] + ([nextPoseKey] if nextPoseKey else []))
         self.ravenArm = ravenArm
         self.ravenPlanner = ravenPlanner
         self.imageDetector = imageDetector
         self.openLoopSpeed = openLoopSpeed
+        self.nextPoseKey = nextPoseKey
     
     def execute(self, userdata):
         if MasterClass.PAUSE_BETWEEN_STATES:
@@ -348,11 +366,20 @@ class MoveToHome(smach.State):
         endPoseTraj = self.ravenPlanner.getTrajectoryFromPose(self.ravenArm.name, homePose)
 
         if endPoseTraj != None:
+            if self.nextPoseKey is not None:
+                nextPose = tfx.pose(userdata[self.nextPoseKey])
+                nextPose.orientation = homePose.orientation
+                self.ravenPlanner.speculate(self.ravenArm.name, homePose, nextPose)
+            
             self.ravenArm.executePoseTrajectory(endPoseTraj)
         
         # so when finding object, find newest one
         self.imageDetector.removeObjectPoint()
         
+        if self.nextPoseKey is None and self.ravenPlanner.speculator is not None:
+            stats = self.ravenPlanner.speculator.stats
+            rospy.loginfo('Speculative planning saved %.3f s this piece, %s' % (stats.markPiece(), stats.stats()))
+        
         return 'success'
 
 class MasterClass(object):
@@ -430,7 +457,8 @@ class MasterClass(object):
             smach.StateMachine.add('checkPickup', CheckPickup(self.ravenArm, self.gripperOpenCloseDuration),
                                    transitions = {'success': 'pickupSuccessMoveToHome',
                                                   'failure': 'findObject'})
-            smach.StateMachine.add('pickupSuccessMoveToHome', MoveToHome(self.ravenArm, self.ravenPlanner, self.imageDetector, self.openLoopSpeed),
+            smach.StateMachine.add('pickupSuccessMoveToHome', MoveToHome(self.ravenArm, self.ravenPlanner, self.imageDetector, self.openLoopSpeed,
+                                                                                  nextPoseKey='receptaclePose'),
                                    transitions = {'success': 'moveToReceptacle'})
             smach.StateMachine.add('moveToReceptacle', MoveToReceptacle(self.ravenArm, self.ravenPlanner, self.openLoopSpeed, self.gripperOpenCloseDuration),
                                    transitions = {'success': 'moveToHome'})
@@ -465,13 +493,49 @@ def mainloop():
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--smooth',action='store_true',default=False)
+    parser.add_argument('--correction-threshold',type=float,default=0,help='servo moves shorter than this (m) skip trajopt, e.g. .005')
+    parser.add_argument('--approximate-ik',action='store_true',default=False,help='numerical ik for poses just outside the joint limits')
+    parser.add_argument('--trajectory-cache',default=None,help='file of the trajectory cache, loaded at start and saved at shutdown')
+    parser.add_argument('--warm-start',action='store_true',default=False,help='initialize trajopt from the nearest past trajectory')
+    parser.add_argument('--compare-warm-start',action='store_true',default=False,help='also solve from a straight line and log the difference')
+    parser.add_argument('--planner-processes',type=int,default=0,help='solve trajopt in this many worker processes')
+    parser.add_argument('--speculate',action='store_true',default=False,help='plan the next move while the arm is moving')
+    parser.add_argument('--tiered',action='store_true',default=False,help='try straight lines before trajopt')
+    parser.add_argument('--phase-timing',default=None,help='time the planning stages, publish them on /diagnostics and save them to this .csv or .json file at shutdown')
+    parser.add_argument('--adaptive-steps',action='store_true',default=False,help='size trajopt problems from the move, not the requested n_steps')
+    parser.add_argument('--plan-budget',type=float,default=None,help='seconds a plan may take before the best trajectory found without trajopt is used')
     args = parser.parse_args(rospy.myargv()[1:])
     
     MasterClass.PAUSE_BETWEEN_STATES = not args.smooth
     
     imageDetector = ARImageDetector()
     ravenArm = RavenArm(armName)
-    ravenPlanner = RavenPlanner([armName])
+    trajectoryCache = None
+    if args.trajectory_cache:
+        trajectoryCache = TrajectoryCache.loadOrCreate(args.trajectory_cache)
+        def saveTrajectoryCache():
+            rospy.loginfo('Saving trajectory cache %s' % trajectoryCache.stats())
+            trajectoryCache.save(args.trajectory_cache)
+        rospy.on_shutdown(saveTrajectoryCache)
+    phaseTimer = None
+    if args.phase_timing:
+        phaseTimer = PhaseTimer()
+        phaseTimer.publishPeriodically()
+        rospy.on_shutdown(lambda: phaseTimer.dump(args.phase_timing))
+    ravenPlanner = RavenPlanner([armName], correctionThreshold=args.correction_threshold, approximateIK=args.approximate_ik,
+                                trajectoryCache=trajectoryCache, warmStart=args.warm_start or args.compare_warm_start,
+                                compareWarmStart=args.compare_warm_start, processes=args.planner_processes,
+                                speculate=args.speculate, tiered=args.tiered,
+                                adaptiveSteps=args.adaptive_steps, phaseTimer=phaseTimer, planBudget=args.plan_budget)
+    if ravenPlanner.trajectoryLibrary is not None:
+        rospy.on_shutdown(lambda: rospy.loginfo('Warm start %s' % ravenPlanner.trajectoryLibrary.stats.stats()))
+    rospy.on_shutdown(lambda: rospy.loginfo('Planning tiers %s' % ravenPlanner.tierStats.stats()))
+    if ravenPlanner.speculator is not None:
+        rospy.on_shutdown(lambda: rospy.loginfo('Speculation %s' % ravenPlanner.speculator.stats.stats()))
+    if args.plan_budget is not None:
+        rospy.on_shutdown(lambda: rospy.loginfo('Planning deadlines %s' % ravenPlanner.anytimeStats.stats()))
+    if args.approximate_ik:
+        rospy.on_shutdown(lambda: rospy.loginfo('Approximate ik %s' % ravenPlanner.ikFallbackStats.stats()))
     master = MasterClass(armName, ravenArm, ravenPlanner, imageDetector)
     master.run()
 
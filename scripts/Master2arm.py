@@ -43,6 +43,9 @@ import IPython
 
 STEPS_PER_METER = 50
 
+# approach direction to the foam when the allocator has no grasp search
+FOAM_APPROACH_DIR = np.array([0,.1,.9])
+
 DATA_RECORD_DIR = 'calibration/right/trajectory_data2'
 
 def getGrid(homePose, x_inc, y_inc, z_inc, z_levels, x_levels, y_levels, angles):
@@ -115,14 +118,44 @@ class Completer(object):
     __repr__ = __str__
 
 class ReceptacleToken(object):
-    def __init__(self):
+    def __init__(self, receptaclePose=None, jointsSource=None, minArmClearance=None):
+        """
+        With minArmClearance, the token is only granted when the requesting
+        arm at receptaclePose keeps that clearance from the other arm's
+        current joints, given by jointsSource(armName)
+        """
         self.lock = threading.Lock()
         
         self.tokenHolder = None
+        
+        self.receptaclePose = receptaclePose
+        self.jointsSource = jointsSource
+        self.minArmClearance = minArmClearance
+    
+    def clearOfOtherArm(self, armName):
+        if self.minArmClearance is None or self.jointsSource is None:
+            return True
+        from RavenDebridement.RavenCommand import ArmClearance
+        import RavenDebridement.RavenCommand.kinematics as kin
+        otherArm = raven_constants.Arm.Right if armName == raven_constants.Arm.Left else raven_constants.Arm.Left
+        currentJoints = self.jointsSource(armName)
+        otherJoints = self.jointsSource(otherArm)
+        if not currentJoints or not otherJoints:
+            return True
+        receptacleJoints = kin.invArmKinClosest(armName, tfx.pose(self.receptaclePose), math.pi/4., currentJoints)
+        if receptacleJoints is None:
+            return True
+        clearance = ArmClearance.armSweptClearance(armName, kin.jointDictsToArray([currentJoints, receptacleJoints]), kin.jointDictsToArray([otherJoints]))
+        MasterClass.publish_event('ReceptacleToken_clearance_%s' % armName,clearance)
+        return clearance >= self.minArmClearance
     
     def requestToken(self, armName):
         MasterClass.publish_event('ReceptacleToken_request',armName)
         with self.lock:
+            if self.tokenHolder is None and not self.clearOfOtherArm(armName):
+                print 'Rejecting request %s, too close to the other arm'%armName
+                MasterClass.publish_event('ReceptacleToken_rejected',armName)
+                return False
             if self.tokenHolder is None or self.tokenHolder == armName:
                 print 'New tokenHolder is %s'%armName
                 self.tokenHolder = armName
@@ -174,7 +207,7 @@ class WaitForCompletion(smach.State):
     
 class AllocateFoam(smach.State):
     def __init__(self, armName, foamAllocator, ravenArm, ravenPlanner, gripperPoseEstimator, holdingPose, stepsPerMeter, transFrame, rotFrame, receptacleLock, completer=None, simulatedFoam=False, collectData=True):
-        smach.State.__init__(self, outcomes = ['foamFound','noFoamFound'], input_keys = ['foamOffset'], output_keys = ['foamPose','numInOuterThreshold'])
+        smach.State.__init__(self, outcomes = ['foamFound','noFoamFound'], input_keys = ['foamOffset'], output_keys = ['foamPose','approachDir','numInOuterThreshold'])
         self.armName = armName
         self.foamAllocator = foamAllocator
         self.ravenArm = ravenArm
@@ -295,7 +328,10 @@ class AllocateFoam(smach.State):
                     return self.didNotFindFoam()
                 
                 rospy.loginfo('Spinning, waiting for valid foam allocation %s' % self.armName)
-                foamPose = self.foamAllocator.allocateFoam(new=True)
+                seedJoints = None
+                if MasterClass.GRASP_SEARCH:
+                    seedJoints = self.ravenPlanner.getCurrentJoints(self.armName)
+                foamPose = self.foamAllocator.allocateFoam(new=True, seedJoints=seedJoints)
                 rospy.loginfo('Just tried to allocate foam piece %s' % self.armName)
                 
                 endPose = self.ravenArm.getGripperPose()
@@ -323,6 +359,11 @@ class AllocateFoam(smach.State):
         
         userdata.foamPose = foamPose.msg.PoseStamped()
         
+        approachDir = None
+        if not self.simulatedFoam:
+            approachDir = self.foamAllocator.getApproachDir()
+        userdata.approachDir = approachDir if approachDir is not None else FOAM_APPROACH_DIR
+        
         print 'foamPose %s' % self.armName
         print foamPose
         
@@ -335,6 +376,7 @@ class AllocateFoam(smach.State):
 class PlanTrajToFoam(smach.State):
     def __init__(self, ravenArm, gripperPoseEstimator, ravenPlanner, errorModel, stepsPerMeter, transFrame, rotFrame, speed):
         smach.State.__init__(self, outcomes = ['success', 'failure','IKFailure'],
+                             input_keys = ['approachDir'],
                              output_keys = ['deltaPoseTraj','gripperPose'],
                              io_keys = ['foamPose'])
         self.armName = ravenArm.name
@@ -378,7 +420,7 @@ class PlanTrajToFoam(smach.State):
         try:
             # NOTE: temporarily removed correction to check if trajopt collision checker would fail
             (correctedStartPose, deltaPoseTraj) = self.ravenPlanner.getFullTrajectoryFromPose(self.ravenArm.name, foamPose,
-                startPose=gripperPose, n_steps=n_steps, approachDir=np.array([0,.1,.9]), correctTrajectory=True, speed=self.speed)
+                startPose=gripperPose, n_steps=n_steps, approachDir=userdata.approachDir, correctTrajectory=True, speed=self.speed)
             #IPython.embed()
         except RuntimeError as e:
             rospy.loginfo(e)
@@ -860,6 +902,7 @@ class TransitionPublisher(object):
 class MasterClass(object):
     PAUSE_BETWEEN_STATES = False
     START_IN_HOLD_POSE = False
+    GRASP_SEARCH = False
     file_lock = threading.Lock()
     output_file = open('/tmp/master_output.txt','w')
     event_publisher = None
@@ -881,7 +924,7 @@ class MasterClass(object):
             cls.output_file.write(*args,**kwargs)
     
     def __init__(self, armName, ravenPlanner, foamAllocator, gripperPoseEstimator, errorModel, receptaclePose, defaultPoseSpeed,
-                 closedGraspValues=dict(), simulatedFoam=False, record=False, bothArms=True):
+                 closedGraspValues=dict(), simulatedFoam=False, record=False, bothArms=True, minArmClearance=None):
         self.armName = armName
         
         if armName == raven_constants.Arm.Left:
@@ -945,7 +988,7 @@ class MasterClass(object):
         self.otherFoamAllocator = ArmFoamAllocator(self.otherArmName, foamAllocator)
         
         self.receptaclePose = receptaclePose  
-        self.receptacleLock = ReceptacleToken()
+        self.receptacleLock = ReceptacleToken(receptaclePose, ravenPlanner.getCurrentJoints, minArmClearance)
         
         # translation frame
         self.transFrame = raven_constants.Frames.Link0
@@ -1138,6 +1181,10 @@ def mainloop():
     parser.add_argument('--simulate', default = False)
     parser.add_argument('--record', default = False)
     parser.add_argument('--onearm', default = False)
+    parser.add_argument('--reachability-map', default=None, help='prefix of maps built by ReachabilityMap, loads PREFIX_L and PREFIX_R')
+    parser.add_argument('--grasp-search', action='store_true', help='search grasp orientations and approach directions for each foam piece')
+    parser.add_argument('--min-arm-clearance', type=float, default=None, help='clearance (m) from the other arm required to allocate foam and to get the receptacle')
+    parser.add_argument('--approximate-ik', action='store_true', help='numerical ik for foam poses just outside the joint limits')
     args = parser.parse_args(rospy.myargv()[1:])
     
     if args.pause is not False:
@@ -1150,7 +1197,24 @@ def mainloop():
     if args.start_in_hold_pose:
         MasterClass.START_IN_HOLD_POSE = True
     
-    foamAllocator = FoamAllocator()
+    reachabilityMaps = {}
+    if args.reachability_map:
+        from RavenDebridement.RavenCommand.ReachabilityMap import ReachabilityMap
+        for arm in ('L','R'):
+            reachabilityMaps[arm] = ReachabilityMap.load('%s_%s' % (args.reachability_map, arm))
+    
+    graspSearch = None
+    if args.grasp_search:
+        from RavenDebridement.RavenCommand import GraspCandidates
+        graspSearch = GraspCandidates.bestGrasp
+        MasterClass.GRASP_SEARCH = True
+    
+    ikFallback = None
+    if args.approximate_ik:
+        from RavenDebridement.RavenCommand import NumericalIK
+        ikFallback = NumericalIK.invArmKinWithFallback
+        rospy.on_shutdown(lambda: rospy.loginfo('Approximate ik %s' % NumericalIK.STATS.stats()))
+    
     gripperPoseEstimator = GripperPoseEstimator()
     
     leftErrorModelFileName = rospy.get_param('left_error_model')
@@ -1166,6 +1230,10 @@ def mainloop():
     else:
         ravenPlanner = RavenPlanner(['L', 'R'], errorModel=errorModel, withWorkspace=args.with_workspace, addNoise=args.noise)
     print 'After raven planner'
+    
+    foamAllocator = FoamAllocator(reachabilityMaps=reachabilityMaps, graspSearch=graspSearch,
+                                  minArmClearance=args.min_arm_clearance, jointsSource=ravenPlanner.getCurrentJoints,
+                                  ikFallback=ikFallback)
 
     if args.show_openrave:
         ravenPlanner.env.SetViewer('qtcoin')
@@ -1202,7 +1270,7 @@ def mainloop():
     
     print 'Creating Master class...'
     
-    master = MasterClass(armName, ravenPlanner, foamAllocator, gripperPoseEstimator, errorModel, receptaclePose, args.speed, closedGraspValues, simulatedFoam=args.simulate, record=args.record, bothArms=(not args.onearm))
+    master = MasterClass(armName, ravenPlanner, foamAllocator, gripperPoseEstimator, errorModel, receptaclePose, args.speed, closedGraspValues, simulatedFoam=args.simulate, record=args.record, bothArms=(not args.onearm), minArmClearance=args.min_arm_clearance)
     master.run()
 
 if __name__ == '__main__':
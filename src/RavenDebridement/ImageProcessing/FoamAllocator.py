@@ -24,9 +24,40 @@ from raven_2_control import kinematics
 import IPython
 
 class FoamAllocator(object):
-    def __init__(self):
+    def __init__(self, reachabilityMaps=None, graspSearch=None, minArmClearance=None, jointsSource=None, ikFallback=None):
+        """
+        reachabilityMaps is an optional dict of arm name to ReachabilityMap,
+        used to skip the ik for foam centers well inside or outside the workspace
+
+        graspSearch is an optional function(armName, center, seedJoints)
+        returning the best grasp of a foam center (see GraspCandidates.bestGrasp)
+        or None, used in place of the fixed grasp orientation
+
+        minArmClearance is an optional clearance (m) the grasp of a foam center
+        must keep from the other arm's current joints and its allocated grasp,
+        jointsSource a function(armName) returning the current joints of an
+        arm or None (e.g. the planner's getCurrentJoints)
+
+        ikFallback is an optional function(armName, pose, grasp, solver)
+        returning (joints, approximate, residual), see
+        NumericalIK.invArmKinWithFallback, so foam centers just outside the
+        joint limits get an approximate ik solution instead of being rejected
+        """
         self.ignore = False
         
+        self.reachabilityMaps = reachabilityMaps or {}
+        self.graspSearch = graspSearch
+        # grasp of each unallocated center from the last search, by arm and center position
+        self.centerGrasps = {arm : {} for arm in 'LR'}
+        self.approachDirs = {arm : None for arm in 'LR'}
+        
+        self.minArmClearance = minArmClearance
+        self.jointsSource = jointsSource
+        self.ikFallback = ikFallback
+        # grasp joints of each unallocated center and of each allocation, for the clearance check
+        self.centerJoints = {arm : {} for arm in 'LR'}
+        self.allocationJoints = {arm : None for arm in 'LR'}
+        
         self.currentCenters = []
         self.newCenters = False
         
@@ -214,20 +245,98 @@ class FoamAllocator(object):
                         allCenters.append(center)
             return [tfx.point(center) for center in allCenters]
     
-    def _getUnallocatedCenters(self, armName, centers, new=False, forHasFoam=False):
+    def _isReachable(self, armName, pose, grasp):
+        reachabilityMap = self.reachabilityMaps.get(armName)
+        if reachabilityMap is not None:
+            reachable = reachabilityMap.isReachable(pose, grasp)
+            if reachable is not None:
+                return reachable
+        return self._invArmKin(armName, pose, grasp) is not None
+    
+    def _invArmKin(self, armName, pose, grasp):
+        if self.ikFallback is None:
+            return kinematics.invArmKin(armName, pose, grasp)
+        joints, approximate, residual = self.ikFallback(armName, pose, grasp, solver=kinematics.invArmKin)
+        if approximate and joints is not None:
+            self.event_pub.publish(String('Approximate IK for arm {0} at pose {1}, residual {2}'.format(armName,pose,residual)))
+        return joints
+    
+    def _currentJoints(self, armName):
+        if self.jointsSource is None:
+            return None
+        return self.jointsSource(armName)
+    
+    def _graspJoints(self, armName, center, grasp):
+        """
+        Joints of the grasp of center, from the same ik as the reachability
+        check (the grasp search's joints with a graspSearch). None without
+        an ik solution
+        """
+        if grasp is not None:
+            return grasp.joints
+        joints = self._invArmKin(armName, tfx.pose(center,tfx.tb_angles(-90,90,0)), math.pi/4.0)
+        if joints is None:
+            return None
+        return [joints]
+    
+    def _otherArmJoints(self, armName):
+        """
+        Current joints and allocated grasp joints of the other arm, the ones known
+        """
+        otherArm = 'R' if armName == 'L' else 'L'
+        otherJoints = []
+        currentJoints = self._currentJoints(otherArm)
+        if currentJoints:
+            otherJoints.append([currentJoints])
+        if self.allocationJoints[otherArm] is not None:
+            otherJoints.append(self.allocationJoints[otherArm])
+        return otherJoints
+    
+    def _clearance(self, armName, graspJoints, otherJoints):
+        """
+        Smallest swept clearance between graspJoints of armName and each of otherJoints
+        """
+        from RavenDebridement.RavenCommand import ArmClearance
+        return min(ArmClearance.armSweptClearance(armName, graspJoints, joints) for joints in otherJoints)
+    
+    def _getUnallocatedCenters(self, armName, centers, new=False, forHasFoam=False, seedJoints=None):
         unallocCenters = []
         numAlloc = collections.defaultdict(int)
+        if self.graspSearch is not None:
+            self.centerGrasps[armName] = {}
+        self.centerJoints[armName] = {}
+        otherJoints = None
+        if self.minArmClearance is not None:
+            otherJoints = self._otherArmJoints(armName)
         for center in centers:
             ok = True
             print tfx.pose(center)
-            foam_ik_valid = kinematics.invArmKin(armName, tfx.pose(center,tfx.tb_angles(-90,90,0)), math.pi/4.0) is not None
-            lift_ik_valid = kinematics.invArmKin(armName, tfx.pose(center+[0,0,.06],tfx.tb_angles(-90,90,0)), math.pi/4.0) is not None
+            if self.graspSearch is not None:
+                grasp = self.graspSearch(armName, center, seedJoints)
+                if grasp is None:
+                    ok = False
+                    self.event_pub.publish(String('Cannot allocate foam piece for arm {0} because no grasp orientation is valid for pose {1}'.format(armName,center)))
+                else:
+                    self.centerGrasps[armName][tuple(center.list)] = grasp
+                foam_ik_valid = lift_ik_valid = True
+            else:
+                foam_ik_valid = self._isReachable(armName, tfx.pose(center,tfx.tb_angles(-90,90,0)), math.pi/4.0)
+                lift_ik_valid = self._isReachable(armName, tfx.pose(center+[0,0,.06],tfx.tb_angles(-90,90,0)), math.pi/4.0)
             if not foam_ik_valid:
                 ok = False
                 self.event_pub.publish(String('Cannot allocate foam piece for arm {0} because IK invalid for pose {1}'.format(armName,center)))
             if not lift_ik_valid:
                 ok = False
                 self.event_pub.publish(String('Cannot allocate foam piece for arm {0} because IK invalid for move vertical pose {1}'.format(armName,center+[0,0,.06])))
+            if ok and otherJoints:
+                graspJoints = self._graspJoints(armName, center, self.centerGrasps[armName].get(tuple(center.list)))
+                if graspJoints is not None:
+                    clearance = self._clearance(armName, graspJoints, otherJoints)
+                    if clearance < self.minArmClearance:
+                        ok = False
+                        self.event_pub.publish(String('Cannot allocate foam piece for arm {0} because grasp is {1} from the other arm at pose {2}'.format(armName,clearance,center)))
+                    else:
+                        self.centerJoints[armName][tuple(center.list)] = graspJoints
             for allocArm, allocationCenter in self.allocations.iteritems():
                 if allocationCenter is not None and allocationCenter.distance(center) < self.allocationRadius:
                     print 'allocationCenter {0}'.format(allocationCenter)
@@ -269,8 +378,11 @@ class FoamAllocator(object):
                 self.allocation_pub.publish(msg)
             return foam_found
     
-    def allocateFoam(self, armName, new=False):
-        
+    def allocateFoam(self, armName, new=False, seedJoints=None):
+        """
+        seedJoints are the current joints of the arm, used to rank the
+        grasps when there is a graspSearch
+        """
         with self.lock:
             self.newCenters = False
         timeout = raven_util.Timeout(2)
@@ -281,7 +393,7 @@ class FoamAllocator(object):
                 return None
         with self.lock:
             
-            centers = self._getUnallocatedCenters(armName, self.currentCenters, new=new)
+            centers = self._getUnallocatedCenters(armName, self.currentCenters, new=new, seedJoints=seedJoints)
             print 'centers %s' % armName
             print centers
                     
@@ -303,13 +415,21 @@ class FoamAllocator(object):
                     best = center
             
             self.allocations[armName] = best
+            self.allocationJoints[armName] = self.centerJoints[armName].get(tuple(best.list))
             
+            orientation = self.orientation
+            self.approachDirs[armName] = None
+            grasp = self.centerGrasps[armName].get(tuple(best.list))
+            if grasp is not None:
+                orientation = tfx.rotation(grasp.rotation)
+                self.approachDirs[armName] = grasp.approachDir
+                print 'grasp', armName, grasp
             
             best = tfx.convertToFrame(best,raven_constants.Frames.Link0)
             print 'returning new allocation', armName, best
             self._printState()
             
-            foamPose = tfx.pose(best,self.orientation)
+            foamPose = tfx.pose(best,orientation)
             
             msg = FoamAllocation()
             msg.header.stamp = rospy.Time.now()
@@ -322,6 +442,14 @@ class FoamAllocator(object):
     def releaseAllocation(self, armName):
         with self.lock:
             self.allocations[armName] = None
+            self.allocationJoints[armName] = None
+    
+    def getApproachDir(self, armName):
+        """
+        Approach direction of the grasp of the last allocation, None without a graspSearch
+        """
+        with self.lock:
+            return self.approachDirs[armName]
 
 class ArmFoamAllocator(object):
     def __init__(self, armName, allocator=None):
@@ -331,12 +459,15 @@ class ArmFoamAllocator(object):
     def hasFoam(self, new=False):
         return self.allocator.hasFoam(self.armName, new=new)
     
-    def allocateFoam(self, new=False):
-        return self.allocator.allocateFoam(self.armName, new=new)
+    def allocateFoam(self, new=False, seedJoints=None):
+        return self.allocator.allocateFoam(self.armName, new=new, seedJoints=seedJoints)
     
     def releaseAllocation(self):
         return self.allocator.releaseAllocation(self.armName)
     
+    def getApproachDir(self):
+        return self.allocator.getApproachDir(self.armName)
+    
 def test():
     import IPython
     rospy.init_node('testFoamAllocator',anonymous=True)
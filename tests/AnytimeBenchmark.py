@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Deadline misses and trajectory quality of RavenPlanner2 against the
+planning budget.
+
+Plans the same random moves between joint configurations around the
+default joints with each budget, then prints the planner's AnytimeStats:
+per budget, how many plans trajopt finished in time, how many got a
+fallback and how many were late, and the median normalized joint path
+cost (1 is the straight line) of what was returned.
+
+    AnytimeBenchmark.py --moves 30 --budgets .05 .1 .25 .5 1 --warm-start
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+import rospy
+
+import time
+import argparse
+import pprint
+
+import numpy as np
+
+from RavenDebridement.RavenCommand.RavenPlanner2 import RavenPlanner
+from RavenDebridement.Utils import Constants as MyConstants
+
+# uniform noise around the default joints (shoulder, elbow, insertion, rotation, pitch, yaw)
+JOINT_NOISE = np.array([.3, .3, .03, .6, .6, .6])
+
+def randomJoints(rp):
+    positions = np.array(rp.defaultJointPositions) + np.random.uniform(-1, 1, len(JOINT_NOISE)) * JOINT_NOISE
+    return dict(zip(rp.rosJointTypes, positions))
+
+def benchmark(rp, armName, moves, budgets, n_steps, grasp=.5):
+    pairs = [(randomJoints(rp), randomJoints(rp)) for _ in xrange(moves)]
+    for budget in budgets:
+        for startJoints, endJoints in pairs:
+            request = rp.requestFromJoints(armName, startJoints, endJoints, n_steps=n_steps, grasp=grasp)
+            request.deadline = time.time() + budget
+            rp.optimize1({armName : request})
+    pprint.pprint(rp.anytimeStats.stats())
+
+if __name__ == '__main__':
+    rospy.init_node('anytime_benchmark',anonymous=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--moves',type=int,default=30)
+    parser.add_argument('--budgets',type=float,nargs='+',default=[.05, .1, .25, .5, 1.])
+    parser.add_argument('--n-steps',type=int,default=20)
+    parser.add_argument('--arm',default=MyConstants.Arm.Right)
+    parser.add_argument('--with-workspace',action='store_true',default=False)
+    parser.add_argument('--warm-start',action='store_true',default=False,help='use the trajectory library, which also gives fallbacks')
+    parser.add_argument('--planner-processes',type=int,default=0)
+    parser.add_argument('--seed',type=int,default=0)
+    args = parser.parse_args(rospy.myargv()[1:])
+
+    np.random.seed(args.seed)
+    rp = RavenPlanner(args.arm, thread=False, withWorkspace=args.with_workspace, warmStart=args.warm_start,
+                      processes=args.planner_processes)
+    benchmark(rp, args.arm, args.moves, args.budgets, args.n_steps)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Solve time and trajectory quality of RavenPlanner2 with the fixed
+discretization (n_steps from steps per meter of tool motion, as in the
+masters) against adaptiveSteps.
+
+Plans moves between random joint configurations around the default
+joints and reports, per policy, the median solve time, the trajopt
+waypoints, the failures, the tool path length and the largest joint
+step of the trajectory sent to the controller.
+
+    DiscretizationBenchmark.py --moves 50 --steps-per-meter 50
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+import rospy
+
+import time
+import argparse
+
+import numpy as np
+
+from RavenDebridement.RavenCommand.RavenPlanner2 import RavenPlanner
+from RavenDebridement.RavenCommand import Discretization
+from RavenDebridement.Utils import Constants as MyConstants
+
+# uniform noise around the default joints (shoulder, elbow, insertion, rotation, pitch, yaw)
+JOINT_NOISE = np.array([.3, .3, .03, .6, .6, .6])
+
+def randomJoints(rp):
+    positions = np.array(rp.defaultJointPositions) + np.random.uniform(-1, 1, len(JOINT_NOISE)) * JOINT_NOISE
+    return dict(zip(rp.rosJointTypes, positions))
+
+def pathLength(poseTraj):
+    positions = np.array([pose.position.list for pose in poseTraj])
+    return float(np.sum(np.linalg.norm(np.diff(positions, axis=0), axis=1)))
+
+def benchmark(rp, armName, moves, stepsPerMeter, grasp=.5):
+    results = dict((policy, {'times' : [], 'solveSteps' : [], 'failures' : 0, 'lengths' : [], 'jointSteps' : []})
+                   for policy in ('fixed', 'adaptive'))
+    for i in xrange(moves):
+        startJoints, endJoints = randomJoints(rp), randomJoints(rp)
+        request = rp.requestFromJoints(armName, startJoints, endJoints, grasp=grasp)
+        distance = np.linalg.norm(np.array(request.endPose.position.list) - np.array(request.startPose.position.list))
+        n_steps = int(stepsPerMeter * distance) + 1
+
+        # in the order of the trajopt problem, as solveSteps takes them
+        jointTypes = [rp.raveJointTypesToRos[armName][raveJointType] for raveJointType in rp.manip[armName].GetArmIndices()]
+        startJointPositions = [startJoints[k] for k in jointTypes]
+        endJointPositions = [endJoints[k] for k in jointTypes]
+        for policy in ('fixed', 'adaptive'):
+            rp.adaptiveSteps = policy == 'adaptive'
+            result = results[policy]
+            request = rp.requestFromJoints(armName, startJoints, endJoints, n_steps=n_steps, grasp=grasp)
+
+            start = time.time()
+            deltaPoseTraj = rp.optimize1({armName : request})[armName]
+            result['times'].append(time.time() - start)
+            if rp.adaptiveSteps:
+                result['solveSteps'].append(rp.solveSteps({armName : request}, startJointPositions, endJointPositions))
+            else:
+                result['solveSteps'].append(max(n_steps, Discretization.MIN_STEPS))
+
+            if deltaPoseTraj is None:
+                result['failures'] += 1
+                continue
+            result['lengths'].append(pathLength(rp.poseTraj[armName]))
+            joints = np.array([[state[k] for k in rp.rosJointTypes] for state in rp.jointTraj[armName]])
+            result['jointSteps'].append(float(np.abs(np.diff(joints, axis=0)).max()) if len(joints) > 1 else 0.)
+
+    for policy, result in results.iteritems():
+        print '%-9s median solve %.1f ms, median waypoints %d, %d/%d failed, median path %.4f m, largest joint step %.4f' % (
+            policy, np.median(result['times'])*1000, np.median(result['solveSteps']), result['failures'], moves,
+            np.median(result['lengths']) if result['lengths'] else float('nan'),
+            np.max(result['jointSteps']) if result['jointSteps'] else float('nan'))
+
+if __name__ == '__main__':
+    rospy.init_node('discretization_benchmark',anonymous=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--moves',type=int,default=50)
+    parser.add_argument('--steps-per-meter',type=float,default=50)
+    parser.add_argument('--arm',default=MyConstants.Arm.Right)
+    parser.add_argument('--with-workspace',action='store_true',default=False)
+    parser.add_argument('--seed',type=int,default=0)
+    args = parser.parse_args(rospy.myargv()[1:])
+
+    np.random.seed(args.seed)
+    rp = RavenPlanner(args.arm, thread=False, withWorkspace=args.with_workspace)
+    benchmark(rp, args.arm, args.moves, args.steps_per_meter)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""
+Headless speed and accuracy check of kinematics.py.
+
+Times FK/IK through the scalar tfx path (kinematics.fwdArmKin/invArmKin),
+the numpy path (RavenKinematicModel) and the batch path
+(kinematics.fwdArmKinBatch/invArmKinBatch), and reports the IK(FK(q))
+round trip errors of each path. Samples come from DataRecorder pickles
+(robot_joints/robot_poses) and/or are drawn uniformly within the joint
+limits.
+
+    KinematicsBenchmark.py --pickle run.pkl --save-baseline baseline.json
+    KinematicsBenchmark.py --pickle run.pkl --baseline baseline.json
+
+With --baseline, exits with 1 if a rate dropped or an error grew past
+the tolerances.
+"""
+
+import roslib
+roslib.load_manifest('RavenDebridement')
+
+import os
+import sys
+import time
+import json
+import argparse
+import cPickle as pickle
+
+import numpy as np
+import tfx
+
+import RavenDebridement.RavenCommand.kinematics as kin
+from RavenDebridement.RavenCommand.kinematics import JOINT_TYPES, TOOL_ROT, WRIST, SHOULDER, ELBOW, Z_INS, GRASP1, GRASP2, YAW, GRASP
+from RavenDebridement.RavenCommand import RavenKinematicModel
+from RavenDebridement.RavenCommand.ReachabilityMap import JOINT_MIN_LIMITS, JOINT_MAX_LIMITS
+
+# order of the joint positions in the DataRecorder robot_joints tuples (RavenState arm.joints)
+RECORDED_JOINT_TYPES = [SHOULDER, ELBOW, Z_INS, TOOL_ROT, WRIST, GRASP1, GRASP2, YAW, GRASP]
+
+# columns of JOINT_TYPES that are angles (wrapped when comparing)
+ANGLE_COLUMNS = np.array([jointType != Z_INS for jointType in JOINT_TYPES])
+
+PERCENTILES = [50, 90, 99, 100]
+
+def recordedPoseMatrix(pose):
+    """
+    4x4 matrix of a recorded pose, either a 4x4 array or tfx pose.array
+    (x,y,z,qx,qy,qz,qw)
+    """
+    pose = np.asarray(pose, dtype=float)
+    if pose.shape == (4,4):
+        return pose
+    return np.array(tfx.pose(pose[:3], pose[3:7]).matrix, dtype=float)
+
+def loadRecorded(filename, armName, jointTypes=RECORDED_JOINT_TYPES):
+    """
+    (N,7) joints and (N,4,4) poses of armName from a DataRecorder pickle,
+    paired by index. Poses are None if the pickle has no robot_poses
+    """
+    with open(filename, 'rb') as fp:
+        d = pickle.load(fp)
+    recordedJoints = d['robot_joints'][armName]
+    joints = np.array([[dict(zip(jointTypes, positions))[jointType] for jointType in JOINT_TYPES]
+                       for _, positions in recordedJoints], dtype=float).reshape(-1,len(JOINT_TYPES))
+    recordedPoses = d.get('robot_poses', {}).get(armName)
+    if not recordedPoses or len(recordedPoses) != len(recordedJoints):
+        return joints, None
+    poses = np.array([recordedPoseMatrix(pose) for _, pose in recordedPoses], dtype=float)
+    return joints, poses
+
+def sampleJoints(n, seed=0):
+    """
+    n joint configurations uniformly within the joint limits
+    """
+    rng = np.random.RandomState(seed)
+    joints = rng.uniform(JOINT_MIN_LIMITS, JOINT_MAX_LIMITS, size=(n,len(JOINT_TYPES)))
+    # keep the grasp (g1 + g2) within the finger limits
+    joints[:,5:7] *= .5
+    return joints
+
+def jointError(joints0, joints1):
+    """
+    Max abs joint difference of each row, angles wrapped to [-pi,pi]
+    """
+    delta = joints1 - joints0
+    delta[:,ANGLE_COLUMNS] = (delta[:,ANGLE_COLUMNS] + np.pi) % (2*np.pi) - np.pi
+    return np.abs(delta).max(axis=1)
+
+def poseError(poses0, poses1):
+    """
+    Position (meters) and rotation (radians) error of each pair of 4x4 poses
+    """
+    posErr = np.linalg.norm(poses1[:,:3,3] - poses0[:,:3,3], axis=1)
+    R = np.einsum('nij,nkj->nik', poses1[:,:3,:3], poses0[:,:3,:3])
+    cosAngle = np.clip((np.trace(R, axis1=1, axis2=2) - 1.)/2., -1., 1.)
+    return posErr, np.arccos(cosAngle)
+
+def distribution(values):
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return None
+    return dict(('p%d' % p, float(np.percentile(values, p))) for p in PERCENTILES)
+
+def timed(f, n):
+    """
+    Calls f() and returns its result and the calls per second for n calls.
+    stdout is discarded meanwhile, invArmKin prints every failure
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        result = f()
+        elapsed = max(time.time() - start, 1e-9)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return result, n / elapsed
+
+def benchmarkArm(armName, joints, recordedPoses=None, maxScalar=1000):
+    """
+    Rates and errors of the three paths for the (N,7) joints of one arm.
+    The scalar paths use the first maxScalar samples
+    """
+    model = RavenKinematicModel.getModel(armName)
+    grasps = kin.fwdArmKinBatch(armName, joints)[1]
+    jointDicts = kin.jointArrayToDicts(joints)
+    nScalar = min(len(joints), maxScalar)
+
+    results = {'samples' : len(joints), 'rates' : {}, 'errors' : {}}
+    rates, errors = results['rates'], results['errors']
+
+    # forward kinematics
+    batchPoses, rates['batch_fk'] = timed(lambda: kin.fwdArmKinBatch(armName, joints)[0], len(joints))
+    tfxPoses, rates['tfx_fk'] = timed(lambda: [kin.fwdArmKin(armName, q)[0] for q in jointDicts[:nScalar]], nScalar)
+    modelPoses, rates['numpy_fk'] = timed(lambda: [model.fwdArmKin(q)[0] for q in jointDicts[:nScalar]], nScalar)
+    tfxPoses = np.array([np.array(pose.matrix, dtype=float) for pose in tfxPoses])
+    modelPoses = np.array(modelPoses, dtype=float)
+
+    # agreement of the paths
+    errors['fk_numpy_vs_tfx'] = distribution(np.abs(modelPoses - tfxPoses).reshape(nScalar,-1).max(axis=1))
+    errors['fk_batch_vs_tfx'] = distribution(np.abs(batchPoses[:nScalar] - tfxPoses).reshape(nScalar,-1).max(axis=1))
+
+    if recordedPoses is not None:
+        posErr, rotErr = poseError(recordedPoses, batchPoses)
+        errors['fk_vs_recorded_pos'] = distribution(posErr)
+        errors['fk_vs_recorded_rot'] = distribution(rotErr)
+
+    # inverse kinematics of the fk poses
+    tfxPoseObjects = [tfx.pose(pose, frame='/0_link') for pose in batchPoses[:nScalar]]
+    (batchJoints, valid, _, _), rates['batch_ik'] = timed(lambda: kin.invArmKinBatch(armName, batchPoses, grasps), len(joints))
+    tfxJoints, rates['tfx_ik'] = timed(lambda: [kin.invArmKin(armName, pose, grasp) for pose, grasp in zip(tfxPoseObjects, grasps)], nScalar)
+    modelJoints, rates['numpy_ik'] = timed(lambda: [model.invArmKin(pose, grasp) for pose, grasp in zip(batchPoses, grasps)], nScalar)
+
+    def toArray(solutions):
+        return np.array([[solution[jointType] for jointType in JOINT_TYPES] if solution is not None
+                         else [np.nan]*len(JOINT_TYPES) for solution in solutions], dtype=float).reshape(-1,len(JOINT_TYPES))
+
+    batchJoints = np.where(valid[:,None], batchJoints, np.nan)
+    for name, ikJoints in (('tfx', toArray(tfxJoints)), ('numpy', toArray(modelJoints)), ('batch', batchJoints)):
+        found = ~np.isnan(ikJoints).any(axis=1)
+        errors['roundtrip_%s_joint' % name] = distribution(jointError(joints[:len(ikJoints)][found], ikJoints[found]))
+        results['roundtrip_%s_failures' % name] = float(1. - found.mean()) if len(found) else 0.
+
+    # pose error of fk(ik(pose)), independent of which branch the ik picked
+    posErr, rotErr = poseError(batchPoses[valid], kin.fwdArmKinBatch(armName, batchJoints[valid])[0])
+    errors['roundtrip_batch_pos'] = distribution(posErr)
+    errors['roundtrip_batch_rot'] = distribution(rotErr)
+
+    return results
+
+def compare(results, baseline, rateTolerance=.5, errorFactor=2., errorSlack=1e-9):
+    """
+    Regressions of results against baseline: rates below
+    (1 - rateTolerance) * baseline, errors above errorFactor * baseline + errorSlack
+    and failure rates that grew by more than a percent
+    """
+    regressions = []
+    for armName, armResults in sorted(results.items()):
+        armBaseline = baseline.get(armName)
+        if armBaseline is None:
+            continue
+        for name, rate in sorted(armResults['rates'].items()):
+            baseRate = armBaseline['rates'].get(name)
+            if baseRate is not None and rate < (1. - rateTolerance) * baseRate:
+                regressions.append('%s %s: %.0f/s, baseline %.0f/s' % (armName, name, rate, baseRate))
+        for name, dist in sorted(armResults['errors'].items()):
+            baseDist = armBaseline['errors'].get(name)
+            if dist is None or baseDist is None:
+                continue
+            for p, value in sorted(dist.items()):
+                if value > errorFactor * baseDist[p] + errorSlack:
+                    regressions.append('%s %s %s: %g, baseline %g' % (armName, name, p, value, baseDist[p]))
+        for name, value in sorted(armResults.items()):
+            if name.endswith('_failures') and value > armBaseline.get(name, value) + .01:
+                regressions.append('%s %s: %.3f, baseline %.3f' % (armName, name, value, armBaseline[name]))
+    return regressions
+
+def printResults(results):
+    for armName, armResults in sorted(results.items()):
+        print 'arm %s (%d samples)' % (armName, armResults['samples'])
+        for name, rate in sorted(armResults['rates'].items()):
+            print '  %-12s %12.0f calls/s' % (name, rate)
+        for name, dist in sorted(armResults['errors'].items()):
+            if dist is None:
+                continue
+            print '  %-24s %s' % (name, '  '.join('%s %.2e' % (p, dist[p]) for p in ['p%d' % p for p in PERCENTILES]))
+        for name, value in sorted(armResults.items()):
+            if name.endswith('_failures'):
+                print '  %-24s %.3f' % (name, value)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks and cross-validates the Raven kinematics')
+    parser.add_argument('--pickle',nargs='*',default=[],help='DataRecorder pickles with robot_joints/robot_poses')
+    parser.add_argument('--samples',type=int,default=None,help='number of synthetic samples (default 10000 without --pickle)')
+    parser.add_argument('--max-scalar',type=int,default=1000,help='samples used for the scalar paths')
+    parser.add_argument('--arms',nargs='+',default=[kin.GOLD_ARM_ID,kin.GREEN_ARM_ID])
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--baseline',help='baseline JSON to check against')
+    parser.add_argument('--save-baseline',help='writes the results to this JSON')
+    parser.add_argument('--rate-tolerance',type=float,default=.5)
+    parser.add_argument('--error-factor',type=float,default=2.)
+    args = parser.parse_args()
+
+    nSamples = args.samples
+    if nSamples is None:
+        nSamples = 0 if args.pickle else 10000
+
+    results = {}
+    for armName in args.arms:
+        jointSets, poseSets = [], []
+        for filename in args.pickle:
+            joints, poses = loadRecorded(filename, armName)
+            jointSets.append(joints)
+            poseSets.append(poses)
+        recordedPoses = None
+        if poseSets and all(poses is not None for poses in poseSets):
+            recordedPoses = np.concatenate(poseSets)
+        if nSamples > 0:
+            jointSets.append(sampleJoints(nSamples, args.seed))
+            recordedPoses = None
+        joints = np.concatenate(jointSets)
+        results[armName] = benchmarkArm(armName, joints, recordedPoses, args.max_scalar)
+
+    printResults(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+        print 'saved baseline to %s' % args.save_baseline
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.rate_tolerance, args.error_factor)
+        if regressions:
+            print 'REGRESSIONS against %s:' % args.baseline
+            for regression in regressions:
+                print '  ' + regression
+            sys.exit(1)
+        print 'no regressions against %s' % args.baseline
+
+if __name__ == '__main__':
+    main()
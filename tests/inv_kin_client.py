@@ -3,13 +3,15 @@ import roslib
 roslib.load_manifest('RavenDebridement')
 import rospy
 import math
+import time
 
-from RavenDebridement.srv import InvKinSrv
+from RavenDebridement.srv import InvKinBatchSrv
 from RavenDebridement.RavenCommand.RavenArm import RavenArm
 from RavenDebridement.RavenCommand.RavenPlanner2 import RavenPlanner
 from RavenDebridement.Utils import Constants as MyConstants
 
 from raven_2_msgs.msg import *
+from std_msgs.msg import Header
 
 import numpy as np
 
@@ -17,43 +19,80 @@ import tfx
 
 import code
 
+def poseGrid(center, step=.005, n=(8,8,4)):
+    """
+    Grid of n[0]*n[1]*n[2] poses around center with its orientation
+    """
+    grid = []
+    for i in xrange(n[0]):
+        for j in xrange(n[1]):
+            for k in xrange(n[2]):
+                grid.append(center + [step*(i - n[0]/2), step*(j - n[1]/2), step*(k - n[2]/2)])
+    return grid
+
 def invKinClient():
     rospy.init_node('inv_kin_client',anonymous=True)
     rospy.sleep(4)
     ravenArm = RavenArm(MyConstants.Arm.Right)
     rospy.sleep(4)
-    
+
     start = tfx.pose(ravenArm.getGripperPose())
     end = start + [0,-.05, 0]
-    
+    arm = Constants.ARM_TYPE_GREEN
+    grasp = ravenArm.ravenController.currentGrasp
+
+    header = Header()
+    header.frame_id = start.frame or '/0_link'
+
+    grid = poseGrid(start)
+    gridMsgs = [tfx.pose(pose).msg.Pose() for pose in grid]
+
     try:
-        rospy.wait_for_service('inv_kin_server',timeout=5)
-        inv_kin_service = rospy.ServiceProxy('inv_kin_server', InvKinSrv)
-        arm = Constants.ARM_TYPE_GREEN
-        pose = tfx.pose(ravenArm.getGripperPose())
-        grasp = ravenArm.ravenController.currentGrasp
-        rospy.loginfo('Find ik for ' + str(pose))
-        respStart = inv_kin_service(arm, grasp, start)
-        respEnd = inv_kin_service(arm, grasp, end)
+        rospy.wait_for_service('inv_kin_batch',timeout=5)
+        # persistent, so repeated calls reuse the connection
+        inv_kin_batch = rospy.ServiceProxy('inv_kin_batch', InvKinBatchSrv, persistent=True)
+
+        rospy.loginfo('Find ik for %d poses around %s' % (len(grid), start))
+        t = time.time()
+        respGrid = inv_kin_batch(header, arm, [grasp], gridMsgs)
+        batchTime = time.time() - t
+
+        t = time.time()
+        for poseMsg in gridMsgs:
+            inv_kin_batch(header, arm, [grasp], [poseMsg])
+        perPoseTime = time.time() - t
+
+        respStartEnd = inv_kin_batch(header, arm, [grasp], [start.msg.Pose(), end.msg.Pose()])
         rospy.loginfo('Called service')
     except (rospy.ServiceException, rospy.ROSException) as e:
         print "Service call failed: %s"%e
         return
 
-    startJoints = []
-    for joint in respStart.joints:
-        if joint.type in RavenPlanner.rosJointTypes:
-            startJoints.append(joint.position)
-        #print("({0},{1})".format(joint.type,joint.position))
-        
-    endJoints = []
-    for joint in respEnd.joints:
-        if joint.type in RavenPlanner.rosJointTypes:
-            endJoints.append(joint.position)
-        #print("({0},{1})".format(joint.type,joint.position))
-        
-    startJoints = np.array(startJoints)
-    endJoints = np.array(endJoints)
+    print 'batch call:    %d poses in %.1f ms (%.1f ms solving), %d valid' % (len(grid), batchTime*1000, respGrid.solve_time*1000, sum(respGrid.valid))
+    print 'one per call:  %d poses in %.1f ms' % (len(grid), perPoseTime*1000)
+
+    # the C++ server, one pose per request, if it is running
+    try:
+        from RavenDebridement.srv import InvKinSrv
+        rospy.wait_for_service('inv_kin_server',timeout=1)
+        inv_kin_service = rospy.ServiceProxy('inv_kin_server', InvKinSrv, persistent=True)
+        t = time.time()
+        for pose in grid:
+            inv_kin_service(header, arm, grasp, tfx.pose(pose).msg.Pose())
+        print 'inv_kin_server: %d poses in %.1f ms' % (len(grid), (time.time() - t)*1000)
+    except (ImportError, rospy.ServiceException, rospy.ROSException) as e:
+        print 'Skipping inv_kin_server: %s' % e
+
+    if not all(respStartEnd.valid):
+        print 'No ik for start or end pose'
+        return
+
+    jointTypes = list(respStartEnd.joint_types)
+    joints = np.array(respStartEnd.joints).reshape(-1,len(jointTypes))
+    columns = [jointTypes.index(jointType) for jointType in RavenPlanner.rosJointTypes if jointType in jointTypes]
+    startJoints = joints[0,columns]
+    endJoints = joints[1,columns]
+
     timeSteps = 50
     for i in range(timeSteps):
         print(list(startJoints + (float(i)/float(timeSteps)*(endJoints-startJoints))))